@@ -0,0 +1,728 @@
+"""
+Image analysis helpers (moments, noise, ratios) that read CASA/FITS images chunk by chunk with the ia tool.
+Load with execfile() after imaging_utils.py (uses get_image_header).
+"""
+
+import os
+import numpy as np
+
+c_light = 2.99792458e8 #m/s
+
+def _parse_angle(angle, hours=False):
+    """
+    Convert a CASA angle string ('05h35m58.472722s', '24d44m53.613450s', '05:35:58.47', '+24.44.53.6',
+    '4.arcsec', '55.0deg') to radians. Sexagesimal values are in hours if hours=True or if they contain 'h'.
+    """
+    angle = angle.strip()
+    for unit,factor in (('arcsec',1./3600.),('arcmin',1./60.),('deg',1.),('rad',180./np.pi)):
+        if angle.endswith(unit):
+            try:
+                return np.radians(float(angle[:-len(unit)])*factor)
+            except ValueError:
+                pass
+    hours = hours or 'h' in angle
+    sign  = -1. if angle.startswith('-') else 1.
+    angle = angle.lstrip('+-').rstrip('s')
+    if angle.count('.') > 1 and not any(s in angle for s in 'hdm:'):
+        #Dec in dotted format, e.g. 24.44.53.6
+        angle = angle.replace('.',' ',2)
+    for separator in ('h','d','m',':'):
+        angle = angle.replace(separator,' ')
+    value = sum(float(f)/60.**i for i,f in enumerate(angle.split()))
+    return sign*np.radians(value*(15. if hours else 1.))
+
+def world_to_pixel(header, ra, dec):
+    """
+    Pixel coordinates (x, y) of the sky position (ra, dec) (strings or radians) in an image with the given header
+    (from get_image_header), using the SIN projection about the reference pixel.
+    """
+    if isinstance(ra,str):
+        ra = _parse_angle(ra,hours=True)
+    if isinstance(dec,str):
+        dec = _parse_angle(dec)
+    ra0,dec0 = header['refval']
+    l = np.cos(dec)*np.sin(ra-ra0)
+    m = np.sin(dec)*np.cos(dec0)-np.cos(dec)*np.sin(dec0)*np.cos(ra-ra0)
+    cell_rad = header['cell']*np.pi/180./3600.
+    return header['refpix'][0]+l/cell_rad[0], header['refpix'][1]+m/cell_rad[1]
+
+def _annulus_mask(header, ra, dec, r_in, r_out):
+    """
+    Boolean (Dec, RA) pixel mask of an annulus with radii r_in, r_out (arcsec) around (ra, dec).
+    """
+    x0,y0 = world_to_pixel(header,ra,dec)
+    nx,ny = header['shape'][header['axisnames'].index('right ascension')],header['shape'][header['axisnames'].index('declination')]
+    y,x   = np.ogrid[:ny,:nx]
+    r     = np.hypot((x-x0)*header['cell'][0],(y-y0)*header['cell'][1])
+    return (r >= r_in) & (r <= r_out)
+
+def parse_region(region):
+    """
+    Parse the CASA region strings used in these scripts:
+    ellipse[[ra, dec], [a arcsec, b arcsec], pa deg], circle[[ra, dec], r arcsec] and annulus[[ra, dec], [r_in arcsec, r_out arcsec]].
+    Returns a dictionary with 'shape', 'ra', 'dec' (strings) and the sizes in arcsec ('radii' or 'axes') and pa in deg.
+    """
+    region = region.strip()
+    shape  = region[:region.index('[')].strip()
+    fields = [f.strip().strip("'").strip('"') for f in region[region.index('[')+1:region.rindex(']')].replace('[','').replace(']','').split(',')]
+    fields = [f for f in fields if len(f) > 0]
+    parsed = {'shape':shape,'ra':fields[0],'dec':fields[1]}
+    to_arcsec = lambda angle: np.degrees(_parse_angle(angle))*3600.
+    if shape == 'annulus':
+        parsed['radii'] = (to_arcsec(fields[2]),to_arcsec(fields[3]))
+    elif shape == 'circle':
+        parsed['radii'] = (0.,to_arcsec(fields[2]))
+    elif shape == 'ellipse':
+        parsed['axes'] = (to_arcsec(fields[2]),to_arcsec(fields[3]))
+        parsed['pa']   = np.degrees(_parse_angle(fields[4])) if len(fields) > 4 else 0.
+    else:
+        raise ValueError(f'Region shape {shape} not supported')
+    return parsed
+
+def region_to_mask(region, header):
+    """
+    Rasterise a CASA region string (see parse_region) on the (Dec, RA) pixel grid of an image header.
+    """
+    parsed = parse_region(region)
+    x0,y0  = world_to_pixel(header,parsed['ra'],parsed['dec'])
+    axisnames = header['axisnames']
+    nx,ny  = header['shape'][axisnames.index('right ascension')],header['shape'][axisnames.index('declination')]
+    y,x    = np.ogrid[:ny,:nx]
+    #Offsets in arcsec towards East and North
+    dx = (x-x0)*header['cell'][0]
+    dy = (y-y0)*header['cell'][1]
+    if parsed['shape'] in ('annulus','circle'):
+        r = np.hypot(dx,dy)
+        return (r >= parsed['radii'][0]) & (r <= parsed['radii'][1])
+    pa = np.radians(parsed['pa'])
+    major = dx*np.sin(pa)+dy*np.cos(pa)
+    minor = dx*np.cos(pa)-dy*np.sin(pa)
+    return (major/parsed['axes'][0])**2+(minor/parsed['axes'][1])**2 <= 1.
+
+def mask_bounding_box(mask):
+    """
+    Bottom-left and top-right (x, y) pixel corners of the True pixels of a (Dec, RA) mask.
+    """
+    rows = np.flatnonzero(np.any(mask,axis=1))
+    cols = np.flatnonzero(np.any(mask,axis=0))
+    return (cols[0],rows[0]),(cols[-1],rows[-1])
+
+_region_cache = {}
+region_cache_folder = 'region_cache'
+
+def compile_region(region, header, cache_folder=region_cache_folder):
+    """
+    Compile a CASA region string into a boolean pixel mask cropped to its bounding box.
+    Compiled regions are cached in memory and (if cache_folder is not None) on disk, keyed on the region
+    and on the image direction coordinates, so the same region is rasterised once per coordinate system.
+    Returns:
+    dictionary with 'blc', 'trc' ((x, y) corners of the bounding box) and 'mask' (cropped (Dec, RA) boolean mask).
+    """
+    axisnames = header['axisnames']
+    nx,ny = int(header['shape'][axisnames.index('right ascension')]),int(header['shape'][axisnames.index('declination')])
+    key = (region.strip(),nx,ny,tuple(np.round(header['refval'],12)),tuple(np.round(header['refpix'],6)),tuple(np.round(header['cell'],9)))
+    if key in _region_cache:
+        return _region_cache[key]
+    if cache_folder is not None:
+        import hashlib
+        cache_file = os.path.join(cache_folder,hashlib.sha1(repr(key).encode()).hexdigest()+'.npz')
+        if os.path.isfile(cache_file):
+            cached = np.load(cache_file)
+            shape  = tuple(cached['shape'])
+            compiled = {
+                'blc':tuple(int(i) for i in cached['blc']),'trc':tuple(int(i) for i in cached['trc']),
+                'mask':np.unpackbits(cached['mask'],count=int(np.prod(shape))).reshape(shape).astype(bool),
+            }
+            _region_cache[key] = compiled
+            return compiled
+    mask = region_to_mask(region,header)
+    blc,trc = mask_bounding_box(mask)
+    compiled = {'blc':blc,'trc':trc,'mask':mask[blc[1]:trc[1]+1,blc[0]:trc[0]+1]}
+    _region_cache[key] = compiled
+    if cache_folder is not None:
+        os.makedirs(cache_folder,exist_ok=True)
+        np.savez(cache_file,blc=np.array(blc),trc=np.array(trc),shape=np.array(compiled['mask'].shape),mask=np.packbits(compiled['mask']))
+    return compiled
+
+def _common_box(*compiled_regions):
+    """
+    Union bounding box of compiled regions, and their masks embedded in it.
+    """
+    x0 = min(c['blc'][0] for c in compiled_regions)
+    y0 = min(c['blc'][1] for c in compiled_regions)
+    x1 = max(c['trc'][0] for c in compiled_regions)
+    y1 = max(c['trc'][1] for c in compiled_regions)
+    masks = []
+    for c in compiled_regions:
+        mask = np.zeros((y1-y0+1,x1-x0+1),dtype=bool)
+        mask[c['blc'][1]-y0:c['trc'][1]-y0+1,c['blc'][0]-x0:c['trc'][0]-x0+1] = c['mask']
+        masks.append(mask)
+    return (x0,y0),(x1,y1),masks
+
+def iterate_channel_chunks(imagename, header=None, max_chunk_bytes=512*1024**2, blc=None, trc=None):
+    """
+    Read a cube (CASA image or FITS) channel-chunk by channel-chunk.
+    Parameters:
+    imagename:       image to read
+    header:          output of get_image_header(imagename), read if not given
+    max_chunk_bytes: maximum size of a chunk in memory
+    blc, trc:        optional (x, y) bottom-left and top-right pixel corners to read only a box
+    Yields:
+    (first channel, data) with data of shape (nchan_chunk, ny, nx) and NaN for masked pixels
+    """
+    if header is None:
+        header = get_image_header(imagename)
+    axisnames = header['axisnames']
+    shape     = header['shape']
+    ix = axisnames.index('right ascension')
+    iy = axisnames.index('declination')
+    iz = axisnames.index('frequency') if 'frequency' in axisnames else None
+    nchan = shape[iz] if iz is not None else 1
+    x0,y0 = (0,0) if blc is None else (int(blc[0]),int(blc[1]))
+    x1,y1 = (shape[ix]-1,shape[iy]-1) if trc is None else (int(trc[0]),int(trc[1]))
+    plane_bytes = 4*(x1-x0+1)*(y1-y0+1)
+    nchunk = int(max(1,min(nchan,max_chunk_bytes//plane_bytes)))
+
+    ia.open(imagename)
+    try:
+        for k0 in range(0,nchan,nchunk):
+            k1 = min(k0+nchunk,nchan)-1
+            chunk_blc = [0]*len(shape)
+            chunk_trc = [0]*len(shape)
+            chunk_blc[ix],chunk_trc[ix] = x0,x1
+            chunk_blc[iy],chunk_trc[iy] = y0,y1
+            if iz is not None:
+                chunk_blc[iz],chunk_trc[iz] = k0,k1
+            data  = ia.getchunk(blc=chunk_blc,trc=chunk_trc,dropdeg=False)
+            pmask = ia.getchunk(blc=chunk_blc,trc=chunk_trc,dropdeg=False,getmask=True)
+            data  = np.where(pmask,data,np.nan).astype(np.float32)
+            #Reorder to (chan, Dec, RA), dropping the other (degenerate) axes
+            order = [iz,iy,ix] if iz is not None else [iy,ix]
+            data  = np.transpose(data,order+[i for i in range(len(shape)) if i not in order])
+            data  = data.reshape(data.shape[:len(order)])
+            if iz is None:
+                data = data[None,:,:]
+            yield k0,data
+    finally:
+        ia.close()
+
+def _write_image_like(template, outfile, data, unit, beam=None, export_fits=True):
+    """
+    Write a 2D (Dec, RA) array as a CASA image with the coordinate system of template (and as FITS).
+    """
+    ia.open(template)
+    csys  = ia.coordsys()
+    shape = ia.shape()
+    ia.close()
+    axisnames = [name.lower() for name in csys.names()]
+    ix = axisnames.index('right ascension')
+    iy = axisnames.index('declination')
+    pixels = np.zeros([shape[ix] if i == ix else shape[iy] if i == iy else 1 for i in range(len(shape))],dtype=np.float32)
+    index  = [0]*len(shape)
+    index[ix],index[iy] = slice(None),slice(None)
+    pixels[tuple(index)] = data.T if ix < iy else data
+    casa_image = outfile[:-5] if outfile.endswith('.fits') else outfile
+    os.system(f'rm -rf {casa_image}')
+    ia.fromarray(outfile=casa_image,pixels=pixels,csys=csys.torecord(),overwrite=True)
+    ia.setbrightnessunit(unit)
+    if beam is not None:
+        ia.setrestoringbeam(major=f'{beam[0]}arcsec',minor=f'{beam[1]}arcsec',pa=f'{beam[2]}deg')
+    ia.close()
+    csys.done()
+    if export_fits:
+        exportfits(imagename=casa_image,fitsimage=casa_image+'.fits',overwrite=True)
+        os.system(f'rm -rf {casa_image}')
+
+default_moment_products = {
+    'M0':          {'moment':0,'clip':3.,  'chans':None},
+    'M0_noclip':   {'moment':0,'clip':None,'chans':None},
+    'M8':          {'moment':8,'clip':None,'chans':None},
+}
+
+def bestchans_moment_products(bestchans, suffix='bestchans'):
+    """
+    Moment products restricted to the channels with the line emission (M0 without clipping and M8), to add to
+    default_moment_products, e.g. {**default_moment_products,**bestchans_moment_products([3,4,5,6,7])}.
+    """
+    return {
+        f'M0_{suffix}': {'moment':0,'clip':None,'chans':list(bestchans)},
+        f'M8_{suffix}': {'moment':8,'clip':None,'chans':list(bestchans)},
+    }
+
+def compute_moments(imagename, products=None, rms=None, noise_annulus=None, output_folder=None, max_chunk_bytes=512*1024**2, export_fits=True):
+    """
+    Compute several moment maps of a cube in a single, chunked pass over the channels.
+    Parameters:
+    imagename:     cube (CASA image or FITS)
+    products:      dictionary {name: {'moment':0 or 8, 'clip':sigma clip or None, 'chans':list of channels or None}},
+                   default is default_moment_products. e.g. add 'M0_bestchans':{'moment':0,'clip':None,'chans':[...]}
+    rms:           per-channel rms (Jy/beam, scalar or array). If None, it is measured in noise_annulus in the same pass
+    noise_annulus: CASA region string (e.g. noise_annulus) or (ra, dec, r_in, r_out) with r_in, r_out in arcsec
+    output_folder: if given, save the maps as imagename+'_'+name+'.fits' in this folder, or in the folder of their
+                   moment with a dictionary {moment: folder}
+    Returns:
+    dictionary with the map of every product (results[name]) and its noise propagated from the per-channel rms:
+    for M0 products results[name+'_rms'] is sqrt(sum_k (rms_k*dv_k)**2) over the selected channels (sqrt(N)*rms*dv
+    for a uniform rms), the noise of a pixel where all of them enter the sum, and results['d'+name] is the per-pixel
+    noise map (Jy/beam m/s) over the channels that enter the sum of each pixel (smaller where channels are clipped,
+    zero where all of them are). The clip keeps the channels with |I| >= clip*rms, so that the noise stays symmetric.
+    For M8 products results[name+'_rms'] is the quadratic mean of the rms of the selected channels.
+    Also 'rms_chan' (per-channel rms, Jy/beam) and 'velocities' (m/s).
+    """
+    if products is None:
+        products = default_moment_products
+    header = get_image_header(imagename)
+    velocities = c_light*(1.-header['frequencies']/header['restfreq'])
+    nchan = len(velocities)
+    dv    = np.abs(np.gradient(velocities)) if nchan > 1 else np.array([1.])
+    ny,nx = header['shape'][header['axisnames'].index('declination')],header['shape'][header['axisnames'].index('right ascension')]
+
+    noise_mask = None
+    if isinstance(noise_annulus,str):
+        compiled   = compile_region(noise_annulus,header)
+        noise_mask = np.zeros((ny,nx),dtype=bool)
+        noise_mask[compiled['blc'][1]:compiled['trc'][1]+1,compiled['blc'][0]:compiled['trc'][0]+1] = compiled['mask']
+    elif noise_annulus is not None:
+        ra,dec,r_in,r_out = noise_annulus
+        noise_mask = _annulus_mask(header,ra,dec,r_in,r_out)
+    assert rms is not None or noise_mask is not None, 'provide either rms or noise_annulus'
+    rms_chan = np.full(nchan,np.nan) if rms is None else np.broadcast_to(np.asarray(rms,dtype=float),(nchan,)).copy()
+
+    sums   = {name:np.zeros((ny,nx)) for name,p in products.items() if p['moment'] == 0}
+    vars_  = {name:np.zeros((ny,nx)) for name,p in products.items() if p['moment'] == 0}
+    peaks  = {name:np.full((ny,nx),-np.inf) for name,p in products.items() if p['moment'] == 8}
+    selections = {name:(np.ones(nchan,dtype=bool) if p['chans'] is None else np.isin(np.arange(nchan),p['chans'])) for name,p in products.items()}
+
+    for k0,data in iterate_channel_chunks(imagename,header=header,max_chunk_bytes=max_chunk_bytes):
+        k = np.arange(k0,k0+data.shape[0])
+        if rms is None:
+            rms_chan[k] = np.sqrt(np.nanmean(data[:,noise_mask]**2,axis=1))
+        data = np.nan_to_num(data)
+        for name,p in products.items():
+            selected = selections[name][k]
+            if not np.any(selected):
+                continue
+            chunk = data[selected]
+            if p['moment'] == 8:
+                peaks[name] = np.maximum(peaks[name],chunk.max(axis=0))
+                continue
+            weights = dv[k][selected][:,None,None]*np.ones_like(chunk)
+            if p['clip'] is not None:
+                weights *= (np.abs(chunk) >= p['clip']*rms_chan[k][selected][:,None,None])
+            sums[name]  += np.sum(weights*chunk,axis=0)
+            vars_[name] += np.sum(weights**2*(rms_chan[k][selected]**2)[:,None,None],axis=0)
+
+    results = {'rms_chan':rms_chan,'velocities':velocities}
+    for name,p in products.items():
+        selected = selections[name]
+        if p['moment'] == 0:
+            results[name] = sums[name]
+            results['d'+name] = np.sqrt(vars_[name])
+            results[name+'_rms'] = float(np.sqrt(np.sum((rms_chan[selected]*dv[selected])**2)))
+            unit = 'Jy/beam.m/s'
+        else:
+            results[name] = peaks[name]
+            results[name+'_rms'] = float(np.sqrt(np.mean(rms_chan[selected]**2)))
+            unit = 'Jy/beam'
+        if output_folder is not None:
+            folder = output_folder[p['moment']] if isinstance(output_folder,dict) else output_folder
+            os.makedirs(folder,exist_ok=True)
+            outfile = os.path.join(folder,os.path.basename(imagename.rstrip('/'))+'_'+name+'.fits')
+            _write_image_like(imagename,outfile,results[name],unit,beam=header['beam'],export_fits=export_fits)
+        print(f'#{name} rms: %.2e {unit}' %results[name+'_rms'])
+    return results
+
+def noise_spectrum(imagename, noise_region, disk_region=None, snr_linefree=5., max_chunk_bytes=512*1024**2):
+    """
+    Per-channel noise statistics of a cube in one chunked, vectorised pass, in place of imstat loops over chans.
+    The region is rasterised once and only its bounding box is read.
+    Parameters:
+    imagename:    cube (CASA image or FITS)
+    noise_region: CASA region string of the noise region, e.g. noise_annulus
+    disk_region:  CASA region string with the line emission, default is the inner circle of the annulus
+    snr_linefree: channels whose peak in disk_region is below snr_linefree*rms are suggested as line-free
+    Returns:
+    dictionary with per-channel 'rms', 'mean', 'mad' (median absolute deviation, scaled to a Gaussian sigma),
+    'peak' (in the noise region) and 'disk_peak' (Jy/beam), and 'linefree_chans'.
+    """
+    header = get_image_header(imagename)
+    if disk_region is None:
+        parsed = parse_region(noise_region)
+        disk_region = f"circle[[{parsed['ra']}, {parsed['dec']}], {parsed['radii'][0]}arcsec]"
+    (x0,y0),(x1,y1),(noise_mask,disk_mask) = _common_box(compile_region(noise_region,header),compile_region(disk_region,header))
+
+    stats = {key:[] for key in ('rms','mean','mad','peak','disk_peak')}
+    for k0,data in iterate_channel_chunks(imagename,header=header,max_chunk_bytes=max_chunk_bytes,blc=(x0,y0),trc=(x1,y1)):
+        noise = data[:,noise_mask]
+        stats['rms'].append(np.sqrt(np.nanmean(noise**2,axis=1)))
+        stats['mean'].append(np.nanmean(noise,axis=1))
+        stats['mad'].append(1.4826*np.nanmedian(np.abs(noise-np.nanmedian(noise,axis=1)[:,None]),axis=1))
+        stats['peak'].append(np.nanmax(noise,axis=1))
+        stats['disk_peak'].append(np.nanmax(data[:,disk_mask],axis=1))
+    stats = {key:np.concatenate(value) for key,value in stats.items()}
+    stats['linefree_chans'] = np.flatnonzero(stats['disk_peak'] < snr_linefree*stats['rms'])
+    return stats
+
+def region_statistics(imagename, region, header=None, max_chunk_bytes=512*1024**2):
+    """
+    imstat-like statistics inside a region, reading only the region's bounding box.
+    Returns:
+    dictionary with 'rms', 'mean', 'max', 'min', 'npts' and 'flux' (Jy, or Jy km/s for cubes, as in imstat).
+    """
+    if header is None:
+        header = get_image_header(imagename)
+    compiled = compile_region(region,header)
+    mask = compiled['mask']
+    velocities = c_light*(1.-header['frequencies']/header['restfreq']) if len(header['frequencies']) > 1 else np.zeros(1)
+    dv = np.abs(np.gradient(velocities))/1e3 if len(velocities) > 1 else np.array([1.]) #km/s
+    bmaj,bmin,bpa = header['beam'] if header['beam'] is not None else (np.nan,np.nan,np.nan)
+    beam_area = np.pi*bmaj*bmin/(4.*np.log(2.))/abs(header['cell'][0]*header['cell'][1]) #pixels
+
+    total,sumsq,flux,npts,vmax,vmin = 0.,0.,0.,0,-np.inf,np.inf
+    for k0,data in iterate_channel_chunks(imagename,header=header,max_chunk_bytes=max_chunk_bytes,blc=compiled['blc'],trc=compiled['trc']):
+        values = data[:,mask]
+        total += np.nansum(values)
+        sumsq += np.nansum(values**2)
+        flux  += np.sum(np.nansum(values,axis=1)*dv[k0:k0+data.shape[0]])/beam_area
+        npts  += int(np.sum(np.isfinite(values)))
+        vmax   = max(vmax,np.nanmax(values))
+        vmin   = min(vmin,np.nanmin(values))
+    return {'rms':np.sqrt(sumsq/npts),'mean':total/npts,'max':vmax,'min':vmin,'npts':npts,'flux':flux}
+
+def estimate_SNR_cached(imagename, disk_mask, noise_mask, max_chunk_bytes=512*1024**2):
+    """
+    estimate_SNR using compiled (cached) regions and reading only the regions' bounding box, for continuum images and cubes.
+    Prints the beam, the flux inside disk_mask (integrated over velocity for cubes, as imstat does), the peak intensity,
+    the rms in noise_mask (over all channels) and the peak SNR, in the format of estimate_SNR.
+    """
+    header = get_image_header(imagename)
+    (x0,y0),(x1,y1),(disk,noise) = _common_box(compile_region(disk_mask,header),compile_region(noise_mask,header))
+    bmaj,bmin,bpa = header['beam']
+    beam_area = np.pi*bmaj*bmin/(4.*np.log(2.))/abs(header['cell'][0]*header['cell'][1]) #pixels
+    is_cube = len(header['frequencies']) > 1
+    if is_cube:
+        velocities = c_light*(1.-header['frequencies']/header['restfreq'])
+        dv = np.abs(np.gradient(velocities))/1e3 #km/s
+    else:
+        dv = np.array([1.])
+
+    flux,peak,sumsq,npix = 0.,-np.inf,0.,0
+    for k0,data in iterate_channel_chunks(imagename,header=header,max_chunk_bytes=max_chunk_bytes,blc=(x0,y0),trc=(x1,y1)):
+        flux  += np.sum(np.nansum(data[:,disk],axis=1)*dv[k0:k0+data.shape[0]])/beam_area
+        peak   = max(peak,np.nanmax(data[:,disk]))
+        sumsq += np.nansum(data[:,noise]**2)
+        npix  += np.sum(np.isfinite(data[:,noise]))
+    rms = np.sqrt(sumsq/npix)
+
+    print('#%s' %imagename)
+    print('#Beam %.3f arcsec x %.3f arcsec (%.2f deg)' %(bmaj,bmin,bpa))
+    print('#Flux inside disk mask: %.2f mJy%s' %(flux*1000.,' km/s' if is_cube else ''))
+    print('#Peak intensity of source: %.2f mJy/beam' %(peak*1000.))
+    print('#rms: %.2e mJy/beam' %(rms*1000.))
+    print('#Peak SNR: %.2f' %(peak/rms))
+    return {'beam':header['beam'],'flux':flux,'peak':peak,'rms':rms,'snr':peak/rms}
+
+def _box_around(header, size, center=None):
+    """
+    (x, y) bottom-left and top-right pixel corners of a size x size arcsec box around center
+    ((ra, dec), default the image centre), clipped to the image.
+    """
+    axisnames = header['axisnames']
+    nx,ny = int(header['shape'][axisnames.index('right ascension')]),int(header['shape'][axisnames.index('declination')])
+    x0,y0 = (nx//2,ny//2) if center is None else world_to_pixel(header,*center)
+    if size is None:
+        return (0,0),(nx-1,ny-1),(x0,y0)
+    half_x = 0.5*size/abs(header['cell'][0])
+    half_y = 0.5*size/abs(header['cell'][1])
+    blc = (max(0,int(np.floor(x0-half_x))),max(0,int(np.floor(y0-half_y))))
+    trc = (min(nx-1,int(np.ceil(x0+half_x))),min(ny-1,int(np.ceil(y0+half_y))))
+    return blc,trc,(x0,y0)
+
+def image_ratio(ref_image, image, threshold, size=None, center=None, nbins=20, outfile=None, max_chunk_bytes=64*1024**2):
+    """
+    Ratio image/ref_image where ref_image > threshold (0 elsewhere), as immath(expr='iif(IM0 > threshold, IM1/IM0, 0)'),
+    reading both images in row tiles restricted to a box of size arcsec around center (the plotted region).
+    Parameters:
+    ref_image, image: continuum images with the same pixel grid
+    threshold:        Jy/beam, e.g. 3*rms of ref_image
+    size:             side of the box in arcsec (e.g. the plot size), default is the full image
+    center:           (ra, dec) of the box centre, default is the image centre
+    nbins:            number of radial bins of the ratio profile
+    outfile:          if given, write the ratio in the box as a CASA image (e.g. for generate_image_png)
+    Returns:
+    dictionary with 'ratio' (2D (Dec, RA) array in the box, NaN below threshold), 'blc', 'trc', 'median', 'spread'
+    (MAD scaled to a Gaussian sigma), 'npix', and 'radius' (arcsec), 'ratio_vs_radius', 'spread_vs_radius' per radial bin.
+    """
+    header = get_image_header(ref_image)
+    assert np.all(get_image_header(image)['shape'] == header['shape']), 'the two images must have the same pixel grid'
+    (x0,y0),(x1,y1),(xc,yc) = _box_around(header,size,center)
+    row_bytes = 4*(x1-x0+1)
+    rows_per_tile = int(max(1,max_chunk_bytes//row_bytes))
+
+    ratio = np.full((y1-y0+1,x1-x0+1),np.nan,dtype=np.float32)
+    for t0 in range(y0,y1+1,rows_per_tile):
+        t1 = min(t0+rows_per_tile,y1+1)-1
+        (_,ref),   = iterate_channel_chunks(ref_image,header=header,blc=(x0,t0),trc=(x1,t1))
+        (_,other), = iterate_channel_chunks(image,header=header,blc=(x0,t0),trc=(x1,t1))
+        ref,other = ref[0],other[0]
+        above = ref > threshold
+        ratio[t0-y0:t1-y0+1][above] = other[above]/ref[above]
+
+    valid  = np.isfinite(ratio)
+    values = ratio[valid]
+    y,x    = np.mgrid[y0:y1+1,x0:x1+1]
+    radius = np.hypot((x-xc)*header['cell'][0],(y-yc)*header['cell'][1])[valid]
+    edges  = np.linspace(0.,radius.max() if len(radius) > 0 else 1.,nbins+1)
+    ibin   = np.clip(np.digitize(radius,edges)-1,0,nbins-1)
+    ratio_vs_radius  = np.full(nbins,np.nan)
+    spread_vs_radius = np.full(nbins,np.nan)
+    for i in np.unique(ibin):
+        in_bin = values[ibin == i]
+        ratio_vs_radius[i]  = np.median(in_bin)
+        spread_vs_radius[i] = 1.4826*np.median(np.abs(in_bin-ratio_vs_radius[i]))
+    median = np.median(values) if len(values) > 0 else np.nan
+    spread = 1.4826*np.median(np.abs(values-median)) if len(values) > 0 else np.nan
+
+    if outfile is not None:
+        os.system(f'rm -rf {outfile}')
+        ia.open(ref_image)
+        shape = ia.shape()
+        axisnames = header['axisnames']
+        ix,iy = axisnames.index('right ascension'),axisnames.index('declination')
+        box_blc,box_trc = [0]*len(shape),[s-1 for s in shape]
+        box_blc[ix],box_trc[ix] = x0,x1
+        box_blc[iy],box_trc[iy] = y0,y1
+        subimage = ia.subimage(outfile=outfile,region=rg.box(blc=box_blc,trc=box_trc),overwrite=True)
+        ia.close()
+        pixels = np.zeros(subimage.shape(),dtype=np.float32)
+        index  = [0]*len(shape)
+        index[ix],index[iy] = slice(None),slice(None)
+        pixels[tuple(index)] = np.nan_to_num(ratio).T if ix < iy else np.nan_to_num(ratio)
+        subimage.putchunk(pixels)
+        subimage.setbrightnessunit('')
+        subimage.done()
+
+    print(f'#{os.path.basename(image)}/{os.path.basename(ref_image)}: median ratio %.3f, spread %.3f (%d pixels above threshold)' %(median,spread,len(values)))
+    return {
+        'ratio':ratio,'blc':(x0,y0),'trc':(x1,y1),'median':median,'spread':spread,'npix':len(values),
+        'radius':0.5*(edges[1:]+edges[:-1]),'ratio_vs_radius':ratio_vs_radius,'spread_vs_radius':spread_vs_radius,
+    }
+
+image_pyramid_folder = 'image_pyramids'
+png_target_pixels = 800 #pixels across the smallest panel of the pngs
+png_nprocesses    = 8
+_png_pool    = None
+_png_futures = []
+
+def _image_stamp(imagename):
+    """
+    Modification time of an image (latest among the files of a CASA image directory).
+    """
+    if os.path.isdir(imagename):
+        return max([os.path.getmtime(imagename)]+[os.path.getmtime(os.path.join(imagename,f)) for f in os.listdir(imagename)])
+    return os.path.getmtime(imagename)
+
+def image_pyramid_level(imagename, level, size, header=None, cache_folder=image_pyramid_folder):
+    """
+    Level of the multi-resolution pyramid of a continuum image over the plotted box only: the size x size arcsec box
+    around the image centre, block-averaged over 2**level x 2**level pixels, as a CASA image with the coordinate system
+    of the box. Levels are built on first access and cached under the same relative name as the image (so that
+    generate_image_png names the png as for the image itself); the levels of older versions of the image are removed.
+    Returns:
+    (cache directory of the level, relative name of the image in it)
+    """
+    import hashlib
+    stamp_key = hashlib.sha1(str(_image_stamp(imagename)).encode()).hexdigest()[:16]
+    image_dir = os.path.join(cache_folder,hashlib.sha1(os.path.abspath(imagename.rstrip('/')).encode()).hexdigest()[:16])
+    level_dir = os.path.join(image_dir,f'{stamp_key}_{size}arcsec_level{level}')
+    relname = os.path.normpath(imagename).lstrip(os.sep)
+    if relname.startswith('..'):
+        relname = os.path.basename(relname)
+    outfile = os.path.join(level_dir,relname)
+    if os.path.isdir(outfile):
+        return level_dir,relname
+    if os.path.isdir(image_dir):
+        for old_level in os.listdir(image_dir):
+            if not old_level.startswith(stamp_key):
+                os.system(f'rm -rf {os.path.join(image_dir,old_level)}')
+    if header is None:
+        header = get_image_header(imagename)
+    (x0,y0),(x1,y1),_ = _box_around(header,size)
+    axisnames = header['axisnames']
+    ix,iy = axisnames.index('right ascension'),axisnames.index('declination')
+    os.makedirs(os.path.dirname(outfile),exist_ok=True)
+    os.system(f'rm -rf {outfile}')
+    ia.open(imagename)
+    shape = ia.shape()
+    box_blc,box_trc = [0]*len(shape),[s-1 for s in shape]
+    box_blc[ix],box_trc[ix] = x0,x1
+    box_blc[iy],box_trc[iy] = y0,y1
+    if level == 0:
+        subimage = ia.subimage(outfile=outfile,region=rg.box(blc=box_blc,trc=box_trc),overwrite=True)
+    else:
+        subimage = ia.subimage(region=rg.box(blc=box_blc,trc=box_trc))
+        binned = subimage.rebin(outfile=outfile,bin=[2**level if i in (ix,iy) else 1 for i in range(len(shape))],overwrite=True)
+        binned.done()
+    subimage.done()
+    ia.close()
+    return level_dir,relname
+
+def _render_png(level_dir, relname, plot_sizes, color_scale_limits, save_folder, image_units):
+    """
+    Draw the png of a pyramid level with generate_image_png (run in the png process pool). The level has the same
+    relative name as the image inside level_dir, so the figure and its file name are those of the image itself.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    cwd = os.getcwd()
+    os.chdir(level_dir)
+    try:
+        generate_image_png(
+            relname,plot_sizes=plot_sizes,color_scale_limits=color_scale_limits,
+            save_folder=save_folder,image_units=image_units
+        )
+    finally:
+        os.chdir(cwd)
+    return relname
+
+def _collect_png_renders(block=False):
+    """
+    Re-raise errors of finished png renders (all pending renders if block=True).
+    """
+    global _png_futures
+    pending = []
+    for future in _png_futures:
+        if block or future.done():
+            future.result()
+        else:
+            pending.append(future)
+    _png_futures = pending
+
+def wait_png_renders():
+    """
+    Wait for all png renders submitted by render_image_png to finish (and re-raise their errors).
+    """
+    _collect_png_renders(block=True)
+
+def render_image_png(image, plot_sizes, color_scale_limits, save_folder='', image_units='mJy/beam', parallel=True):
+    """
+    generate_image_png on the plotted box of the image only: the largest panel is cropped from the image and
+    block-averaged, as long as the smallest panel keeps png_target_pixels across, into a cached pyramid level
+    (image_pyramid_level) before generate_image_png reads it, so the figures are drawn by generate_image_png itself.
+    The drawing is done in a pool of png_nprocesses processes: call wait_png_renders() before the end of the script.
+    """
+    global _png_pool
+    _collect_png_renders()
+    header = get_image_header(image)
+    npix  = min(plot_sizes)/abs(header['cell'][0])
+    level = int(max(0,np.floor(np.log2(npix/png_target_pixels))))
+    level_dir,relname = image_pyramid_level(image,level,max(plot_sizes),header=header)
+    save_folder = os.path.abspath(save_folder)+(os.sep if save_folder in ('','.') or save_folder.endswith('/') else '')
+    args = (level_dir,relname,plot_sizes,color_scale_limits,save_folder,image_units)
+    if not parallel:
+        return _render_png(*args)
+    if _png_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _png_pool = ProcessPoolExecutor(max_workers=png_nprocesses,mp_context=multiprocessing.get_context('fork'))
+    _png_futures.append(_png_pool.submit(_render_png,*args))
+    return relname
+
+def _sample_on_grid(imagename, header, grid_header):
+    """
+    Bilinear interpolation of a continuum image on the (Dec, RA) pixel grid described by grid_header
+    (same keys as get_image_header, small-field approximation), reading only the box covering the grid.
+    """
+    ny_grid,nx_grid = int(grid_header['shape'][1]),int(grid_header['shape'][0])
+    xc,yc = world_to_pixel(header,*grid_header['refval'])
+    #Offsets (arcsec towards East and North) of the grid pixels, and their pixel coordinates in the image
+    east  = (np.arange(nx_grid)-grid_header['refpix'][0])*grid_header['cell'][0]
+    north = (np.arange(ny_grid)-grid_header['refpix'][1])*grid_header['cell'][1]
+    x = xc+east/header['cell'][0]
+    y = yc+north/header['cell'][1]
+    axisnames = header['axisnames']
+    nx,ny = int(header['shape'][axisnames.index('right ascension')]),int(header['shape'][axisnames.index('declination')])
+    x0,x1 = max(0,int(np.floor(x.min()))),min(nx-1,int(np.floor(x.max()))+1)
+    y0,y1 = max(0,int(np.floor(y.min()))),min(ny-1,int(np.floor(y.max()))+1)
+    (_,box), = iterate_channel_chunks(imagename,header=header,blc=(x0,y0),trc=(x1,y1))
+    box = np.nan_to_num(box[0])
+    x = np.clip(x-x0,0,x1-x0)
+    y = np.clip(y-y0,0,y1-y0)
+    ix,iy = np.minimum(x.astype(int),x1-x0-1),np.minimum(y.astype(int),y1-y0-1)
+    fx,fy = (x-ix)[None,:],(y-iy)[:,None]
+    return (
+        box[np.ix_(iy,ix)]*(1-fx)*(1-fy)+box[np.ix_(iy,ix+1)]*fx*(1-fy)
+        +box[np.ix_(iy+1,ix)]*(1-fx)*fy+box[np.ix_(iy+1,ix+1)]*fx*fy
+    )
+
+def _parabolic_peak(values):
+    """
+    Sub-pixel position of the maximum of values[1] from a parabola through three samples.
+    """
+    denominator = values[0]-2.*values[1]+values[2]
+    return 0.5*(values[0]-values[2])/denominator if denominator != 0 else 0.
+
+def image_alignment_offsets(images, region, cell=None, noise_region=None, applied_offsets=None, reference=0):
+    """
+    Sub-pixel offsets between all pairs of continuum images by FFT cross-correlation of their masked cutouts,
+    in place of re-imaging the EBs on a common grid and comparing fit_gaussian peaks by hand.
+    The images can have different cell sizes: the cutouts are resampled on a common grid around the region centre.
+    Parameters:
+    images:          list of continuum images (e.g. the *_initcont_selfcal_image.image of every EB)
+    region:          CASA ellipse/circle region string with the emission to correlate (e.g. the disk mask)
+    cell:            cell of the common grid in arcsec, default is the coarsest cell of the images
+    noise_region:    region for the rms of each image, default is the 4-6 arcsec annulus around the region centre
+    applied_offsets: optional list of the [dRA, dDec] shifts (arcsec) applied to each image's EB by the alignment,
+                     subtracted from the measured offsets to predict the residual misalignment after the shift
+    reference:       index of the image the summary is printed against
+    Returns:
+    dictionary with 'offsets' and 'errors' (n x n x 2 arrays, arcsec, [dRA towards East, dDec]) of image j with
+    respect to image i, and 'cell' (arcsec). Errors are 0.5*beam/SNR of both images added in quadrature.
+    """
+    headers = [get_image_header(image) for image in images]
+    if cell is None:
+        cell = max(abs(header['cell'][0]) for header in headers)
+    parsed = parse_region(region)
+    extent = max(parsed['axes']) if 'axes' in parsed else parsed['radii'][1]
+    npix   = 2*int(np.ceil(1.2*extent/cell))+1
+    grid_header = {
+        'shape':np.array([npix,npix]),'axisnames':['right ascension','declination'],
+        'cell':np.array([-cell,cell]),'refpix':np.array([(npix-1)/2.]*2),
+        'refval':np.array([_parse_angle(parsed['ra'],hours=True),_parse_angle(parsed['dec'])]),
+    }
+    mask = region_to_mask(region,grid_header)
+    if noise_region is None:
+        noise_region = f"annulus[[{parsed['ra']}, {parsed['dec']}],['4.arcsec', '6.arcsec']]"
+
+    spectra,sigmas = [],[]
+    for image,header in zip(images,headers):
+        cutout = _sample_on_grid(image,header,grid_header)*mask
+        #Zero-pad to avoid wrapping of the correlation
+        spectra.append(np.fft.rfft2(cutout,s=(2*npix,2*npix)))
+        rms  = region_statistics(image,noise_region,header=header)['rms']
+        beam = np.sqrt(header['beam'][0]*header['beam'][1])
+        sigmas.append(0.5*beam*rms/cutout.max())
+
+    n = len(images)
+    offsets = np.zeros((n,n,2))
+    errors  = np.zeros((n,n,2))
+    for i in range(n):
+        for j in range(n):
+            if i == j:
+                continue
+            correlation = np.fft.fftshift(np.fft.irfft2(np.conj(spectra[i])*spectra[j],s=(2*npix,2*npix)))
+            py,px = np.unravel_index(np.argmax(correlation),correlation.shape)
+            dx = px-npix+_parabolic_peak(correlation[py,px-1:px+2])
+            dy = py-npix+_parabolic_peak(correlation[py-1:py+2,px])
+            offsets[i,j] = dx*grid_header['cell'][0],dy*grid_header['cell'][1]
+            if applied_offsets is not None:
+                offsets[i,j] -= np.asarray(applied_offsets[j])-np.asarray(applied_offsets[i])
+            errors[i,j] = np.hypot(sigmas[i],sigmas[j])
+
+    print(f'#Offsets with respect to {os.path.basename(images[reference])} (common cell {cell:.4f} arcsec):')
+    for j,image in enumerate(images):
+        dra,ddec = 1e3*offsets[reference,j]
+        era,edec = 1e3*errors[reference,j]
+        print(f'#{os.path.basename(image)}: dRA = {dra:.2f} +- {era:.2f} mas, dDec = {ddec:.2f} +- {edec:.2f} mas')
+    print(f'#Largest pairwise offset: {np.max(np.hypot(offsets[...,0],offsets[...,1]))/cell:.2f} common-grid pixels')
+    return {'offsets':offsets,'errors':errors,'cell':cell}
@@ -0,0 +1,547 @@
+"""
+Imaging helpers used on top of reduction_utils_py3_mpi.py (tclean_wrapper, estimate_SNR, ...).
+Load with execfile() after reduction_utils, so that the CASA tasks and tools are in the namespace.
+"""
+
+import os
+import json
+import inspect
+import numpy as np
+
+#Default adaptive deconvolution schedule. Each stage is used while the peak residual is above
+#'above' times the final threshold: large loop gain and cycleniter far from the threshold,
+#the user-provided (conservative) gain and cycleniter for the last stage.
+default_gain_schedule = [
+    {'above':30., 'gain':0.3, 'cycleniter':2000},
+    {'above':10., 'gain':0.1, 'cycleniter':1000},
+    {'above': 3., 'gain':0.05,'cycleniter':500 },
+]
+
+#tclean settings fixed in the body of tclean_wrapper (not keywords of tclean_wrapper)
+tclean_wrapper_settings = {'specmode':'mfs','deconvolver':'multiscale','weighting':'briggs'}
+
+def _tclean_kwargs_from_wrapper(vis, imagename, threshold, gain, cycleniter, **kwargs):
+    """
+    Translate tclean_wrapper keywords into tclean keywords, with the defaults read from the signature of
+    tclean_wrapper (cellsize is renamed cell, defaults of keywords that tclean does not take are dropped).
+    """
+    defaults = {
+        name:parameter.default for name,parameter in inspect.signature(tclean_wrapper).parameters.items()
+        if parameter.default is not inspect.Parameter.empty
+    }
+    for wrapper_kwargs in (defaults,kwargs):
+        if 'cellsize' in wrapper_kwargs:
+            wrapper_kwargs['cell'] = wrapper_kwargs.pop('cellsize')
+    tclean_parameters = inspect.signature(tclean).parameters
+    tclean_kwargs = dict(tclean_wrapper_settings)
+    tclean_kwargs.update({name:value for name,value in defaults.items() if name in tclean_parameters})
+    tclean_kwargs.update(kwargs)
+    tclean_kwargs.update({'vis':vis,'imagename':imagename,'threshold':threshold,'gain':gain,'cycleniter':cycleniter})
+    return tclean_kwargs
+
+def _tclean_summary_trajectory(summary):
+    """
+    Extract the residual trajectory from the dictionary returned by tclean.
+    Returns a list of [iterations done, peak residual (Jy/beam), model flux (Jy)], one entry per minor cycle set
+    (i.e., per major cycle). Works with both the array (CASA<=6.5) and the dictionary (CASA>=6.6) summaryminor.
+    """
+    if not isinstance(summary,dict) or 'summaryminor' not in summary:
+        return []
+    summaryminor = summary['summaryminor']
+    if isinstance(summaryminor,dict):
+        #{field:{chan:{pol:{'iterDone':[...],'peakRes':[...],'modelFlux':[...]}}}}, mfs has a single chan/pol
+        while isinstance(summaryminor,dict) and 'peakRes' not in summaryminor:
+            summaryminor = summaryminor[sorted(summaryminor.keys())[0]]
+        iterdone = np.cumsum(summaryminor['iterDone'])
+        return [[int(i),float(p),float(f)] for i,p,f in zip(iterdone,summaryminor['peakRes'],summaryminor['modelFlux'])]
+    summaryminor = np.atleast_2d(summaryminor)
+    if summaryminor.shape[0] < 3:
+        return []
+    return [[int(i),float(p),float(f)] for i,p,f in zip(summaryminor[0],summaryminor[1],summaryminor[2])]
+
+def _threshold_to_Jy(threshold):
+    """
+    Convert a tclean threshold string (e.g. '0.0315mJy') or a float (Jy) to Jy.
+    """
+    if isinstance(threshold,str):
+        for unit,factor in (('uJy',1e-6),('mJy',1e-3),('Jy',1.)):
+            if threshold.endswith(unit):
+                return float(threshold[:-len(unit)])*factor
+        return float(threshold)
+    return float(threshold)
+
+def tclean_wrapper_adaptive(vis, imagename, threshold, gain=0.02, cycleniter=300, gain_schedule=None, savemodel='none', **kwargs):
+    """
+    Run tclean_wrapper with an adaptive loop gain and cycleniter.
+    Deconvolution starts with the first (aggressive) stage of gain_schedule and continues with restart=True
+    through less aggressive stages as the peak residual approaches threshold. The last stage always uses
+    gain and cycleniter down to threshold, so the final image is cleaned with the same parameters as a
+    fixed-gain tclean_wrapper call.
+    Parameters:
+    vis, imagename: as in tclean_wrapper
+    threshold:      final cleaning threshold (e.g. '0.0315mJy')
+    gain:           loop gain for the last stage
+    cycleniter:     cycleniter for the last stage
+    gain_schedule:  list of {'above','gain','cycleniter'} dictionaries, sorted by decreasing 'above'
+                    (a stage stops when the peak residual is below above*threshold), default is default_gain_schedule
+    savemodel:      as in tclean_wrapper, the model column is saved only at the end
+    kwargs:         all other tclean_wrapper keywords (cellsize, imsize, scales, robust, mask, ...)
+    Returns:
+    the residual trajectory, also saved as imagename+'.schedule.json'. Each entry has the stage parameters
+    and a list of [cumulative iterations, peak residual (Jy/beam), model flux (Jy)] per major cycle.
+    """
+    if gain_schedule is None:
+        gain_schedule = default_gain_schedule
+    final_threshold = _threshold_to_Jy(threshold)
+
+    #Skip stages that would be less aggressive than the final one
+    stages = [s for s in gain_schedule if s['gain'] > gain and s['above'] > 1.]
+    stages.append({'above':1.,'gain':gain,'cycleniter':cycleniter})
+
+    for ext in ['.image','.image.pbcor','.mask','.model','.pb','.psf','.residual','.sumwt','.schedule.json']:
+        os.system('rm -rf '+imagename+ext)
+
+    trajectory = []
+    iterdone   = 0
+    niter      = kwargs.pop('niter',50000)
+    kwargs.pop('restart',None)
+    for i,stage in enumerate(stages):
+        stage_threshold = stage['above']*final_threshold
+        tclean_kwargs = _tclean_kwargs_from_wrapper(
+            vis=vis,imagename=imagename,threshold=f'{stage_threshold:.6e}Jy',
+            gain=stage['gain'],cycleniter=stage['cycleniter'],niter=max(niter-iterdone,0),**kwargs
+        )
+        if i > 0:
+            #Continue from the model and residual of the previous stage
+            tclean_kwargs.update({'restart':True,'calcpsf':False,'calcres':False})
+        summary = tclean(**tclean_kwargs)
+        stage_trajectory = _tclean_summary_trajectory(summary)
+        if isinstance(summary,dict) and 'iterdone' in summary:
+            stage_iterdone = int(summary['iterdone'])
+        elif len(stage_trajectory) > 0:
+            stage_iterdone = stage_trajectory[-1][0]
+        else:
+            stage_iterdone = 0
+        trajectory.append({
+            'stage':i,'gain':stage['gain'],'cycleniter':stage['cycleniter'],
+            'threshold':stage_threshold,'iterdone':stage_iterdone,
+            'nmajordone':int(summary.get('nmajordone',0)) if isinstance(summary,dict) else 0,
+            'stopcode':int(summary.get('stopcode',0)) if isinstance(summary,dict) else 0,
+            'cycles':[[iterdone+it,peak,flux] for it,peak,flux in stage_trajectory],
+        })
+        iterdone += stage_iterdone
+        print(f'Stage {i}: gain={stage["gain"]}, cycleniter={stage["cycleniter"]}, '+
+              f'threshold={stage_threshold:.3e} Jy, {stage_iterdone} iterations')
+        if iterdone >= niter:
+            break
+
+    if savemodel == 'modelcolumn':
+        print('')
+        print('Running tclean a second time to save the model...')
+        tclean_kwargs = _tclean_kwargs_from_wrapper(
+            vis=vis,imagename=imagename,threshold=threshold,gain=gain,cycleniter=cycleniter,**kwargs
+        )
+        tclean_kwargs.update({'niter':0,'restart':True,'calcpsf':False,'calcres':False,'savemodel':'modelcolumn'})
+        tclean(**tclean_kwargs)
+
+    with open(imagename+'.schedule.json','w') as f:
+        json.dump({'imagename':imagename,'threshold':final_threshold,'iterdone':iterdone,'stages':trajectory},f,indent=1)
+    print(f'Total minor cycle iterations: {iterdone}, residual trajectory saved to {imagename}.schedule.json')
+
+    return trajectory
+
+def _split_quantity(quantity):
+    """
+    Split a quantity string (e.g. '-118.4km/s', '219.9494420GHz') into value and unit.
+    """
+    quantity = quantity.strip()
+    i = len(quantity)
+    while i > 0 and not (quantity[i-1].isdigit() or quantity[i-1] == '.'):
+        i -= 1
+    return float(quantity[:i]), quantity[i:]
+
+def split_channel_range(start, width, nchan, nchunks):
+    """
+    Partition a tclean cube spectral axis into contiguous chunks.
+    Parameters:
+    start:   first channel (e.g. '-118.4km/s', an integer channel index is also accepted)
+    width:   channel width (e.g. '0.7km/s', or an integer number of channels)
+    nchan:   total number of output channels
+    nchunks: number of chunks
+    Returns:
+    list of (start, nchan) for the chunks, with start in the same units as the input start.
+    """
+    nchunks = int(min(max(nchunks,1),nchan))
+    edges   = np.linspace(0,nchan,nchunks+1).round().astype(int)
+    if isinstance(start,str):
+        start_value,start_unit = _split_quantity(start)
+        width_value,width_unit = _split_quantity(width)
+        assert start_unit == width_unit, 'start and width must have the same units'
+        return [(f'{start_value+i0*width_value:.6f}{start_unit}',int(i1-i0)) for i0,i1 in zip(edges[:-1],edges[1:])]
+    return [(int(start)+int(i0)*int(width),int(i1-i0)) for i0,i1 in zip(edges[:-1],edges[1:])]
+
+#At most 8 CASA processes at once on the shared nodes (see the scripts' header)
+cube_max_workers = 8
+
+_tclean_chunk_script = """
+import json
+from casatasks import tclean
+with open({params!r}) as f:
+    tclean(**json.load(f))
+"""
+
+def tclean_cube_parallel(vis, imagename, start, width, nchan, nchunks=None, nworkers=None, restoringbeam='common', python_executable=None, keep_chunks=False, **tclean_kwargs):
+    """
+    Image a cube in channel chunks, each in a separate (non-MPI) CASA process, and merge the chunks.
+    Channels are deconvolved independently, so the only cross-channel step is the common restoring beam.
+    Each chunk is restored with per-plane beams and the chunks are concatenated along the spectral axis.
+    If restoringbeam='common', the image is then restored again as tclean does: model convolved with the common
+    beam of all the planes plus the (unsmoothed) residual. The .image.pbcor (if pbcor) and .sumwt are merged too.
+    Parameters:
+    vis, imagename:   as in tclean
+    start, width:     first channel and channel width of the full cube (as in tclean)
+    nchan:            number of channels of the full cube
+    nchunks:          number of channel chunks, default is one per worker
+    nworkers:         number of concurrent CASA processes, default is the number of cores up to cube_max_workers
+                      (and at most nchan)
+    restoringbeam:    'common' or '' (per-plane beams)
+    python_executable: python with casatasks installed, default is the one running this session
+    keep_chunks:      whether to keep the chunk images (imagename+'_chunkN.*')
+    tclean_kwargs:    all other tclean keywords (specmode='cube', cell, imsize, threshold, mask, ...)
+    """
+    import sys
+    import subprocess
+    if python_executable is None:
+        python_executable = sys.executable
+    if nworkers is None:
+        nworkers = min(os.cpu_count(),cube_max_workers)
+    nworkers = int(min(nworkers,nchan))
+    if nchunks is None:
+        nchunks = nworkers
+    chunks = split_channel_range(start,width,nchan,nchunks)
+
+    pbcor = tclean_kwargs.pop('pbcor',False)
+    for ext in ['.image','.image.pbcor','.image.perplanebeam','.mask','.model','.pb','.psf','.residual','.sumwt']:
+        os.system('rm -rf '+imagename+ext)
+
+    #Each worker runs single-threaded, parallelism comes from the number of concurrent chunks
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = '1'
+
+    chunk_names = []
+    pending     = []
+    for i,(chunk_start,chunk_nchan) in enumerate(chunks):
+        chunk_name = f'{imagename}_chunk{i}'
+        chunk_names.append(chunk_name)
+        os.system(f'rm -rf {chunk_name}.*')
+        params = dict(tclean_kwargs)
+        params.update({
+            'vis':os.path.abspath(vis),'imagename':os.path.abspath(chunk_name),
+            'start':chunk_start,'width':width,'nchan':chunk_nchan,
+            'restoringbeam':'','parallel':False,'pbcor':False,
+        })
+        with open(chunk_name+'.json','w') as f:
+            json.dump(params,f)
+        with open(chunk_name+'.py','w') as f:
+            f.write(_tclean_chunk_script.format(params=os.path.abspath(chunk_name+'.json')))
+        pending.append((chunk_name,[python_executable,os.path.abspath(chunk_name+'.py')]))
+
+    running = []
+    failed  = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < nworkers:
+            chunk_name,command = pending.pop(0)
+            log = open(chunk_name+'.log','w')
+            running.append((chunk_name,subprocess.Popen(command,stdout=log,stderr=subprocess.STDOUT,env=env),log))
+        chunk_name,process,log = running.pop(0)
+        process.wait()
+        log.close()
+        if process.returncode != 0 or not os.path.isdir(chunk_name+'.image'):
+            failed.append(chunk_name)
+        print(f'Chunk {chunk_name} done (return code {process.returncode})')
+    if len(failed) > 0:
+        raise RuntimeError(f'tclean failed for chunks {failed}, see the corresponding .log files')
+
+    #Merge the chunks along the spectral axis
+    for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt']:
+        outfile = imagename+('.image.perplanebeam' if ext == '.image' else ext)
+        infiles = [chunk_name+ext for chunk_name in chunk_names if os.path.isdir(chunk_name+ext)]
+        if len(infiles) != len(chunk_names):
+            continue
+        merged = ia.imageconcat(outfile=outfile,infiles=infiles,axis=-1,relax=True,overwrite=True)
+        merged.done()
+
+    if restoringbeam == 'common':
+        ia.open(imagename+'.image.perplanebeam')
+        commonbeam = ia.commonbeam()
+        ia.close()
+        #Restore with the common beam: only the model is convolved, the residual is added as it is
+        ia.open(imagename+'.model')
+        smoothed = ia.convolve2d(
+            outfile=imagename+'.model.commonbeam',axes=[0,1],type='gaussian',
+            major=commonbeam['major'],minor=commonbeam['minor'],pa=commonbeam['pa'],overwrite=True
+        )
+        smoothed.done()
+        ia.close()
+        immath(imagename=[imagename+'.model.commonbeam',imagename+'.residual'],expr='IM0+IM1',outfile=imagename+'.image')
+        ia.open(imagename+'.image')
+        ia.setrestoringbeam(remove=True)
+        ia.setrestoringbeam(major=commonbeam['major'],minor=commonbeam['minor'],pa=commonbeam['pa'])
+        ia.setbrightnessunit('Jy/beam')
+        ia.close()
+        os.system(f'rm -rf {imagename}.image.perplanebeam {imagename}.model.commonbeam')
+        print(f'Common beam: {commonbeam["major"]["value"]:.3f} {commonbeam["major"]["unit"]} x '+
+              f'{commonbeam["minor"]["value"]:.3f} {commonbeam["minor"]["unit"]} ({commonbeam["pa"]["value"]:.2f} {commonbeam["pa"]["unit"]})')
+    else:
+        os.system(f'mv {imagename}.image.perplanebeam {imagename}.image')
+    if pbcor:
+        impbcor(imagename=imagename+'.image',pbimage=imagename+'.pb',outfile=imagename+'.image.pbcor',cutoff=tclean_kwargs.get('pblimit',0.2))
+
+    if not keep_chunks:
+        for chunk_name in chunk_names:
+            os.system(f'rm -rf {chunk_name}.*')
+
+def get_image_header(imagename):
+    """
+    Read the axes and beam of a CASA (or FITS) image.
+    Returns a dictionary with:
+    shape, axisnames: as in ia.summary(), in CASA pixel order (usually RA, Dec, Stokes, Frequency)
+    cell:             pixel size in arcsec (x, y), with the sign of the increments
+    refpix, refval:   direction reference pixel and value (rad)
+    frequencies:      channel frequencies (Hz), empty for images without a spectral axis
+    restfreq:         rest frequency (Hz), 0 if undefined
+    beam:             (major, minor, pa) in arcsec, arcsec, deg (common beam for per-plane beam cubes)
+    """
+    ia.open(imagename)
+    summary = ia.summary(list=False)
+    csys    = ia.coordsys()
+    try:
+        beam = ia.restoringbeam()
+        if 'beams' in beam:
+            beam = ia.commonbeam()
+            beam['positionangle'] = beam['pa']
+    except Exception:
+        beam = {}
+    ia.close()
+
+    axisnames = [name.lower() for name in summary['axisnames']]
+    shape     = np.array(summary['shape'],dtype=int)
+    incr      = np.array(summary['incr'],dtype=float)
+    refpix    = np.array(summary['refpix'],dtype=float)
+    refval    = np.array(summary['refval'],dtype=float)
+    units     = summary['axisunits']
+    ix = axisnames.index('right ascension')
+    iy = axisnames.index('declination')
+    to_rad = {'rad':1.,'deg':np.pi/180.,'arcmin':np.pi/180./60.,'arcsec':np.pi/180./3600.}
+    header = {
+        'shape':shape,'axisnames':axisnames,
+        'cell':np.array([incr[ix]*to_rad[units[ix]],incr[iy]*to_rad[units[iy]]])*180./np.pi*3600.,
+        'refpix':refpix[[ix,iy]],
+        'refval':np.array([refval[ix]*to_rad[units[ix]],refval[iy]*to_rad[units[iy]]]),
+        'frequencies':np.array([]),'restfreq':0.,
+    }
+    if 'frequency' in axisnames:
+        iz = axisnames.index('frequency')
+        scale = {'Hz':1.,'kHz':1e3,'MHz':1e6,'GHz':1e9}[units[iz]]
+        header['frequencies'] = (refval[iz]+(np.arange(shape[iz])-refpix[iz])*incr[iz])*scale
+        header['restfreq']    = float(csys.restfrequency()['value'][0]) if len(csys.restfrequency()['value']) > 0 else 0.
+    csys.done()
+    if 'major' in beam:
+        arcsec = {'arcsec':1.,'arcmin':60.,'deg':3600.,'rad':180./np.pi*3600.}
+        header['beam'] = (
+            beam['major']['value']*arcsec[beam['major']['unit']],
+            beam['minor']['value']*arcsec[beam['minor']['unit']],
+            beam['positionangle']['value']*(180./np.pi if beam['positionangle']['unit'] == 'rad' else 1.),
+        )
+    else:
+        header['beam'] = None
+    return header
+
+def _radio_velocities(start, width, nchan):
+    """
+    Channel velocities (m/s) of a tclean cube defined by start and width in km/s or m/s.
+    """
+    start_value,start_unit = _split_quantity(start)
+    width_value,width_unit = _split_quantity(width)
+    scale = {'km/s':1e3,'m/s':1.}
+    return (start_value*scale[start_unit]+np.arange(nchan)*width_value*scale[width_unit])
+
+_keplerian_velocity_cache = {}
+_keplerian_mask_cache     = {}
+
+def _projected_keplerian_velocity(inc, PA, mstar, dist, x0, y0, extent, fine_cell):
+    """
+    Projected Keplerian velocity (m/s, without vlsr) and deprojected radius (arcsec) on a fine,
+    square grid of half-size extent (arcsec) and pixel size fine_cell (arcsec), centred on the image centre.
+    x is the offset towards East, y towards North. PA is the position angle of the redshifted major axis
+    (East of North) and a negative inc flips the sense of rotation, as in keplerian_mask.py.
+    The grid depends only on the disk geometry and stellar parameters and is memoised.
+    """
+    key = (inc,PA,mstar,dist,x0,y0,extent,fine_cell)
+    if key in _keplerian_velocity_cache:
+        return _keplerian_velocity_cache[key]
+    G     = 6.67430e-11
+    Msun  = 1.98847e30
+    au    = 1.495978707e11
+    axis  = np.arange(-extent,extent+0.5*fine_cell,fine_cell)
+    x,y   = np.meshgrid(axis-x0,axis-y0)
+    x_rot = x*np.sin(np.radians(PA))+y*np.cos(np.radians(PA))
+    y_rot = (x*np.cos(np.radians(PA))-y*np.sin(np.radians(PA)))/np.cos(np.radians(inc))
+    r     = np.hypot(x_rot,y_rot)
+    r_au  = np.maximum(r,0.5*fine_cell)*dist*au
+    vproj = np.sqrt(G*mstar*Msun/r_au)*(x_rot/np.maximum(r,0.5*fine_cell))*np.sin(np.radians(inc))
+    _keplerian_velocity_cache[key] = (axis,vproj,r)
+    return axis,vproj,r
+
+def keplerian_mask(inc, PA, mstar, dist, vlsr, cell, imsize, velocities, beam, nbeams=1.0, dV0=300., dVq=-0.5, r_min=0.0, r_max=4.0, x0=0.0, y0=0.0, conv_threshold=0.01, fine_cell=None, use_cache=True, cache_folder=None):
+    """
+    Boolean Keplerian mask cube for a tclean grid, without the need of an image on disk.
+    Parameters:
+    inc, PA:        disk inclination and position angle (deg), same conventions as keplerian_mask.make_mask
+    mstar, dist:    stellar mass (Msun) and distance (pc)
+    vlsr:           systemic velocity (m/s)
+    cell, imsize:   tclean pixel size (arcsec) and image size (pixels)
+    velocities:     channel velocities (m/s, radio convention), e.g. from _radio_velocities(start,width,nchan)
+    beam:           (major, minor, pa) in arcsec, arcsec, deg
+    nbeams:         FWHM of the convolution kernel in units of the beam
+    dV0, dVq:       local line width dV0*(r/1arcsec)**dVq (m/s)
+    r_min, r_max:   inner and outer (deprojected) radius of the mask (arcsec)
+    x0, y0:         offset of the disk centre from the image centre (arcsec, East and North)
+    conv_threshold: a pixel is masked if more than this fraction of the convolution kernel overlaps the line emission
+    fine_cell:      pixel size of the velocity field grid (arcsec), default is cell/2
+    use_cache:      cache masks in memory and (if cache_folder is given) on disk
+    Returns:
+    boolean array with shape (nchan, imsize, imsize), the last two axes are (Dec, RA) pixels
+    with RA increasing to the left as in CASA images (i.e., x pixel 0 is East).
+    """
+    velocities = np.atleast_1d(np.asarray(velocities,dtype=float))
+    if isinstance(imsize,(list,tuple,np.ndarray)):
+        nx,ny = int(imsize[0]),int(imsize[-1])
+    else:
+        nx,ny = int(imsize),int(imsize)
+    key = (inc,PA,mstar,dist,vlsr,float(cell),nx,ny,tuple(np.round(velocities,3)),tuple(beam),nbeams,dV0,dVq,r_min,r_max,x0,y0,conv_threshold)
+    if use_cache and key in _keplerian_mask_cache:
+        return _keplerian_mask_cache[key]
+    if use_cache and cache_folder is not None:
+        import hashlib
+        cache_file = os.path.join(cache_folder,hashlib.sha1(repr(key).encode()).hexdigest()+'.npz')
+        if os.path.isfile(cache_file):
+            packed = np.load(cache_file)
+            mask = np.unpackbits(packed['mask'],count=int(np.prod(packed['shape'])),axis=None).reshape(packed['shape']).astype(bool)
+            _keplerian_mask_cache[key] = mask
+            return mask
+
+    #Velocity field on a fine grid covering r_max plus the convolution kernel; outside the mask is empty
+    kernel_fwhm = nbeams*beam[0]
+    extent      = r_max+abs(x0)+abs(y0)+2.*kernel_fwhm
+    if fine_cell is None:
+        fine_cell = cell/2.
+    #Round the fine grid to a fixed set of values so that images with similar cells share the same grid
+    fine_cell = float(2.**np.floor(np.log2(fine_cell/1e-3)))*1e-3
+    axis,vproj,r = _projected_keplerian_velocity(inc,PA,mstar,dist,x0,y0,round(extent,3),fine_cell)
+
+    #Pixels of the requested grid within the extent (x pixel 0 is East)
+    npix_x   = min(nx,2*int(np.ceil(extent/cell))+2)
+    npix_y   = min(ny,2*int(np.ceil(extent/cell))+2)
+    i0,j0    = nx//2-npix_x//2,ny//2-npix_y//2
+    x_offset = -(np.arange(i0,i0+npix_x)-nx//2)*cell
+    y_offset =  (np.arange(j0,j0+npix_y)-ny//2)*cell
+    ix = np.clip(np.round((x_offset-axis[0])/fine_cell).astype(int),0,len(axis)-1)
+    iy = np.clip(np.round((y_offset-axis[0])/fine_cell).astype(int),0,len(axis)-1)
+    vproj_grid = vproj[np.ix_(iy,ix)]
+    r_grid     = r[np.ix_(iy,ix)]
+
+    #Broadcast the channel velocities against the velocity field
+    dchan   = np.abs(np.median(np.diff(velocities))) if len(velocities) > 1 else 0.
+    dV      = dV0*np.maximum(r_grid,fine_cell)**dVq
+    in_disk = (r_grid >= r_min) & (r_grid <= r_max)
+    submask = (np.abs((velocities-vlsr)[:,None,None]-vproj_grid[None,:,:]) <= (dV+0.5*dchan)[None,:,:]) & in_disk[None,:,:]
+
+    #Convolve with a Gaussian of FWHM nbeams*beam in Fourier space
+    sigma_major = nbeams*beam[0]/cell/np.sqrt(8.*np.log(2.))
+    sigma_minor = nbeams*beam[1]/cell/np.sqrt(8.*np.log(2.))
+    theta = np.radians(beam[2])
+    u = np.fft.fftfreq(npix_y)[:,None]
+    v = np.fft.rfftfreq(npix_x)[None,:]
+    #Beam PA is East of North and pixel x increases towards West
+    u_major =  u*np.cos(theta)-v*np.sin(theta)
+    u_minor =  u*np.sin(theta)+v*np.cos(theta)
+    transfer = np.exp(-2.*np.pi**2*(sigma_major**2*u_major**2+sigma_minor**2*u_minor**2))
+    convolved = np.fft.irfft2(np.fft.rfft2(submask.astype(np.float32),axes=(1,2))*transfer[None,:,:],s=(npix_y,npix_x),axes=(1,2))
+
+    mask = np.zeros((len(velocities),ny,nx),dtype=bool)
+    mask[:,j0:j0+npix_y,i0:i0+npix_x] = convolved > conv_threshold
+
+    if use_cache:
+        _keplerian_mask_cache[key] = mask
+        if cache_folder is not None:
+            os.makedirs(cache_folder,exist_ok=True)
+            np.savez_compressed(cache_file,mask=np.packbits(mask,axis=None),shape=np.array(mask.shape))
+    return mask
+
+def make_mask_fast(image=None, inc=None, PA=None, mstar=None, dist=None, vlsr=None, nbeams=1.0, r_min=0.0, r_max=4.0, dV0=300., dVq=-0.5, x0=0.0, y0=0.0, outfile=None, vis=None, cell=None, imsize=None, start=None, width=None, nchan=None, restfreq=None, beam=None, cache_folder='keplerian_mask_cache'):
+    """
+    Drop-in replacement for keplerian_mask.make_mask writing outfile (default image.replace('.image','.mask.image'),
+    outfile is required without image). If image exists, the grid, spectral axis and beam are read from its header. Otherwise the tclean
+    grid is built from vis (phase centre), cell (e.g. '0.021875arcsec'), imsize, start, width, nchan,
+    restfreq (e.g. '219.9494420GHz') and beam=(major,minor,pa) in arcsec, arcsec, deg, so that no dirty
+    cube is needed. Masks are cached by geometry, stellar parameters, spectral axis, cell and imsize.
+    """
+    c = 2.99792458e8
+    if outfile is None:
+        assert image is not None, 'provide outfile when the grid is built from vis'
+        outfile = image.replace('.image','.mask.image')
+    if image is not None and os.path.isdir(image):
+        header     = get_image_header(image)
+        cell_value = abs(header['cell'][1])
+        shape      = header['shape']
+        axisnames  = header['axisnames']
+        imsize     = [shape[axisnames.index('right ascension')],shape[axisnames.index('declination')]]
+        restfreq_value = header['restfreq']
+        velocities = c*(1.-header['frequencies']/restfreq_value)
+        beam       = header['beam'] if beam is None else beam
+        ia.open(image)
+        csys = ia.coordsys()
+        ia.close()
+    else:
+        if vis is None:
+            raise ValueError(f'make_mask_fast: image {image} does not exist, provide vis (and the tclean grid) to build the mask without it')
+        cell_value     = _split_quantity(cell)[0] if isinstance(cell,str) else float(cell)
+        restfreq_value = _split_quantity(restfreq)[0]*{'GHz':1e9,'MHz':1e6,'Hz':1.}[_split_quantity(restfreq)[1]]
+        velocities     = _radio_velocities(start,width,nchan)
+        imsize         = [imsize,imsize] if np.isscalar(imsize) else list(imsize)
+        msmd.open(vis)
+        phasecenter = msmd.phasecenter(0)
+        msmd.done()
+        csys = cs.newcoordsys(direction=True,spectral=True,stokes=['I'])
+        csys.setunits(type='direction',value=['rad','rad'])
+        csys.setreferencevalue(type='direction',value=[phasecenter['m0']['value'],phasecenter['m1']['value']])
+        csys.setincrement(type='direction',value=[-cell_value*np.pi/180./3600.,cell_value*np.pi/180./3600.])
+        csys.setreferencepixel(type='direction',value=[imsize[0]//2,imsize[1]//2])
+        csys.setreferencecode(type='spectral',value='LSRK',adjust=False)
+        csys.setrestfrequency(value=restfreq_value)
+        frequencies = restfreq_value*(1.-velocities/c)
+        csys.setreferencevalue(type='spectral',value=frequencies[0])
+        csys.setincrement(type='spectral',value=frequencies[1]-frequencies[0] if len(frequencies) > 1 else 1.)
+        csys.setreferencepixel(type='spectral',value=0)
+        axisnames = [name.lower() for name in csys.names()]
+        shape = [{'right ascension':imsize[0],'declination':imsize[1],'stokes':1,'frequency':len(velocities)}[name] for name in axisnames]
+    assert beam is not None, 'provide the beam, or an image with a restoring beam'
+
+    mask = keplerian_mask(
+        inc=inc,PA=PA,mstar=mstar,dist=dist,vlsr=vlsr,cell=cell_value,imsize=imsize,
+        velocities=velocities,beam=beam,nbeams=nbeams,dV0=dV0,dVq=dVq,
+        r_min=r_min,r_max=r_max,x0=x0,y0=y0,cache_folder=cache_folder,
+    )
+
+    #(chan, Dec, RA) -> CASA pixel order
+    pixels = np.transpose(mask,(2,1,0)).astype(np.float32)
+    order  = [axisnames.index(name) for name in ('right ascension','declination','frequency')]
+    pixels = pixels.reshape([imsize[0],imsize[1],len(velocities)]+[1]*(len(axisnames)-3))
+    pixels = np.moveaxis(pixels,list(range(len(axisnames))),order+[i for i in range(len(axisnames)) if i not in order])
+    os.system(f'rm -rf {outfile}')
+    ia.fromarray(outfile=outfile,pixels=pixels,csys=csys.torecord(),overwrite=True)
+    ia.close()
+    csys.done()
+    print(f'Keplerian mask saved to {outfile}')
+    return outfile
@@ -0,0 +1,283 @@
+"""
+Parser of the CASA session logs of the self-calibration scripts (selfcal_*_final_log.dat) and a columnar database of
+the parsed runs, to compare two runs or two targets. Only needs numpy: load with execfile() in CASA or import it.
+"""
+
+import os
+import re
+import numpy as np
+
+#Fields of the records produced by iter_log_records, per kind ('session': index of the execfile call in the log,
+#'line': line number, 'stage': last product reported before the record, without the target prefix)
+log_record_fields = {
+    'image':             ('session','line','stage','image','beam_major','beam_minor','beam_pa','flux','peak','rms','snr'),
+    'flagged_solutions': ('session','line','stage','flagged','solutions','snr_limit','spw','time'),
+    'warning':           ('session','line','stage','time','level','origin','message'),
+    'flux_ratio':        ('session','line','stage','vis','reference','ratio','gencal_scale','ratio_error'),
+    'offset':            ('session','line','stage','vis','dx','dy')
+}
+_log_numeric_fields = {
+    'session','line','beam_major','beam_minor','beam_pa','flux','peak','rms','snr','flagged','solutions','snr_limit',
+    'spw','ratio','gencal_scale','ratio_error','dx','dy'
+}
+log_run_database = 'log_runs' #folder with one .npz file of columns per run
+
+_re_prefix    = re.compile(r"prefix\s*=\s*'([^']+)'")
+_re_execfile  = re.compile(r"^CASA <\d+>: execfile\(")
+_re_image     = re.compile(r'^#(\S+\.image)\s*$')
+_re_beam      = re.compile(r'^#Beam ([-\d.e+]+) arcsec x ([-\d.e+]+) arcsec \(([-\d.e+]+) deg\)')
+_re_image_val = {
+    'flux': re.compile(r'^#Flux inside disk mask: ([-\d.e+]+) mJy'),
+    'peak': re.compile(r'^#Peak intensity of source: ([-\d.e+]+) mJy/beam'),
+    'rms':  re.compile(r'^#rms: ([-\d.e+]+) mJy/beam'),
+    'snr':  re.compile(r'^#Peak SNR: ([-\d.e+]+)')
+}
+_re_flagged   = re.compile(r'^(\d+) of (\d+) solutions flagged due to SNR < ([\d.]+) in spw=(\d+) at (\S+)')
+_re_casa_log  = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\s+(WARN|SEVERE)\s+(\S+?)(\+?)(?: \(file [^)]*\))?\s+(.*?)\s*$')
+_re_ratio     = re.compile(r'^#The ratio of the fluxes of (\S+) to\s*$')
+_re_ratio_val = re.compile(r'^#(\S+) is ([-\d.e+]+)\s*$')
+_re_gencal    = re.compile(r'^#The scaling factor for gencal is ([-\d.e+]+)')
+_re_ratio_err = re.compile(r'^#The error on the weighted mean ratio is ([-\d.e+]+)')
+_re_offset    = re.compile(r'^#Offset for (\S+):\s*\[\s*([-\d.e+]+)\s+([-\d.e+]+)\s*\]')
+_re_product   = re.compile(r'^#(?:Saving observation \d+ of|Measurement set exported to) (\S+?)(?: to \S+)?\s*$')
+
+def _strip_product(name, prefix):
+    """
+    Product name without folder, target prefix and extension, e.g. CQ_Tau_SB_contp2.image -> SB_contp2.
+    """
+    name = os.path.basename(name)
+    for extension in ('.vis.npz','.image','.ms'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            break
+    if prefix and name.startswith(prefix+'_'):
+        name = name[len(prefix)+1:]
+    return name
+
+def _product_stage(name, prefix):
+    #Per-EB products belong to the stage of the combined MS
+    return re.sub(r'_EB\d+$','',_strip_product(name,prefix))
+
+def iter_log_records(logfile, prefix=None):
+    """
+    Parse a CASA session log line by line (IPython echo, progress bars and notices are skipped) and yield the
+    results as dicts with a 'kind' key and the fields of log_record_fields[kind]:
+    image:             '#<name>.image' blocks of estimate_SNR (beam in arcsec/deg, flux/peak/rms in mJy)
+    flagged_solutions: 'N of M solutions flagged due to SNR < x' lines of gaincal
+    warning:           WARN/SEVERE lines of the CASA logger ('+' continuation lines are merged in the message)
+    flux_ratio:        estimate_flux_scale blocks ('vis' is the compared dataset)
+    offset:            alignment offsets (arcsec)
+    Parameters:
+    logfile: path of the log
+    prefix:  target prefix stripped from the product names (default: read from the "prefix = '...'" line of the log)
+    """
+    session = 0
+    stage   = ''
+    image   = None
+    ratio   = None
+    warning = None
+    with open(logfile,errors='replace') as f:
+        for line_number,line in enumerate(f,start=1):
+            line = line.rstrip('\n')
+            if prefix is None:
+                match = _re_prefix.search(line)
+                if match:
+                    prefix = match.group(1)
+            if _re_execfile.match(line):
+                session += 1
+                continue
+
+            if warning is not None:
+                match = _re_casa_log.match(line)
+                if match and match.group(4) and match.group(3) == warning['origin']:
+                    warning['message'] += ' '+match.group(5)
+                    continue
+                yield warning
+                warning = None
+            match = _re_casa_log.match(line)
+            if match:
+                warning = {
+                    'kind':'warning','session':session,'line':line_number,'stage':stage,'time':match.group(1),
+                    'level':match.group(2),'origin':match.group(3),'message':match.group(5)
+                }
+                continue
+
+            if image is not None:
+                if line.startswith('#') and not _re_image.match(line):
+                    match = _re_beam.match(line)
+                    if match:
+                        image['beam_major'],image['beam_minor'],image['beam_pa'] = map(float,match.groups())
+                    for field,regex in _re_image_val.items():
+                        match = regex.match(line)
+                        if match:
+                            image[field] = float(match.group(1))
+                    continue
+                yield image
+                image = None
+            match = _re_image.match(line)
+            if match:
+                stage = _strip_product(match.group(1),prefix)
+                image = dict.fromkeys(log_record_fields['image'])
+                image.update(kind='image',session=session,line=line_number,stage=stage,image=os.path.basename(match.group(1)))
+                continue
+
+            if ratio is not None:
+                match = _re_ratio_val.match(line)
+                if match and ratio['reference'] is None:
+                    ratio['reference'],ratio['ratio'] = _strip_product(match.group(1),prefix),float(match.group(2))
+                    continue
+                match = _re_gencal.match(line)
+                if match:
+                    ratio['gencal_scale'] = float(match.group(1))
+                    continue
+                match = _re_ratio_err.match(line)
+                if match:
+                    ratio['ratio_error'] = float(match.group(1))
+                    continue
+                yield ratio
+                ratio = None
+            match = _re_ratio.match(line)
+            if match:
+                ratio = dict.fromkeys(log_record_fields['flux_ratio'])
+                ratio.update(
+                    kind='flux_ratio',session=session,line=line_number,stage=_product_stage(match.group(1),prefix),
+                    vis=_strip_product(match.group(1),prefix)
+                )
+                continue
+
+            match = _re_flagged.match(line)
+            if match:
+                yield {
+                    'kind':'flagged_solutions','session':session,'line':line_number,'stage':stage,
+                    'flagged':int(match.group(1)),'solutions':int(match.group(2)),'snr_limit':float(match.group(3)),
+                    'spw':int(match.group(4)),'time':match.group(5)
+                }
+                continue
+            match = _re_offset.match(line)
+            if match:
+                yield {
+                    'kind':'offset','session':session,'line':line_number,'stage':stage,
+                    'vis':_strip_product(match.group(1),prefix),'dx':float(match.group(2)),'dy':float(match.group(3))
+                }
+                continue
+            match = _re_product.match(line)
+            if match:
+                stage = _product_stage(match.group(1),prefix)
+    for record in (warning,image,ratio):
+        if record is not None:
+            yield record
+
+def _log_columns(records):
+    """
+    Records of iter_log_records as columns: {kind: {field: array}} (missing numbers are nan).
+    """
+    rows = {kind:[] for kind in log_record_fields}
+    for record in records:
+        rows[record['kind']].append(record)
+    columns = {}
+    for kind,fields in log_record_fields.items():
+        columns[kind] = {}
+        for field in fields:
+            values = [record[field] for record in rows[kind]]
+            if field in _log_numeric_fields:
+                columns[kind][field] = np.array([np.nan if value is None else value for value in values],dtype=float)
+            else:
+                columns[kind][field] = np.array(['' if value is None else value for value in values],dtype=str)
+    return columns
+
+def load_log_run(logfile, run=None, database=None, prefix=None):
+    """
+    Parse a log into the run database (one .npz of columns per run), unless it is already there and the log has not
+    changed since. Returns the columns, {kind: {field: array}}.
+    Parameters:
+    logfile:  CASA session log
+    run:      name of the run in the database (default: log file name without extension)
+    database: folder of the database (default: log_run_database)
+    prefix:   target prefix (default: read from the log)
+    """
+    database = log_run_database if database is None else database
+    run = os.path.splitext(os.path.basename(logfile))[0] if run is None else run
+    runfile = os.path.join(database,run+'.npz')
+    stat = os.stat(logfile)
+    source = f'{os.path.abspath(logfile)}:{stat.st_size}:{stat.st_mtime_ns}'
+    if os.path.isfile(runfile):
+        with np.load(runfile) as stored:
+            if str(stored['source']) == source:
+                return _columns_from_npz(stored)
+    columns = _log_columns(iter_log_records(logfile,prefix=prefix))
+    os.makedirs(database,exist_ok=True)
+    np.savez(
+        runfile,source=np.array(source),
+        **{f'{kind}.{field}':values for kind,kind_columns in columns.items() for field,values in kind_columns.items()}
+    )
+    print(f'#Parsed {logfile}: '+', '.join(f'{len(next(iter(c.values())))} {kind}' for kind,c in columns.items()))
+    return columns
+
+def _columns_from_npz(stored):
+    columns = {kind:{} for kind in log_record_fields}
+    for key in stored.files:
+        if '.' in key:
+            kind,field = key.split('.',1)
+            columns[kind][field] = stored[key]
+    return columns
+
+def read_log_run(run, database=None):
+    """
+    Columns of a run of the database, {kind: {field: array}}.
+    """
+    database = log_run_database if database is None else database
+    with np.load(os.path.join(database,run+'.npz')) as stored:
+        return _columns_from_npz(stored)
+
+def summarize_log_run(columns):
+    """
+    Per-key summary of a run, {(kind, key): {quantity: value}}: the last image of each stage, the last flux ratio of
+    each dataset and the last offset of each EB (later sessions redo earlier ones), and the numbers of flagged
+    gaincal solutions per stage and of warnings per origin over the whole log.
+    """
+    summary = {}
+    for kind,key,fields in (
+        ('image','stage',('beam_major','beam_minor','beam_pa','flux','peak','rms','snr')),
+        ('flux_ratio','vis',('ratio','gencal_scale','ratio_error')),
+        ('offset','vis',('dx','dy'))
+    ):
+        table = columns[kind]
+        for i,name in enumerate(table[key]):
+            summary[(kind,str(name))] = {field:float(table[field][i]) for field in fields}
+    table = columns['flagged_solutions']
+    stages,index = np.unique(table['stage'],return_inverse=True)
+    flagged   = np.bincount(index,weights=table['flagged'],minlength=len(stages))
+    solutions = np.bincount(index,weights=table['solutions'],minlength=len(stages))
+    for stage,n_flagged,n_solutions in zip(stages,flagged,solutions):
+        summary[('flagged_solutions',str(stage))] = {
+            'flagged':int(n_flagged),'solutions':int(n_solutions),
+            'fraction':n_flagged/n_solutions if n_solutions else np.nan
+        }
+    origins,counts = np.unique(columns['warning']['origin'],return_counts=True)
+    for origin,count in zip(origins,counts):
+        summary[('warning',str(origin))] = {'count':int(count)}
+    return summary
+
+def diff_log_runs(run_a, run_b, database=None, kinds=None, rtol=1e-3, verbose=True):
+    """
+    Compare the summaries (summarize_log_run) of two runs of the database, e.g. two reductions of a target or two
+    targets (stage names do not include the prefix). Returns the list of (kind, key, quantity, value_a, value_b) that
+    differ by more than rtol (relative) or are only in one run (value None).
+    """
+    summary_a = summarize_log_run(read_log_run(run_a,database=database))
+    summary_b = summarize_log_run(read_log_run(run_b,database=database))
+    differences = []
+    for kind,key in sorted(set(summary_a)|set(summary_b)):
+        if kinds is not None and kind not in kinds:
+            continue
+        values_a = summary_a.get((kind,key),{})
+        values_b = summary_b.get((kind,key),{})
+        for quantity in dict.fromkeys(list(values_a)+list(values_b)):
+            a,b = values_a.get(quantity),values_b.get(quantity)
+            if a is not None and b is not None and (np.isclose(a,b,rtol=rtol,atol=0.) or (np.isnan(a) and np.isnan(b))):
+                continue
+            differences.append((kind,key,quantity,a,b))
+    if verbose:
+        for kind,key,quantity,a,b in differences:
+            print(f'{kind:<18} {key:<60} {quantity:<12} {a!s:>12} {b!s:>12}')
+    return differences
@@ -0,0 +1,772 @@
+"""
+Pipeline bookkeeping helpers (intermediate products and their cleanup, staging on node-local scratch, profiling,
+results store).
+Load with execfile() after reduction_utils, like imaging_utils.py.
+"""
+
+import os
+import shutil
+import hashlib
+import inspect
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#Registry of the intermediate products (MSs, caltables, images): {path: {'consumers': set of stage names, 'final': bool}}
+_intermediates = {}
+_intermediates_lock = threading.Lock()
+_deletion_pool    = None
+_deletion_futures = []
+
+def register_intermediate(path, consumers=(), final=False):
+    """
+    Register a product with the stages that still have to read it. It is deleted (in the background) once all of
+    them have called stage_done, unless it is tagged final. Registering an existing product adds consumers.
+    Parameters:
+    path:      MS, caltable or image (a CASA image is a directory; matching .flagversions/.listobs.txt go with it)
+    consumers: names of the pending stages reading it, e.g. ['no_ave_applycal']
+    final:     never delete it (deliverables)
+    """
+    path = os.path.normpath(path)
+    with _intermediates_lock:
+        entry = _intermediates.setdefault(path,{'consumers':set(),'final':False})
+        entry['consumers'].update(consumers)
+        entry['final'] = entry['final'] or final
+
+def tag_final(*paths):
+    """
+    Keep the given products whatever their consumers.
+    """
+    for path in paths:
+        register_intermediate(path,final=True)
+
+def stage_done(stage):
+    """
+    Mark a stage as completed: it is removed from the consumers of all products, and the non-final products nobody
+    needs anymore are freed. Returns the list of freed products.
+    """
+    with _intermediates_lock:
+        freed = []
+        for path,entry in list(_intermediates.items()):
+            if stage not in entry['consumers']:
+                continue
+            entry['consumers'].discard(stage)
+            if not entry['consumers'] and not entry['final']:
+                freed.append(path)
+                del _intermediates[path]
+    for path in freed:
+        free_intermediate(path)
+    return freed
+
+def pending_consumers(path):
+    """
+    Stages still registered as reading a product (empty set if unknown).
+    """
+    entry = _intermediates.get(os.path.normpath(path))
+    return set(entry['consumers']) if entry is not None else set()
+
+def _remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path,ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+def free_intermediate(path):
+    """
+    Delete a product without blocking the pipeline: it (and its .flagversions and .listobs.txt companions) is
+    renamed right away, so the name can be re-created immediately, and removed in a background thread
+    (call wait_deletions() to wait for the pending ones).
+    """
+    global _deletion_pool
+    from concurrent.futures import ThreadPoolExecutor
+    if _deletion_pool is None:
+        _deletion_pool = ThreadPoolExecutor(max_workers=1)
+    scratch_forget(path)
+    for name in (path,path+'.flagversions',path+'.listobs.txt'):
+        if not os.path.lexists(name):
+            continue
+        trash = f'{name}.deleting.{os.getpid()}.{len(_deletion_futures)}'
+        os.rename(name,trash)
+        _deletion_futures.append(_deletion_pool.submit(_remove_path,trash))
+    print(f'#Freed {path}')
+
+def wait_deletions():
+    """
+    Wait for the background deletions started by free_intermediate.
+    """
+    while _deletion_futures:
+        _deletion_futures.pop().result()
+
+def copy_product(src, dst):
+    """
+    Copy an MS, caltable or image (shutil.copytree), as a profiled task so the read is part of the lineage.
+    """
+    shutil.copytree(src=src,dst=dst)
+
+#Lineage of the products read and written by the profiled tasks in each stage, merged over the runs and saved at exit
+#(intermediates_lineage). It is only reported (lineage_report): products are freed only when registered explicitly
+intermediates_lineage = 'intermediates_lineage.json'
+_lineage_input_keys   = ('gaintable','imagename','src','startmodel')
+_lineage_output_keys  = ('outputvis','concatvis','caltable','outfile','fitsimage','dst')
+_tclean_products      = ('.image','.residual','.model','.psf','.pb','.sumwt','.weight','.mask','.image.pbcor')
+_lineage = {} #path: {'produced': stage or None, 'read': [stages]}
+
+def _lineage_paths(value):
+    if isinstance(value,dict): #ms_observation_view
+        value = value.get('vis')
+    if isinstance(value,str):
+        value = [value]
+    if not isinstance(value,(list,tuple)):
+        return []
+    return [os.path.normpath(path) for path in value if isinstance(path,str) and path]
+
+def _task_products(task, args, kwargs):
+    """
+    Products read and written by a call, from its keywords (vis may be the first positional argument).
+    """
+    tclean = task in ('tclean','tclean_wrapper')
+    inputs = _lineage_paths(kwargs.get('vis',args[0] if args else None))
+    for key in _lineage_input_keys:
+        if not (tclean and key == 'imagename'):
+            inputs += _lineage_paths(kwargs.get(key))
+    outputs = [path for key in _lineage_output_keys for path in _lineage_paths(kwargs.get(key))]
+    if tclean:
+        outputs += [name+ext for name in _lineage_paths(kwargs.get('imagename')) for ext in _tclean_products]
+    return inputs,outputs
+
+def _record_lineage(task, args, kwargs, stage):
+    inputs,outputs = _task_products(task,args,kwargs)
+    scratch = os.path.normpath(scratch_folder)+os.sep
+    with _intermediates_lock:
+        for path in inputs:
+            if os.path.exists(path) and not os.path.abspath(path).startswith(scratch):
+                entry = _lineage.setdefault(path,{'produced':None,'read':[]})
+                if stage not in entry['read']:
+                    entry['read'].append(stage)
+        for path in outputs:
+            if os.path.exists(path) and not os.path.abspath(path).startswith(scratch):
+                entry = _lineage.setdefault(path,{'produced':None,'read':[]})
+                entry['produced'] = entry['produced'] or stage
+
+def write_lineage(lineage=None):
+    """
+    Merge the lineage recorded in this run into the lineage file (read stages are only added, so an interrupted run
+    never shortens the life of a product).
+    """
+    import json
+    lineage = intermediates_lineage if lineage is None else lineage
+    previous = {'stages':[],'products':{}}
+    if os.path.isfile(lineage):
+        with open(lineage) as f:
+            previous = json.load(f)
+    stages = list(dict.fromkeys(previous['stages']+[stage for stage,_,_ in _profile_stages]))
+    products = previous['products']
+    with _intermediates_lock:
+        for path,entry in _lineage.items():
+            merged = products.setdefault(path,{'produced':None,'read':[]})
+            merged['produced'] = merged['produced'] or entry['produced']
+            merged['read'] = list(dict.fromkeys(merged['read']+entry['read']))
+    with open(lineage,'w') as f:
+        json.dump({'stages':stages,'products':products},f,indent=1)
+
+def lineage_report(lineage=None):
+    """
+    Print the products written by the pipeline in the previous runs (lineage file) that are neither tagged final nor
+    registered, with the last stage that read them: candidates for register_intermediate. Nothing is deleted.
+    Returns:
+    list of (product, last reader stage or None if never read)
+    """
+    import json
+    lineage = intermediates_lineage if lineage is None else lineage
+    if not os.path.isfile(lineage):
+        return []
+    with open(lineage) as f:
+        recorded = json.load(f)
+    order = {stage:k for k,stage in enumerate(recorded['stages'])}
+    report = []
+    for path,entry in sorted(recorded['products'].items()):
+        if entry['produced'] is None or os.path.normpath(path) in _intermediates or not os.path.exists(path):
+            continue
+        last = max(entry['read'],key=lambda stage: order.get(stage,-1)) if entry['read'] else None
+        report.append((path,last))
+        print(f'#{path}: last read in stage {last}')
+    return report
+
+#Node-local scratch cache of MSs/caltables/images living on the shared filesystem: stages read their inputs from
+#local copies (LRU, at most scratch_max_bytes) and their outputs are written back in the background
+scratch_folder    = os.path.join(os.environ.get('TMPDIR','/tmp'),'selfcal_scratch')
+scratch_max_bytes = 200*1024**3
+scratch_max_input_fraction = 0.5 #larger inputs are read in place: caching them would evict everything else
+_scratch_cache    = OrderedDict() #shared path: {'local', 'stamp', 'bytes'}
+_scratch_pinned   = set()
+_scratch_lock     = threading.RLock()
+_writeback_pool    = None
+_writeback_futures = {}
+
+def _source_stamp(path):
+    """
+    Modification time of a product, to check the cached copy is current: for CASA tables the latest of the top-level
+    table.* files (and of those of the sub-MSs of a multi-MS), since data written in place (applycal, tclean model
+    column) change the table.f* files and not table.dat.
+    """
+    if not os.path.isfile(os.path.join(path,'table.dat')):
+        return os.stat(path).st_mtime_ns
+    roots = [path]
+    submss = os.path.join(path,'SUBMSS')
+    if os.path.isdir(submss):
+        roots += [entry.path for entry in os.scandir(submss) if entry.is_dir()]
+    return max(
+        entry.stat().st_mtime_ns for root in roots for entry in os.scandir(root)
+        if entry.is_file() and entry.name.startswith('table.')
+    )
+
+def _table_bytes(path):
+    """
+    Size estimate of a CASA table without walking it: the top-level table.f* data files (and those of the sub-MSs
+    of a multi-MS), which hold the main table columns; the subtables are negligible for an MS.
+    """
+    if not os.path.isfile(os.path.join(path,'table.dat')):
+        return _tree_bytes(path)
+    roots = [path]
+    submss = os.path.join(path,'SUBMSS')
+    if os.path.isdir(submss):
+        roots += [entry.path for entry in os.scandir(submss) if entry.is_dir()]
+    return sum(
+        entry.stat().st_size for root in roots for entry in os.scandir(root)
+        if entry.is_file() and entry.name.startswith('table.f')
+    )
+
+def _tree_bytes(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root,name)) for root,_,files in os.walk(path) for name in files)
+
+def _copy_product(source, destination):
+    if os.path.lexists(destination):
+        _remove_path(destination)
+    if os.path.isdir(source):
+        shutil.copytree(source,destination,symlinks=True)
+    else:
+        shutil.copy2(source,destination)
+
+def _scratch_path(path):
+    """
+    Local path of a shared product (a per-product folder keeps the base name, which CASA uses in some messages).
+    """
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(scratch_folder,key,os.path.basename(os.path.normpath(path)))
+
+def _scratch_evict(nbytes):
+    """
+    Drop least recently used, unpinned copies until nbytes more fit in scratch_max_bytes.
+    """
+    with _scratch_lock:
+        total = sum(entry['bytes'] for entry in _scratch_cache.values())
+        for path in list(_scratch_cache):
+            if total+nbytes <= scratch_max_bytes:
+                break
+            if path in _scratch_pinned:
+                continue
+            future = _writeback_futures.pop(path,None)
+            if future is not None:
+                future.result()
+            entry = _scratch_cache.pop(path)
+            _remove_path(os.path.dirname(entry['local']))
+            total -= entry['bytes']
+
+def scratch_forget(path):
+    """
+    Drop the local copy of a product (e.g. when it is deleted or rewritten on the shared filesystem).
+    """
+    path = os.path.abspath(path)
+    with _scratch_lock:
+        future = _writeback_futures.pop(path,None)
+        if future is not None:
+            future.result()
+        entry = _scratch_cache.pop(path,None)
+    if entry is not None:
+        _remove_path(os.path.dirname(entry['local']))
+
+def stage_in(path):
+    """
+    Local copy of a shared product, copied on first use or if the shared one changed since. Products larger than
+    scratch_max_input_fraction of the cache are not copied (the shared path is returned).
+    """
+    shared = os.path.abspath(path)
+    with _scratch_lock:
+        entry = _scratch_cache.get(shared)
+        if entry is not None and (shared in _writeback_futures or entry['stamp'] == _source_stamp(shared)):
+            _scratch_cache.move_to_end(shared)
+            return entry['local']
+        scratch_forget(shared)
+        nbytes = _tree_bytes(shared)
+        if nbytes > scratch_max_input_fraction*scratch_max_bytes:
+            print(f'#{shared} ({nbytes/1024**3:.1f} GB) is larger than {scratch_max_input_fraction:g} of the scratch cache, read in place')
+            return shared
+        _scratch_evict(nbytes)
+        local = _scratch_path(shared)
+        os.makedirs(os.path.dirname(local),exist_ok=True)
+        _copy_product(shared,local)
+        _scratch_cache[shared] = {'local':local,'stamp':_source_stamp(shared),'bytes':nbytes}
+        return local
+
+def staged_path(path):
+    """
+    Local copy of a product if it is in the scratch cache (e.g. the output of the previous stage, possibly still
+    being written back), otherwise the shared path. For reads only.
+    """
+    entry = _scratch_cache.get(os.path.abspath(path))
+    return entry['local'] if entry is not None else path
+
+def _write_back(local, shared):
+    #Copy next to the destination and rename, so the shared product never appears half written
+    partial = shared+'.writeback'
+    _copy_product(local,partial)
+    if os.path.lexists(shared):
+        _remove_path(shared)
+    os.rename(partial,shared)
+    with _scratch_lock:
+        if shared in _scratch_cache:
+            _scratch_cache[shared]['stamp'] = _source_stamp(shared)
+
+@contextmanager
+def scratch_stage(inputs=(), outputs=()):
+    """
+    Run a stage on node-local scratch: the inputs are staged in (cached, LRU eviction beyond scratch_max_bytes),
+    the stage writes its declared outputs locally and they are copied back to the shared filesystem in a background
+    thread while the next stage starts (wait_write_backs() waits for them). The outputs stay in the cache, so a
+    following stage staging them in does not wait nor read them back.
+    Example:
+    with scratch_stage(inputs=[vis],outputs=[outputvis]) as (local_inputs,local_outputs):
+        split(vis=local_inputs[0],outputvis=local_outputs[0],datacolumn='corrected')
+    """
+    global _writeback_pool
+    from concurrent.futures import ThreadPoolExecutor
+    shared_inputs  = [os.path.abspath(path) for path in inputs]
+    shared_outputs = [os.path.abspath(path) for path in outputs]
+    with _scratch_lock:
+        _scratch_pinned.update(shared_inputs+shared_outputs)
+    try:
+        local_inputs = [stage_in(path) for path in shared_inputs]
+        local_outputs = []
+        for path in shared_outputs:
+            scratch_forget(path)
+            local = _scratch_path(path)
+            os.makedirs(os.path.dirname(local),exist_ok=True)
+            if os.path.lexists(local):
+                _remove_path(local)
+            local_outputs.append(local)
+        yield local_inputs,local_outputs
+        if _writeback_pool is None:
+            _writeback_pool = ThreadPoolExecutor(max_workers=2)
+        for shared,local in zip(shared_outputs,local_outputs):
+            if not os.path.lexists(local):
+                continue
+            nbytes = _tree_bytes(local)
+            with _scratch_lock:
+                _scratch_cache[shared] = {'local':local,'stamp':None,'bytes':nbytes}
+                _writeback_futures[shared] = _writeback_pool.submit(_write_back,local,shared)
+    finally:
+        with _scratch_lock:
+            _scratch_pinned.difference_update(shared_inputs+shared_outputs)
+    _scratch_evict(0)
+
+#Tasks whose read-only calls run on a scratch copy of their MS (tclean reads it once per major cycle). gaincal and
+#applycal are not staged: applycal writes the MS in place, and gaincal reads it once, right after tclean has written
+#the model column, so the copy would cost more than the read it saves
+scratch_staged_tasks = ['tclean']
+
+def _scratch_task(name, task):
+    def wrapper(*args, **kwargs):
+        vis = kwargs.get('vis')
+        if args or not isinstance(vis,(str,list,tuple)) or kwargs.get('savemodel','none') != 'none' or kwargs.get('parallel',False):
+            #The MS is written (model column) or read by other MPI processes, which do not see the local scratch
+            return task(*args,**kwargs)
+        paths = [vis] if isinstance(vis,str) else list(vis)
+        #Same size cap as stage_in, from the table files only: larger MSs are read in place
+        staged = [path for path in paths if _table_bytes(path) <= scratch_max_input_fraction*scratch_max_bytes]
+        if not staged:
+            return task(*args,**kwargs)
+        with scratch_stage(inputs=staged) as (local_staged,_):
+            local = dict(zip(staged,local_staged))
+            local_vis = [local.get(path,path) for path in paths]
+            return task(*args,**dict(kwargs,vis=local_vis[0] if isinstance(vis,str) else local_vis))
+    wrapper.__name__ = name
+    wrapper.__doc__ = getattr(task,'__doc__',None)
+    wrapper.scratch_task = task
+    #inspect.signature of the wrapper is the one of the task (see _bound_arguments)
+    wrapper.__wrapped__ = task
+    return wrapper
+
+def scratch_tasks(tasks=None, namespace=None):
+    """
+    Wrap the tasks (scratch_staged_tasks by default) so that their read-only, serial calls read the MS from the
+    scratch cache: it is copied once and reused by all the following calls on the same, unchanged MS. The profiling
+    wrappers of profile_tasks are kept outermost, so the lineage still records the shared MS.
+    """
+    namespace = globals() if namespace is None else namespace
+    for name in (scratch_staged_tasks if tasks is None else tasks):
+        task = namespace.get(name)
+        if task is None:
+            continue
+        inner = getattr(task,'profiled_task',task)
+        if hasattr(inner,'scratch_task'):
+            continue
+        namespace[name] = _profiled(name,_scratch_task(name,inner)) if hasattr(task,'profiled_task') else _scratch_task(name,inner)
+
+def wait_write_backs():
+    """
+    Wait for the outputs of scratch_stage to be copied back to the shared filesystem.
+    """
+    with _scratch_lock:
+        futures = list(_writeback_futures.items())
+        _writeback_futures.clear()
+    for _,future in futures:
+        future.result()
+
+#Profiling of the CASA tasks and helper functions called by the pipeline: wall/CPU time, peak RSS, bytes read and
+#written and input MS size for every call, grouped in stages (Chrome trace/Perfetto JSON and per-stage CSV summary)
+profiled_tasks = [
+    'tclean_wrapper','tclean','gaincal','applycal','split','concat','virtualconcat','mstransform','plotms','flagdata',
+    'flagmanager','statwt','uvcontsub','gencal','listobs','fixplanets','phaseshift','export_MS','estimate_flux_scale',
+    'virtual_concat','materialize_concat','export_ms_view','baseline_dependent_average','compress_ms_columns',
+    'track_flux_ratios','ms_summary','ms_binned_profiles','copy_product'
+]
+profile_rss_interval = 0.5 #s, sampling of the resident memory during a call
+_profile_records = [] #one dict per call
+_profile_stages  = [] #[name, start, end]
+_profile_depth   = threading.local()
+_profile_t0      = None
+
+def _proc_io():
+    """
+    Bytes read and written by this process, including network filesystems (rchar/wchar), or None if unavailable.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['rchar']),int(fields['wchar'])
+    except (OSError,KeyError,ValueError):
+        return None
+
+def _proc_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError,ValueError,IndexError):
+        return 0
+
+def _cpu_seconds():
+    import resource
+    own      = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime+own.ru_stime+children.ru_utime+children.ru_stime
+
+def _input_ms_bytes(args, kwargs):
+    """
+    Size of the input MS(s) of a call (vis keyword or first positional argument), estimated with _table_bytes from one
+    listing of the table folder, so no MS is walked while the task is timed.
+    """
+    vis = kwargs.get('vis',args[0] if args else None)
+    if isinstance(vis,dict): #ms_observation_view
+        vis = vis['vis']
+    if isinstance(vis,str):
+        vis = [vis]
+    if not isinstance(vis,(list,tuple)):
+        return 0
+    nbytes = 0
+    for path in vis:
+        if not isinstance(path,str) or not os.path.isdir(path):
+            continue
+        nbytes += _table_bytes(path)
+    return nbytes
+
+def _profiled(name, task):
+    def wrapper(*args, **kwargs):
+        depth = getattr(_profile_depth,'value',0)
+        _profile_depth.value = depth+1
+        record = {
+            'task':name,'stage':_profile_stages[-1][0] if _profile_stages else '','depth':depth,
+            'input_bytes':_input_ms_bytes(args,kwargs)
+        }
+        peak = [_proc_rss()]
+        done = threading.Event()
+        def sample_rss():
+            while not done.wait(profile_rss_interval):
+                peak[0] = max(peak[0],_proc_rss())
+        sampler = threading.Thread(target=sample_rss,daemon=True)
+        sampler.start()
+        io_start,cpu_start,start = _proc_io(),_cpu_seconds(),time.perf_counter()
+        try:
+            return task(*args,**kwargs)
+        finally:
+            end = time.perf_counter()
+            done.set()
+            sampler.join()
+            io_end = _proc_io()
+            record.update(
+                start=start,wall=end-start,cpu=_cpu_seconds()-cpu_start,peak_rss=max(peak[0],_proc_rss()),
+                read_bytes=io_end[0]-io_start[0] if io_start else None,
+                written_bytes=io_end[1]-io_start[1] if io_start else None
+            )
+            _profile_records.append(record)
+            _record_lineage(name,args,kwargs,record['stage'])
+            _profile_depth.value = depth
+    wrapper.__name__ = name
+    wrapper.__doc__ = getattr(task,'__doc__',None)
+    wrapper.profiled_task = task
+    wrapper.__wrapped__ = task
+    return wrapper
+
+def set_profile_stage(stage):
+    """
+    Start a new profiling stage (the previous one ends here). The tasks called from now on are grouped under it.
+    """
+    now = time.perf_counter()
+    if _profile_stages and _profile_stages[-1][2] is None:
+        _profile_stages[-1][2] = now
+    _profile_stages.append([stage,now,None])
+
+def profile_tasks(trace_prefix=None, tasks=None, namespace=None):
+    """
+    Wrap the pipeline tasks (profiled_tasks by default) so that every call is timed and its input and output products
+    are recorded in the lineage (written at exit with write_lineage). The wrappers replace the
+    functions in the namespace the helper modules are execfile'd in, so calls made from other helpers
+    (e.g. tclean from tclean_wrapper) are profiled too, as nested calls.
+    Parameters:
+    trace_prefix: if given, write_profile(trace_prefix) is called at exit, so an interrupted run is profiled too
+    tasks:        names of the functions to profile (missing ones are skipped)
+    namespace:    dict holding the functions (default: the globals of the script)
+    """
+    global _profile_t0
+    import atexit
+    namespace = globals() if namespace is None else namespace
+    if _profile_t0 is None:
+        _profile_t0 = time.perf_counter()
+    for name in (profiled_tasks if tasks is None else tasks):
+        task = namespace.get(name)
+        if task is None or hasattr(task,'profiled_task'):
+            continue
+        namespace[name] = _profiled(name,task)
+    atexit.register(write_lineage)
+    if trace_prefix is not None:
+        atexit.register(write_profile,trace_prefix)
+
+def write_profile(trace_prefix):
+    """
+    Write the calls profiled so far: trace_prefix+'.trace.json' (Chrome trace format, open in chrome://tracing or
+    https://ui.perfetto.dev; stages and calls on separate tracks) and trace_prefix+'.csv' (per stage and task:
+    number of calls, wall and CPU time, peak RSS, bytes read/written, input MS size; the per-stage total row only
+    counts top-level calls, since nested calls are included in their parent).
+    Returns the CSV rows.
+    """
+    import csv
+    import json
+    t0 = _profile_t0 if _profile_t0 is not None else 0.
+    now = time.perf_counter()
+    microseconds = lambda t: round((t-t0)*1e6,1)
+    pid = os.getpid()
+    events = [
+        {'ph':'M','name':'thread_name','pid':pid,'tid':0,'args':{'name':'stages'}},
+        {'ph':'M','name':'thread_name','pid':pid,'tid':1,'args':{'name':'tasks'}}
+    ]
+    for stage,start,end in _profile_stages:
+        end = now if end is None else end
+        events.append({'ph':'X','name':stage,'cat':'stage','pid':pid,'tid':0,'ts':microseconds(start),'dur':round((end-start)*1e6,1)})
+    for record in _profile_records:
+        args = {key:record[key] for key in ('cpu','peak_rss','read_bytes','written_bytes','input_bytes','depth')}
+        events.append({
+            'ph':'X','name':record['task'],'cat':record['stage'] or 'task','pid':pid,'tid':1,
+            'ts':microseconds(record['start']),'dur':round(record['wall']*1e6,1),'args':args
+        })
+    with open(trace_prefix+'.trace.json','w') as f:
+        json.dump({'traceEvents':events,'displayTimeUnit':'ms'},f)
+
+    def summary(stage, task, records, wall=None):
+        return {
+            'stage':stage,'task':task,'calls':len(records),
+            'wall_s':round(sum(r['wall'] for r in records) if wall is None else wall,3),
+            'cpu_s':round(sum(r['cpu'] for r in records),3),
+            'peak_rss_MB':round(max([r['peak_rss'] for r in records],default=0)/1024**2,1),
+            'read_MB':round(sum(r['read_bytes'] or 0 for r in records)/1024**2,1),
+            'written_MB':round(sum(r['written_bytes'] or 0 for r in records)/1024**2,1),
+            'input_MB':round(sum(r['input_bytes'] for r in records)/1024**2,1)
+        }
+    rows = []
+    stages = [stage for stage,_,_ in _profile_stages]
+    if any(record['stage'] == '' for record in _profile_records):
+        stages.insert(0,'')
+    for stage in dict.fromkeys(stages):
+        records = [record for record in _profile_records if record['stage'] == stage]
+        stage_wall = sum((now if end is None else end)-start for name,start,end in _profile_stages if name == stage)
+        rows.append(summary(stage,'(stage total)',[r for r in records if r['depth'] == 0],wall=stage_wall or None))
+        for task in sorted({record['task'] for record in records}):
+            rows.append(summary(stage,task,[r for r in records if r['task'] == task]))
+    with open(trace_prefix+'.csv','w',newline='') as f:
+        writer = csv.DictWriter(f,fieldnames=list(summary('','',[]).keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'#Profile of {len(_profile_records)} calls written to {trace_prefix}.trace.json and {trace_prefix}.csv')
+    return rows
+
+#Append-only store of the results printed after each image/calibration step (estimate_SNR, imstat rms, gaincal
+#flagged solutions, alignment offsets, flux ratios), keyed by product name and stage, so later stages query them
+results_store = 'selfcal_results.sqlite'
+_results_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, stage TEXT, kind TEXT, name TEXT, quantity TEXT, value REAL, text TEXT
+);
+CREATE INDEX IF NOT EXISTS results_name ON results (name, quantity);
+CREATE INDEX IF NOT EXISTS results_stage ON results (stage, kind);
+"""
+
+def _product_name(path):
+    return os.path.basename(os.path.normpath(path))
+
+def record_result(kind, name, values, stage=None, store=None):
+    """
+    Append results to the store (previous values are kept; queries return the latest).
+    Parameters:
+    kind:   e.g. 'image', 'imstat', 'gaincal', 'offset', 'flux_ratio'
+    name:   image/caltable/MS (only the base name is stored)
+    values: {quantity: number or string}
+    stage:  default is the current profiling stage (set_profile_stage)
+    """
+    import sqlite3
+    store = results_store if store is None else store
+    if stage is None:
+        stage = _profile_stages[-1][0] if _profile_stages else ''
+    now = time.time()
+    rows = []
+    for quantity,value in values.items():
+        if isinstance(value,str):
+            rows.append((now,stage,kind,_product_name(name),quantity,None,value))
+        else:
+            rows.append((now,stage,kind,_product_name(name),quantity,float(value),None))
+    with sqlite3.connect(store) as db:
+        db.executescript(_results_schema)
+        db.executemany('INSERT INTO results (time,stage,kind,name,quantity,value,text) VALUES (?,?,?,?,?,?,?)',rows)
+
+def query_results(quantity=None, kind=None, name=None, stage=None, store=None):
+    """
+    Results from the store, oldest first, as dicts (time, stage, kind, name, quantity, value, text). name and stage
+    accept SQL LIKE patterns, e.g. name='%_SB_contp%.image'.
+    """
+    import sqlite3
+    store = results_store if store is None else store
+    if not os.path.isfile(store):
+        return []
+    conditions,parameters = [],[]
+    for column,value,operator in (('quantity',quantity,'='),('kind',kind,'='),('name',name,'LIKE'),('stage',stage,'LIKE')):
+        if value is not None:
+            conditions.append(f'{column} {operator} ?')
+            parameters.append(_product_name(value) if column == 'name' else value)
+    where = ' WHERE '+' AND '.join(conditions) if conditions else ''
+    with sqlite3.connect(store) as db:
+        db.row_factory = sqlite3.Row
+        return [dict(row) for row in db.execute(f'SELECT time,stage,kind,name,quantity,value,text FROM results{where} ORDER BY id',parameters)]
+
+def last_result(name, quantity, kind=None, store=None):
+    """
+    Latest value of a quantity for a product (None if never recorded).
+    """
+    rows = query_results(quantity=quantity,kind=kind,name=name,store=store)
+    if not rows:
+        return None
+    return rows[-1]['value'] if rows[-1]['text'] is None else rows[-1]['text']
+
+def threshold_from_results(imagename, factor=6., default=None, store=None):
+    """
+    tclean threshold string factor x the latest rms recorded for imagename (estimate_SNR), e.g. '0.0948mJy'.
+    Falls back to default if the image was never measured.
+    """
+    rms = last_result(imagename,'rms',kind='image',store=store)
+    if rms is None:
+        if default is None:
+            raise ValueError(f'no rms recorded for {imagename} in the results store')
+        print(f'#No rms recorded for {imagename}, using threshold {default}')
+        return default
+    return f'{factor*rms*1e3:.4f}mJy'
+
+def _caltable_flag_counts(caltable):
+    tb.open(caltable)
+    try:
+        flag = tb.getcol('FLAG')
+    finally:
+        tb.close()
+    return {'flagged':int(flag.sum()),'solutions':int(flag.size),'fraction':float(flag.mean()) if flag.size else float('nan')}
+
+def _flux_ratio_npz(reference, comparison, incl, PA, uvbins=None):
+    """
+    Flux ratio comparison/reference of two .vis.npz files as estimate_flux_scale computes it (inverse-variance weighted
+    mean over deprojected uv bins of the ratio of the profiles), for estimate_flux_scale versions that only print it.
+    """
+    uvbins = np.arange(10.,810.,20.) if uvbins is None else np.asarray(uvbins,dtype=float)
+    sums = []
+    for filename in (comparison,reference):
+        u,v,vis,wgt = load_vis_npz(filename,apply_flux_scale=False)
+        valid,unit = _flux_units(u,v,incl,PA,uvbins,1)
+        sums += [np.bincount(unit,weights=(wgt*vis.real)[valid],minlength=len(uvbins)-1),np.bincount(unit,weights=wgt[valid],minlength=len(uvbins)-1)]
+    return float(_weighted_ratio(*sums))
+
+def _bound_arguments(task, args, kwargs):
+    """
+    Arguments of a call by parameter name, defaults included (only the keywords if the signature is not available).
+    """
+    try:
+        bound = inspect.signature(task).bind(*args,**kwargs)
+    except (TypeError,ValueError):
+        return dict(kwargs)
+    bound.apply_defaults()
+    return dict(bound.arguments)
+
+def _recording(name, task):
+    def wrapper(*args, **kwargs):
+        result = task(*args,**kwargs)
+        try:
+            arguments = _bound_arguments(task,args,kwargs)
+            if name in ('estimate_SNR','estimate_SNR_cached') and isinstance(result,dict):
+                values = {key:result[key] for key in ('flux','peak','rms','snr') if key in result}
+                if result.get('beam') is not None:
+                    values.update(zip(('beam_major','beam_minor','beam_pa'),result['beam']))
+                record_result('image',arguments['imagename'],values)
+            elif name == 'region_statistics' and isinstance(result,dict):
+                record_result('imstat',arguments['imagename'],{'rms':result['rms'],'region':str(arguments.get('region',''))})
+            elif name == 'imstat' and isinstance(result,dict) and 'rms' in result:
+                record_result('imstat',arguments['imagename'],{'rms':np.ravel(result['rms'])[0],'region':str(arguments.get('region',''))})
+            elif name == 'gaincal' and arguments.get('caltable') and os.path.isdir(arguments['caltable']):
+                record_result('gaincal',arguments['caltable'],_caltable_flag_counts(arguments['caltable']))
+            elif name == 'find_offset' and result is not None:
+                dx,dy = np.ravel(result)[:2]
+                record_result('offset',arguments['offset_ms'],{'dx':dx,'dy':dy,'reference':str(arguments.get('reference_ms',''))})
+            elif name == 'estimate_flux_scale':
+                if result is not None:
+                    ratio = float(np.ravel(result)[0])
+                else:
+                    ratio = _flux_ratio_npz(arguments['reference'],arguments['comparison'],arguments['incl'],arguments['PA'],arguments.get('uvbins'))
+                record_result('flux_ratio',arguments['comparison'],{'ratio':ratio,'gencal_scale':np.sqrt(ratio),'reference':str(arguments['reference'])})
+        except Exception as error:
+            #Never stop the pipeline because of the bookkeeping
+            print(f'#Could not record the results of {name}: {error}')
+        return result
+    wrapper.__name__ = name
+    wrapper.__doc__ = getattr(task,'__doc__',None)
+    wrapper.recorded_task = task
+    wrapper.__wrapped__ = task
+    return wrapper
+
+def record_task_results(namespace=None):
+    """
+    Wrap estimate_SNR(_cached), region_statistics, imstat, gaincal, estimate_flux_scale and alignment.find_offset so
+    that their results go to the results store (in addition to being printed/returned as before).
+    """
+    namespace = globals() if namespace is None else namespace
+    for name in ('estimate_SNR','estimate_SNR_cached','region_statistics','imstat','gaincal','estimate_flux_scale'):
+        task = namespace.get(name)
+        if task is not None and not hasattr(task,'recorded_task'):
+            namespace[name] = _recording(name,task)
+    module = namespace.get('alignment')
+    if module is not None and hasattr(module,'find_offset') and not hasattr(module.find_offset,'recorded_task'):
+        module.find_offset = _recording('find_offset',module.find_offset)
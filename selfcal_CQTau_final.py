@@ -33,8 +33,27 @@ sys.path.append(github_path)
 # import alignment_default as alignment
 execfile(os.path.join(github_path,'reduction_utils_py3_mpi.py'))
 
+#path to your local copy of this repository (helper modules shipped with these scripts)
+selfcal_utils_path = '/data/beegfs/astro-storage/groups/benisty/frzagaria/selfcal_CQTau_and_MWC758/'
+execfile(os.path.join(selfcal_utils_path,'imaging_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'image_analysis_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'visibility_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'pipeline_utils.py'))
+
 prefix = 'CQ_Tau'
 
+#Time every CASA task and helper call (wall/CPU time, peak memory, I/O), per stage
+profile_tasks(trace_prefix=f'{prefix}_profile')
+#Serial tclean calls that only read their MS (savemodel='none') read it from node-local scratch, copied once for all
+#the major cycles and the following images of the same MS
+scratch_tasks()
+#Store the estimate_SNR/imstat/gaincal/alignment/flux scale results in results_store, queried for the thresholds
+record_task_results()
+#List the products of the previous runs that are not registered as intermediates, with their last reader stage
+#(intermediates_lineage): only a report, the intermediates are freed only when registered below
+lineage_report()
+set_profile_stage('0_initial_split')
+
 # System properties.
 incl  = 35.  # deg, from Ubeira-Gabellini et al. 2019
 PA    = 55.  # deg, from Ubeira-Gabellini et al. 2019
@@ -106,10 +125,9 @@ for _path, _data, _name, _field, _spw in zip(PL_calibrated_path, PL_calibrated_d
             keepflags  = False, 
         )
 
-        listobs(
+        ms_summary(
             vis       = f'{prefix}_{_name[i]}.ms',
             listfile  = f'{prefix}_{_name[i]}.ms.listobs.txt',
-            overwrite = True,
         )
 
 # spw_sets = {
@@ -245,6 +263,7 @@ def make_figures_folder(folderpath):
     os.mkdir(folderpath)
     return folderpath
 
+set_profile_stage('1_preselfcal_amp')
 preselfcal_amp_figures_folder = get_figures_folderpath('1_preselfcal_amp_figures')
 make_figures_folder(preselfcal_amp_figures_folder)
 
@@ -362,10 +381,9 @@ for params in data_params.values():
 
     avg_cont(ms_dict=params,output_prefix=prefix+'_flagtest',flagchannels=flagchannels_string,contspws=contspws,width_array=np.ones(len(contspws.split(",")),dtype=int))
 
-    listobs(
+    ms_summary(
         vis       = prefix+'_flagtest_'+params['name']+'_initcont.ms',
         listfile  = prefix+'_flagtest_'+params['name']+'_initcont.ms.listobs.txt',
-        overwrite = True,
     )
 
     plot_filename   = prefix+'_flagtest_'+params['name']+'_amp-v-freq_preselfcal.png'
@@ -413,14 +431,11 @@ for params in data_params.values():
     _, idx_key      = params['name'].split('EB')
     contspws        = np.array(params['cont_spws'].split(","),dtype=int)
     
-    chanfreqs = []
-    for spw in contspws:
-        tb.open(params['vis']+'/SPECTRAL_WINDOW')
-        chanfreqs.append(np.amin(tb.getcol('CHAN_FREQ', startrow=spw, nrow=1)[:,0]))
-        tb.close()
+    #Spw frequencies and baseline lengths from the MS metadata index (one msmd pass per MS, then cached)
+    chanfreqs = [np.amin(ms_chan_freqs(params['vis'],spw)) for spw in contspws]
 
     ref_freq     = np.amin(chanfreqs)
-    max_baseline = au.getBaselineLengths(params['vis'])[-1][1]
+    max_baseline = ms_max_baseline(params['vis'])
     
     max_chan_width.append(delta_freq_smearing(max_baseline=max_baseline,ref_freq=ref_freq/1e9))
 
@@ -486,10 +501,9 @@ for params in data_params.values():
 for baseline_key,n_EB in number_of_EBs.items():
     for i in range(n_EB):
         vis = f'{prefix}_{baseline_key}_EB{i}_initcont.ms'
-        listobs(
+        ms_summary(
             vis       = vis,
             listfile  = f'{vis}.listobs.txt',
-            overwrite = True,
         )
 
 # for params in data_params.values():
@@ -505,6 +519,7 @@ for baseline_key,n_EB in number_of_EBs.items():
 # Flagchannels input string for SB_EB0: '0:837~3005, 2:794~3043, 3:788~3056'
 # Flagchannels input string for SB_EB1: '0:837~3005, 2:794~3043, 3:788~3056'
 
+set_profile_stage('2_preselfcal_initcont_amp')
 preselfcal_initcont_amp_folder = get_figures_folderpath('2_preselfcal_initcont_amp_figures')
 make_figures_folder(preselfcal_initcont_amp_folder)
 
@@ -608,6 +623,7 @@ thresholds = {'LB':['0.1656mJy','0.1422mJy'],'SB':['1.4640mJy','0.3102mJy']}
 
 image_png_plot_sizes = [3,10] #sizes in arcsec of the zoomed and overview plots of the pngs
 
+set_profile_stage('3_preselfcal_images')
 preselfcal_images_png_folder = get_figures_folderpath('3_preselfcal_images')
 make_figures_folder(preselfcal_images_png_folder)
 
@@ -637,10 +653,10 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
             parallel       = use_parallel,
             savemodel      = 'modelcolumn',
         )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
+        estimate_SNR_cached(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
+        rms = region_statistics(f'{imagename}.image',noise_annulus)['rms']
         p['rms'] = rms
-        generate_image_png(
+        render_image_png(
             image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
             color_scale_limits=[-3*rms,10*rms],
             save_folder=preselfcal_images_png_folder
@@ -677,7 +693,7 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
 for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
     for EB_key,p in params.items():
         os.system(f'rm -rf '+prefix+'_'+p['name']+'_initcont_statwt.ms')
-        shutil.copytree(src=prefix+'_'+p['name']+'_initcont.ms',dst=prefix+'_'+p['name']+'_initcont_statwt.ms')
+        copy_product(src=prefix+'_'+p['name']+'_initcont.ms',dst=prefix+'_'+p['name']+'_initcont_statwt.ms')
 
         statwt(
             vis        = prefix+'_'+p['name']+'_initcont_statwt.ms',
@@ -714,10 +730,10 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
             parallel       = use_parallel,
             savemodel      = 'modelcolumn',
         )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
+        estimate_SNR_cached(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
+        rms = region_statistics(f'{imagename}.image',noise_annulus)['rms']
         p['rms'] = rms
-        generate_image_png(
+        render_image_png(
             image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
             color_scale_limits=[-3*rms,10*rms],
             save_folder=preselfcal_images_png_folder
@@ -757,6 +773,7 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
 single_EB_contspws = '0~7'
 single_EB_spw_mapping = [0,0,0,0,0,0,0,0]
 
+set_profile_stage('4_individual_EB_selfcal_and_shift')
 individual_EB_selfcal_shift_folder = get_figures_folderpath('4_individual_EB_selfcal_and_shift_figures')
 make_figures_folder(individual_EB_selfcal_shift_folder)
 
@@ -826,10 +843,10 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
             parallel       = use_parallel,
             savemodel      = 'modelcolumn',
         )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
+        estimate_SNR_cached(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
+        rms = region_statistics(f'{imagename}.image',noise_annulus)['rms']
         p['rms'] = rms
-        generate_image_png(
+        render_image_png(
             image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
             color_scale_limits=[-3*rms,10*rms],
             save_folder=individual_EB_selfcal_shift_folder
@@ -863,92 +880,6 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
 #rms: 4.86e-02 mJy/beam
 #Peak SNR: 98.77
 
-# Cellsize: ~beam/8
-cellsize = {'LB':'0.006arcsec','SB':'0.013arcsec'}
-
-# Image size: ~primary beam 1.22*lam/A = 32'' with A=12m (19 arcsec)
-imsize   = {'LB':6400,'SB':3600}
-
-#Image the self-calibrated EBs with same cellsize and imsize for ratio
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for EB_key,p in params.items():
-        os.system(f'rm -rf '+prefix+'_'+p['name']+'_initcont_selfcal_aligncomp_image*')
-        _, idx_key    = p['name'].split('EB')
-
-        mask = f'ellipse[[{mask_ra[baseline_key][int(idx_key)]},{mask_dec[baseline_key][int(idx_key)]}], [{mask_semimajor[baseline_key]:.3f}arcsec, {mask_semiminor[baseline_key]:.3f}arcsec], {mask_pa:.1f}deg]'
-        noise_annulus = f"annulus[[{mask_ra[baseline_key][int(idx_key)]}, {mask_dec[baseline_key][int(idx_key)]}],['4.arcsec', '6.arcsec']]"
-
-        imagename = prefix+'_'+p['name']+'_initcont_selfcal_aligncomp_image'
-        tclean_wrapper(
-            vis            = prefix+'_'+p['name']+'_initcont_selfcal.ms',
-            imagename      = imagename,
-            # deconvolver    = 'hogbom',
-            deconvolver    = 'multiscale',
-            scales         = scales[baseline_key],
-            smallscalebias = 0.6,                  #Default from Cornwell et al. (2008) and in CASA 5.5 (biases to smaller scales)
-            gain           = 0.3,                  #Default in DSHARP and exoALMA
-            cycleniter     = 300,                  #Default in DSHARP and exoALMA
-            niter          = 1000000,
-            mask           = mask,
-            threshold      = thresholds[baseline_key][int(idx_key)],
-            cellsize       = cellsize[baseline_key],
-            imsize         = imsize[baseline_key],
-            parallel       = use_parallel,
-            savemodel      = 'modelcolumn',
-        )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
-        p['rms'] = rms
-        generate_image_png(
-            image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
-            color_scale_limits=[-3*rms,10*rms],
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-
-#CQ_Tau_LB_EB0_initcont_selfcal_aligncomp_image.image
-#Beam 0.073 arcsec x 0.050 arcsec (-25.17 deg)
-#Flux inside disk mask: 132.94 mJy
-#Peak intensity of source: 1.69 mJy/beam
-#rms: 2.61e-02 mJy/beam
-#Peak SNR: 64.83
-
-#CQ_Tau_LB_EB1_initcont_selfcal_aligncomp_image.image
-#Beam 0.080 arcsec x 0.048 arcsec (20.69 deg)
-#Flux inside disk mask: 142.31 mJy
-#Peak intensity of source: 2.03 mJy/beam
-#rms: 2.11e-02 mJy/beam
-#Peak SNR: 96.25
-
-#CQ_Tau_SB_EB0_initcont_selfcal_aligncomp_image.image
-#Beam 0.272 arcsec x 0.234 arcsec (-14.95 deg)
-#Flux inside disk mask: 186.77 mJy
-#Peak intensity of source: 27.68 mJy/beam
-#rms: 2.03e-01 mJy/beam
-#Peak SNR: 136.50
-
-#CQ_Tau_SB_EB1_initcont_selfcal_aligncomp_image.image
-#Beam 0.127 arcsec x 0.099 arcsec (-0.57 deg)
-#Flux inside disk mask: 114.01 mJy
-#Peak intensity of source: 4.80 mJy/beam
-#rms: 4.86e-02 mJy/beam
-#Peak SNR: 98.77
-
-#For the images with same pixel scales, compute the image ratios
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for p in params.values():
-        imagename = prefix+'_'+p['name']+'_initcont_selfcal_aligncomp_image'
-        #ratio image, to be compared to the ratio image after alignment
-        ref_image = f'{prefix}_{baseline_key}_EB0_initcont_selfcal_aligncomp_image.image'
-        ref_rms = params[f'{baseline_key}0']['rms']
-        ratio_image = imagename+'.ratio'
-        os.system(f'rm -rf {ratio_image}')
-        immath(imagename=[ref_image,imagename+'.image'],mode='evalexpr',outfile=ratio_image,expr=f'iif(IM0 > 3*{ref_rms}, IM1/IM0, 0)')
-        generate_image_png(
-            ratio_image,plot_sizes=[2*mask_semimajor[baseline_key],2*mask_semimajor[baseline_key]],
-            color_scale_limits=[0.5,1.5],image_units='ratio',
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-
 #Align data (go from *initcont_selfcal.ms to *initcont_shift.ms)
 
 #Select the LB EB to act as the reference (usually the best SNR one)
@@ -1023,12 +954,16 @@ for shifted_ms in shifted_LB_EBs:
 #Merge shifted LB EBs for aligning SB EBs
 LB_concat_shifted = f'{prefix}_LB_concat_shifted.ms'
 os.system(f'rm -rf {LB_concat_shifted}')
-concat(
+#virtual_concat builds a multi-MS over the EBs, used in the same way by gaincal/applycal/split/tclean (materialize=True
+#for a physical concat); keepcopy=False moves dedicated inputs into it without any copy, keepcopy=True copies inputs still needed
+#The selfcal splits of a multi-MS keep it as a multi-MS (keepmms=True), the delivered products are written as plain MS (keepmms=False)
+#keepcopy=True: the shifted EBs are renamed and used for all the selfcal below
+virtual_concat(
     vis=shifted_LB_EBs,concatvis=LB_concat_shifted,
     dirtol='0.1arcsec',freqtol='2.0GHz',
-    copypointing=False
+    copypointing=False,keepcopy=True
 )
-listobs(vis=LB_concat_shifted,listfile=f'{LB_concat_shifted}.listobs.txt',overwrite=True)
+ms_summary(vis=LB_concat_shifted,listfile=f'{LB_concat_shifted}.listobs.txt')
 
 #Align SB EBs to concat shifted LB EBs
 reference_for_SB_alignment = LB_concat_shifted
@@ -1098,124 +1033,15 @@ for params in data_params_SB.values():
 for shifted_EB in shifted_LB_EBs+shifted_SB_EBs:
     os.system('mv {} {}'.format(shifted_EB, shifted_EB.replace('_selfcal', '')))
 
-#Check that the images are indeed aligned after the shift
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for EB_key,p in params.items():
-        os.system(f'rm -rf '+prefix+'_'+p['name']+'_initcont_shift_aligncomp_image*')
-        _, idx_key    = p['name'].split('EB')
-
-        mask = f"ellipse[[{mask_ra['LB'][1]},{mask_dec['LB'][1]}], [{mask_semimajor['LB']:.3f}arcsec, {mask_semiminor['LB']:.3f}arcsec], {mask_pa:.1f}deg]"
-        noise_annulus = f"annulus[[{mask_ra['LB'][1]}, {mask_dec['LB'][1]}],['4.arcsec', '6.arcsec']]"
-
-        imagename = prefix+'_'+p['name']+'_initcont_shift_aligncomp_image'
-        tclean_wrapper(
-            vis            = prefix+'_'+p['name']+'_initcont_shift.ms',
-            imagename      = imagename,
-            # deconvolver    = 'hogbom',
-            deconvolver    = 'multiscale',
-            scales         = scales[baseline_key],
-            smallscalebias = 0.6,                  #Default from Cornwell et al. (2008) and in CASA 5.5 (biases to smaller scales)
-            gain           = 0.3,                  #Default in DSHARP and exoALMA
-            cycleniter     = 300,                  #Default in DSHARP and exoALMA
-            niter          = 1000000,
-            mask           = mask,
-            threshold      = thresholds[baseline_key][int(idx_key)],
-            cellsize       = cellsize[baseline_key],
-            imsize         = imsize[baseline_key],
-            parallel       = use_parallel,
-            savemodel      = 'modelcolumn',
-        )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
-        p['rms'] = rms
-        generate_image_png(
-            image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
-            color_scale_limits=[-3*rms,10*rms],
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-
-#CQ_Tau_LB_EB0_initcont_shift_aligncomp_image.image
-#Beam 0.073 arcsec x 0.050 arcsec (-25.17 deg)
-#Flux inside disk mask: 132.66 mJy
-#Peak intensity of source: 1.70 mJy/beam
-#rms: 2.62e-02 mJy/beam
-#Peak SNR: 64.71
-
-#CQ_Tau_LB_EB1_initcont_shift_aligncomp_image.image
-#Beam 0.080 arcsec x 0.048 arcsec (20.69 deg)
-#Flux inside disk mask: 142.31 mJy
-#Peak intensity of source: 2.01 mJy/beam
-#rms: 2.11e-02 mJy/beam
-#Peak SNR: 95.49
-
-#CQ_Tau_SB_EB0_initcont_shift_aligncomp_image.image
-#Beam 0.272 arcsec x 0.234 arcsec (-14.96 deg)
-#Flux inside disk mask: 187.87 mJy
-#Peak intensity of source: 27.65 mJy/beam
-#rms: 2.03e-01 mJy/beam
-#Peak SNR: 136.13
-
-#CQ_Tau_SB_EB1_initcont_shift_aligncomp_image.image
-#Beam 0.127 arcsec x 0.099 arcsec (-0.57 deg)
-#Flux inside disk mask: 116.28 mJy
-#Peak intensity of source: 4.82 mJy/beam
-#rms: 4.87e-02 mJy/beam
-#Peak SNR: 99.06
-
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for p in params.values():
-        imagename = prefix+'_'+p['name']+'_initcont_shift_aligncomp_image'
-        ref_image = f'{prefix}_{baseline_key}_EB0_initcont_shift_aligncomp_image.image'
-        ref_rms = params[f'{baseline_key}0']['rms']
-        ratio_image = imagename+'.ratio'
-        os.system(f'rm -rf {ratio_image}')
-        immath(imagename=[ref_image,imagename+'.image'],mode='evalexpr',outfile=ratio_image,expr=f'iif(IM0 > 3*{ref_rms}, IM1/IM0, 0)')
-        generate_image_png(
-            ratio_image,plot_sizes=[2*mask_semimajor[baseline_key],2*mask_semimajor[baseline_key]],
-            color_scale_limits=[0.5,1.5],image_units='ratio',
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-#Also by checking the different images in casaviewer, the different EBs are well aligned
-
-for i,params in enumerate(data_params_LB.values()):
-    print('#'+params['name'])
-    mask = f"ellipse[[{mask_ra['LB'][i]},{mask_dec['LB'][i]}], [{mask_semimajor['LB']:.3f}arcsec, {mask_semiminor['LB']:.3f}arcsec], {mask_pa:.1f}deg]"
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_selfcal_aligncomp_image.image',region=mask)
-
-    #LB_EB0, 05h35m58.472389s +24d44m53.58122s
-    #Pixel coordinates of peak: x = 3196.577 y = 3191.452
-    #LB_EB1, 05h35m58.471897s +24d44m53.59290s
-    #Pixel coordinates of peak: x = 3197.630 y = 3193.436
-
-    mask = f"ellipse[[{mask_ra['LB'][1]},{mask_dec['LB'][1]}], [{mask_semimajor['LB']:.3f}arcsec, {mask_semiminor['LB']:.3f}arcsec], {mask_pa:.1f}deg]"
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_shift_aligncomp_image.image',region=mask)
-
-    #LB_EB0, 05h35m58.472414s +24d44m53.58068s
-    #Pixel coordinates of peak: x = 3200.699 y = 3194.540
-    #LB_EB1, 05h35m58.472402s +24d44m53.58384s
-    #Pixel coordinates of peak: x = 3200.725 y = 3195.065
-
-    #Differences are sub-pixels!
-
-for i,params in enumerate(data_params_SB.values()):
-    print('#'+params['name'])
-    mask = f"ellipse[[{mask_ra['SB'][i]},{mask_dec['SB'][i]}], [{mask_semimajor['SB']:.3f}arcsec, {mask_semiminor['SB']:.3f}arcsec], {mask_pa:.1f}deg]"
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_selfcal_aligncomp_image.image',region=mask)
-
-    #SB_EB0, 05h35m58.470699s +24d44m53.65246s
-    #Pixel coordinates of peak: x = 1798.674 y = 1796.675
-    #SB_EB1, 05h35m58.469115s +24d44m53.58912s
-    #Pixel coordinates of peak: x = 1802.021 y = 1796.108
-    
-    mask = f"ellipse[[{mask_ra['LB'][1]},{mask_dec['LB'][1]}], [{mask_semimajor['SB']:.3f}arcsec, {mask_semiminor['SB']:.3f}arcsec], {mask_pa:.1f}deg]"
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_shift_aligncomp_image.image',region=mask)
-
-    #SB_EB0, 05h35m58.472540s +24d44m53.58913s
-    #Pixel coordinates of peak: x = 1800.191 y = 1798.129
-    #SB_EB1, 05h35m58.471915s +24d44m53.58031s
-    #Pixel coordinates of peak: x = 1800.846 y = 1797.451
-
-    #Differences are sub-pixels!
+#Check that the EBs are indeed aligned after the shift, from the existing self-calibrated images of all EBs (with different
+#cell sizes) instead of re-imaging every EB on a common grid before and after the shift and comparing fit_gaussian peaks
+#(which gave sub-pixel differences): FFT cross-correlation of the masked images, minus the shifts applied by the alignment
+EB_names = [params['name'] for params in data_params.values()]
+alignment_region = f"ellipse[[{mask_ra['LB'][1]},{mask_dec['LB'][1]}], [{mask_semimajor['SB']:.3f}arcsec, {mask_semiminor['SB']:.3f}arcsec], {mask_pa:.1f}deg]"
+alignment_check = image_alignment_offsets(
+    [prefix+'_'+name+'_initcont_selfcal_image.image' for name in EB_names],region=alignment_region,
+    applied_offsets=[alignment_offsets[name] for name in EB_names],reference=EB_names.index('LB_EB1')
+)
 
 #Now that everything is aligned, we inspect the flux calibration
 for params in data_params.values():
@@ -1232,6 +1058,7 @@ list_npz_files = []
 for baseline_key,n_EB in number_of_EBs.items():
     list_npz_files += [f'{prefix}_{baseline_key}_EB{i}_initcont_shift.vis.npz' for i in range(n_EB)]
 
+set_profile_stage('5_deprojected_vis_profiles')
 deprojected_vis_profiles_folder = get_figures_folderpath('5_deprojected_vis_profiles')
 make_figures_folder(deprojected_vis_profiles_folder)
 
@@ -1242,6 +1069,15 @@ plot_deprojected(
     plot_label=os.path.join(deprojected_vis_profiles_folder,f'{prefix}_flux_scale_EB_preselfcal.png')
 )
 
+#Fit the disk geometry from the deprojected profile of all EBs, to compare with the literature incl/PA (35/55 deg)
+#The EBs are divided by their flux ratios to LB_EB1 (from estimate_flux_scale below), since they are not rescaled yet
+flux_ratios_preselfcal = {'LB_EB0':0.95160,'LB_EB1':1.,'SB_EB0':1.36589,'SB_EB1':0.91086}
+geometry = fit_disk_geometry(
+    list_npz_files,
+    fluxscale=[flux_ratios_preselfcal[f'{baseline_key}_EB{i}'] for baseline_key,n_EB in number_of_EBs.items() for i in range(n_EB)]
+)
+
+set_profile_stage('6_flux_comparisons')
 flux_comparison_folder = get_figures_folderpath('6_flux_comparisons')
 make_figures_folder(flux_comparison_folder)
 
@@ -1258,6 +1094,14 @@ make_figures_folder(flux_comparison_folder)
 #Flux offset of SB_EB0 is clear from the deprojected visibilities.
 flux_ref_EB = 'LB_EB1' 
 
+#Joint fit of offset, flux scale and decoherence of every EB against the gridded reference visibilities
+#(no imaging needed; cross-check of find_offset and of the estimate_flux_scale ratios below)
+vis_fit = fit_vis_offsets_fluxscale(
+    reference=f'{prefix}_{flux_ref_EB}_initcont_shift.vis.npz',
+    comparisons=[prefix+'_'+params['name']+'_initcont_shift.vis.npz' for params in data_params.values() if params['name'] != flux_ref_EB],
+    fit_decoherence=True
+)
+
 for params in data_params.values():
     plot_label = os.path.join(flux_comparison_folder,'flux_comparison_'+params['name']+f'_to_{flux_ref_EB}.png')
     estimate_flux_scale(
@@ -1338,17 +1182,19 @@ for params in data_params.values():
 
 #Begin of SB self-cal - iteration 1
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('7_selfcal_SB')
 SB_selfcal_folder = get_figures_folderpath('7_selfcal_SB_figures')
 make_figures_folder(SB_selfcal_folder)
 
 SB_cont_p0 = prefix+'_SB_contp0'
 os.system('rm -rf %s.ms*' %SB_cont_p0)
 
-concat(
+#keepcopy=True: the SB EBs are reused (rescaled) for the second selfcal iteration
+virtual_concat(
     vis=[f'{prefix}_SB_EB{i}_initcont_shift.ms' for i in range(number_of_EBs['SB'])],
-    concatvis=SB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=SB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=True
 )
-listobs(vis=SB_cont_p0+'.ms',listfile=SB_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=SB_cont_p0+'.ms',listfile=SB_cont_p0+'.ms.listobs.txt')
 #2024-12-10 21:26:44     WARN    MSConcat::copySysCal    
 #    /data/beegfs/astro-storage/groups/benisty/frzagaria/SO_detections/CQTau/selfcal_products/CQ_Tau_SB_contp0.ms does not have a valid syscal table,
 #    the MS to be appended, however, has one. Result won't have one.
@@ -1382,9 +1228,9 @@ tclean_wrapper(
     threshold = '0.3834mJy', 
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-rms_SB = imstat(imagename=SB_cont_p0+'.image',region=noise_annulus_SB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(SB_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+rms_SB = region_statistics(SB_cont_p0+'.image',noise_annulus_SB)['rms']
+render_image_png(
     SB_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1415,10 +1261,8 @@ generate_image_png(
 SB_refant = ''
 
 SB_contspws    = '0~15'
-SB_spw_mapping = [
-    0,0,0,0,0,0,0,0,
-    8,8,8,8,8,8,8,8,
-]
+#Map every spw onto the first spw of its EB for the combine='spw' solutions ([0]*8+[8]*8)
+SB_spw_mapping = combine_spw_map(SB_cont_p0+'.ms')
 
 #First round of phase-only self-cal
 #NOTE: you need .p1 instead of _p1 in the caltable name if you want flagdata to work (i.e., flagging problematic antennas non interactively)...
@@ -1464,17 +1308,17 @@ applycal(
 )
 SB_cont_p1 = SB_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %SB_cont_p1)
-split(vis=SB_cont_p0+'.ms',outputvis=SB_cont_p1+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p0+'.ms',outputvis=SB_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
     vis       = SB_cont_p1+'.ms',
     imagename = SB_cont_p1,
-    threshold = '0.3810mJy',
+    threshold = threshold_from_results(SB_cont_p0+'.image',factor=6.,default='0.3810mJy'), #6x the p0 rms in the results store
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1533,7 +1377,7 @@ applycal(
 )
 SB_cont_p2 = SB_cont_p1.replace('p1','p2')
 os.system('rm -rf %s.ms*' %SB_cont_p2)
-split(vis=SB_cont_p1+'.ms',outputvis=SB_cont_p2+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p1+'.ms',outputvis=SB_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1542,8 +1386,8 @@ tclean_wrapper(
     threshold = '0.3582mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1622,7 +1466,7 @@ applycal(
 )
 SB_cont_p3 = SB_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %SB_cont_p3)
-split(vis=SB_cont_p2+'.ms',outputvis=SB_cont_p3+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p2+'.ms',outputvis=SB_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1631,8 +1475,8 @@ tclean_wrapper(
     threshold = '0.3444mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1723,7 +1567,7 @@ applycal(
 )
 SB_cont_p4 = SB_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %SB_cont_p4)
-split(vis=SB_cont_p3+'.ms',outputvis=SB_cont_p4+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p3+'.ms',outputvis=SB_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1732,8 +1576,8 @@ tclean_wrapper(
     threshold = '0.3300mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1871,7 +1715,7 @@ applycal(
 )
 SB_cont_p5 = SB_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %SB_cont_p5)
-split(vis=SB_cont_p4+'.ms',outputvis=SB_cont_p5+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p4+'.ms',outputvis=SB_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1880,8 +1724,8 @@ tclean_wrapper(
     threshold = '0.3198mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1926,23 +1770,15 @@ all_SB_visibilities = self_caled_SB_visibilities.copy()
 all_SB_visibilities['p0'] = SB_cont_p0
 
 for self_cal_step,vis_name in all_SB_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
-    #Saving observation 0 of CQ_Tau_SB_contp0.ms to CQ_Tau_SB_contp0_EB0.ms
-    #Saving observation 1 of CQ_Tau_SB_contp0.ms to CQ_Tau_SB_contp0_EB1.ms
-    #...
-    #Saving observation 0 of CQ_Tau_SB_contp5.ms to CQ_Tau_SB_contp5_EB0.ms
-    #Saving observation 1 of CQ_Tau_SB_contp5.ms to CQ_Tau_SB_contp5_EB1.ms
 
     exported_ms = []
     for i in range(number_of_EBs['SB']):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
         #Measurement set exported to CQ_Tau_SB_contp0_EB0.vis.npz
         #Measurement set exported to CQ_Tau_SB_contp0_EB1.vis.npz
         #...
@@ -1971,16 +1807,18 @@ for self_cal_step,vis_name in all_SB_visibilities.items():
 
 #Begin of SB+LB self-cal - iteration 1
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('8_selfcal_SBLB')
 LB_selfcal_folder = get_figures_folderpath('8_selfcal_SBLB_figures')
 make_figures_folder(LB_selfcal_folder)
 
 LB_cont_p0 = prefix+'_SBLB_contp0'
 os.system('rm -rf %s.ms*' %LB_cont_p0)
-concat(
+#keepcopy=True: the LB EBs are reused for the second selfcal iteration
+virtual_concat(
     vis=[SB_cont_p5+'.ms']+[f'{prefix}_LB_EB{i}_initcont_shift.ms' for i in range(number_of_EBs['LB'])],
-    concatvis=LB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=LB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=True
 )
-listobs(vis=LB_cont_p0+'.ms',listfile=LB_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=LB_cont_p0+'.ms',listfile=LB_cont_p0+'.ms.listobs.txt')
 #2024-12-10 21:26:44     WARN    MSConcat::copySysCal    
 #    /data/beegfs/astro-storage/groups/benisty/frzagaria/SO_detections/CQTau/selfcal_products/CQ_Tau_SB_contp0.ms does not have a valid syscal table,
 #    the MS to be appended, however, has one. Result won't have one.
@@ -2023,9 +1861,9 @@ tclean_wrapper(
     threshold = '0.1056mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-rms_LB = imstat(imagename=LB_cont_p0+'.image',region=noise_annulus_LB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(LB_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+rms_LB = region_statistics(LB_cont_p0+'.image',noise_annulus_LB)['rms']
+render_image_png(
     LB_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2084,12 +1922,8 @@ generate_image_png(
 LB_refant = ''
 
 LB_contspws    = '0~31'
-LB_spw_mapping = [
-    0,0,0,0,0,0,0,0,
-    8,8,8,8,8,8,8,8,
-    16,16,16,16,16,16,16,16,
-    24,24,24,24,24,24,24,24,
-]
+#Map every spw onto the first spw of its EB for the combine='spw' solutions ([0]*8+[8]*8+[16]*8+[24]*8)
+LB_spw_mapping = combine_spw_map(LB_cont_p0+'.ms')
 
 #First round of phase-only self-cal
 #NOTE: you need .p1 instead of _p1 in the caltable name if you want flagdata to work (i.e., flagging problematic antennas non interactively)...
@@ -2138,17 +1972,17 @@ applycal(
 )
 LB_cont_p1 = LB_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %LB_cont_p1)
-split(vis=LB_cont_p0+'.ms',outputvis=LB_cont_p1+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p0+'.ms',outputvis=LB_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
     vis       = LB_cont_p1+'.ms',
     imagename = LB_cont_p1,
-    threshold = '0.1056mJy',
+    threshold = threshold_from_results(LB_cont_p0+'.image',factor=6.,default='0.1056mJy'), #6x the p0 rms in the results store
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2242,7 +2076,7 @@ applycal(
 )
 LB_cont_p2 = LB_cont_p1.replace('p1','p2')
 os.system('rm -rf %s.ms*' %LB_cont_p2)
-split(vis=LB_cont_p1+'.ms',outputvis=LB_cont_p2+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p1+'.ms',outputvis=LB_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2251,8 +2085,8 @@ tclean_wrapper(
     threshold = '0.1008mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2409,7 +2243,7 @@ applycal(
 )
 LB_cont_p3 = LB_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %LB_cont_p3)
-split(vis=LB_cont_p2+'.ms',outputvis=LB_cont_p3+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p2+'.ms',outputvis=LB_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2418,8 +2252,8 @@ tclean_wrapper(
     threshold = '0.0930mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2592,7 +2426,7 @@ applycal(
 )
 LB_cont_p4 = LB_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %LB_cont_p4)
-split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2601,8 +2435,8 @@ tclean_wrapper(
     threshold = '0.0930mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2748,7 +2582,7 @@ applycal(
 )
 LB_cont_p5 = LB_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %LB_cont_p5)
-split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_p5+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2757,8 +2591,8 @@ tclean_wrapper(
     threshold = '0.0906mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -3103,7 +2937,7 @@ applycal(
 )
 LB_cont_p6 = LB_cont_p5.replace('p5','p6')
 os.system('rm -rf %s.ms*' %LB_cont_p6)
-split(vis=LB_cont_p5+'.ms',outputvis=LB_cont_p6+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p5+'.ms',outputvis=LB_cont_p6+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3112,8 +2946,8 @@ tclean_wrapper(
     threshold = '0.0900mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p6+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -3163,18 +2997,15 @@ all_LB_visibilities['p0'] = LB_cont_p0
 
 total_number_of_EBs = number_of_EBs['SB'] + number_of_EBs['LB']
 for self_cal_step,vis_name in all_LB_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(total_number_of_EBs):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
 
     for i,exp_ms in enumerate(exported_ms):
         png_filename = f'flux_comparison_EB{i}_to_EB{SBLB_flux_ref_EB}'+f'_SBLB_{self_cal_step}.png'
@@ -3188,6 +3019,16 @@ for self_cal_step,vis_name in all_LB_visibilities.items():
     plot_label = os.path.join(LB_selfcal_folder,f'deprojected_vis_profiles_SBLB_{self_cal_step}.png')
     plot_deprojected(filelist=exported_ms,fluxscale=fluxscale,PA=PA,incl=incl,show_err=True,plot_label=plot_label)
 
+#Confidence intervals of all the EB flux ratios at every selfcal step in one call (bootstrap over uv bins and
+#azimuthal sectors), to decide the >4% rescalings without relying on the absolute scale of the weights
+flux_scale_intervals = bootstrap_flux_scale(
+    {
+        (self_cal_step,i):(vis_name+f'_EB{i}.vis.npz',vis_name+f'_EB{SBLB_flux_ref_EB}.vis.npz')
+        for self_cal_step,vis_name in all_LB_visibilities.items() for i in range(total_number_of_EBs) if i != SBLB_flux_ref_EB
+    },
+    incl=incl,PA=PA
+)
+
 #Redo the flux comparison images without the uvbins parameters, to have clearer plots
 #for self_cal_step,vis in self_caled_LB_visibilities.items():
 #    nametemplate = f'{prefix}_SBLB_cont{self_cal_step}_EB'
@@ -3218,7 +3059,7 @@ for self_cal_step,vis_name in all_LB_visibilities.items():
 for baseline_key,n_EB in number_of_EBs.items():
     for i in range(n_EB):
         vis = f'{prefix}_{baseline_key}_EB{i}_initcont_shift.ms'
-        listobs(vis=vis,listfile=f'{vis}.listobs.txt',overwrite=True)
+        ms_summary(vis=vis,listfile=f'{vis}.listobs.txt')
 
 # Check that you're using the right EB (i.e., no strange stuff happened on the original shifted EBs, and, in terms of flux scales, you do recover the original ones)
 # output = f'flux_comparison_SB_EB0_to_LB_EB1.png'
@@ -3237,7 +3078,7 @@ for baseline_key,n_EB in number_of_EBs.items():
 os.system('rm -rf '+prefix+'_SB_EB0_initcont_shift_rescaled.ms')
 rescale_flux(vis=prefix+'_SB_EB0_initcont_shift.ms', gencalparameter=[1.150]) #gencal parameter from SBLB_contp5
 #Splitting out rescaled values into new MS: CQ_Tau_SB_EB0_initcont_shift_rescaled.ms
-listobs(vis=prefix+'_SB_EB0_initcont_shift_rescaled.ms',listfile=prefix+'_SB_EB0_initcont_shift_rescaled.ms.listobs.txt',overwrite=True)
+ms_summary(vis=prefix+'_SB_EB0_initcont_shift_rescaled.ms',listfile=prefix+'_SB_EB0_initcont_shift_rescaled.ms.listobs.txt')
 
 export_MS(prefix+'_SB_EB0_initcont_shift_rescaled.ms') 
 #Measurement set exported to CQ_Tau_SB_EB0_initcont_shift_rescaled.vis.npz
@@ -3258,17 +3099,19 @@ export_MS(prefix+'_SB_EB0_initcont_shift_rescaled.ms')
 
 #Begin of SB self-cal - iteration 2
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('7.1_selfcal_SB_iteration2')
 SB_selfcal_iteration2_folder = get_figures_folderpath('7.1_selfcal_SB_iteration2_figures')
 make_figures_folder(SB_selfcal_iteration2_folder)
 
 SB_iteration2_cont_p0 = prefix+'_SB_iteration2_contp0'
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p0)
 
-concat(
+#keepcopy=False: last use of these EBs, they are moved into the multi-MS without copying the data
+virtual_concat(
     vis=[f'{prefix}_SB_EB0_initcont_shift_rescaled.ms',f'{prefix}_SB_EB1_initcont_shift.ms'],
-    concatvis=SB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=SB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=SB_iteration2_cont_p0+'.ms',listfile=SB_iteration2_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=SB_iteration2_cont_p0+'.ms',listfile=SB_iteration2_cont_p0+'.ms.listobs.txt')
 #2024-12-16 21:19:22     WARN    concat::::casa  The setup of the input MSs is not fully consistent. The concatenation may fail
 #   and/or the affected columns may contain partially only default data.
 #   {'CQ_Tau_SB_EB1_initcont_shift.ms': {'Main': {'present_a': True, 'present_b': True, 'missingcol_a': ['MODEL_DATA'], 'missingcol_b': []}}}
@@ -3303,9 +3146,9 @@ tclean_wrapper(
     threshold = '0.2754mJy', 
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-rms_iteration2_SB = imstat(imagename=SB_iteration2_cont_p0+'.image',region=noise_annulus_SB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+rms_iteration2_SB = region_statistics(SB_iteration2_cont_p0+'.image',noise_annulus_SB)['rms']
+render_image_png(
     SB_iteration2_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3368,7 +3211,7 @@ applycal(
 )
 SB_iteration2_cont_p1 = SB_iteration2_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p1)
-split(vis=SB_iteration2_cont_p0+'.ms',outputvis=SB_iteration2_cont_p1+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p0+'.ms',outputvis=SB_iteration2_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3377,8 +3220,8 @@ tclean_wrapper(
     threshold = '0.2730mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3444,7 +3287,7 @@ applycal(
 )
 SB_iteration2_cont_p2 = SB_iteration2_cont_p1.replace('p1','p2')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p2)
-split(vis=SB_iteration2_cont_p1+'.ms',outputvis=SB_iteration2_cont_p2+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p1+'.ms',outputvis=SB_iteration2_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3453,8 +3296,8 @@ tclean_wrapper(
     threshold = '0.2490mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3532,7 +3375,7 @@ applycal(
 )
 SB_iteration2_cont_p3 = SB_iteration2_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p3)
-split(vis=SB_iteration2_cont_p2+'.ms',outputvis=SB_iteration2_cont_p3+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p2+'.ms',outputvis=SB_iteration2_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3541,8 +3384,8 @@ tclean_wrapper(
     threshold = '0.2376mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3617,7 +3460,7 @@ applycal(
 )
 SB_iteration2_cont_p4 = SB_iteration2_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p4)
-split(vis=SB_iteration2_cont_p3+'.ms',outputvis=SB_iteration2_cont_p4+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p3+'.ms',outputvis=SB_iteration2_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3626,8 +3469,8 @@ tclean_wrapper(
     threshold = '0.2274mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3755,7 +3598,7 @@ applycal(
 
 SB_iteration2_cont_p5 = SB_iteration2_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p5)
-split(vis=SB_iteration2_cont_p4+'.ms',outputvis=SB_iteration2_cont_p5+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p4+'.ms',outputvis=SB_iteration2_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3764,8 +3607,8 @@ tclean_wrapper(
     threshold = '0.2262mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -3814,18 +3657,15 @@ all_SB_iteration2_visibilities = self_caled_SB_iteration2_visibilities.copy()
 all_SB_iteration2_visibilities['p0'] = SB_iteration2_cont_p0
 
 for self_cal_step,vis_name in all_SB_iteration2_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(number_of_EBs['SB']):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
 
     for i,exp_ms in enumerate(exported_ms):
         png_filename = f'iteration2_flux_comparison_SB_EB{i}_{self_cal_step}_to_{flux_ref_EB}.png'
@@ -3853,16 +3693,18 @@ for self_cal_step,vis_name in all_SB_iteration2_visibilities.items():
 
 #Begin of SB+LB self-cal - iteration 2
 #For phase self-cal, clean down to ~6sigma; for amplitude self-cal, clean down to ~1 sigma
+set_profile_stage('8.1_selfcal_SBLB_iteration2')
 LB_selfcal_iteration2_folder = get_figures_folderpath('8.1_selfcal_SBLB_iteration2_figures')
 make_figures_folder(LB_selfcal_iteration2_folder)
 
 LB_iteration2_cont_p0 = prefix+'_SBLB_iteration2_contp0'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p0)
-concat(
+#keepcopy=False: last use of these MSs, they are moved into the multi-MS without copying the data
+virtual_concat(
     vis=[SB_iteration2_cont_p5+'.ms',f'{prefix}_LB_EB0_initcont_shift.ms',f'{prefix}_LB_EB1_initcont_shift.ms'],
-    concatvis=LB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=LB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=LB_iteration2_cont_p0+'.ms',listfile=LB_iteration2_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=LB_iteration2_cont_p0+'.ms',listfile=LB_iteration2_cont_p0+'.ms.listobs.txt')
 
 #Define new SB mask using the same centre as before (checked and agrees with the listobs one)
 mask_pa        = PA
@@ -3891,9 +3733,9 @@ tclean_wrapper(
     threshold = '0.0888mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-rms_iteration2_LB = imstat(imagename=LB_iteration2_cont_p0+'.image',region=noise_annulus_LB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+rms_iteration2_LB = region_statistics(LB_iteration2_cont_p0+'.image',noise_annulus_LB)['rms']
+render_image_png(
     LB_iteration2_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -3960,7 +3802,7 @@ applycal(
 )
 LB_iteration2_cont_p1 = LB_iteration2_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p1)
-split(vis=LB_iteration2_cont_p0+'.ms',outputvis=LB_iteration2_cont_p1+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p0+'.ms',outputvis=LB_iteration2_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3969,8 +3811,8 @@ tclean_wrapper(
     threshold = '0.0882mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -4074,7 +3916,7 @@ applycal(
 )
 LB_iteration2_cont_p2 = LB_iteration2_cont_p1.replace('p1','p2')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p2)
-split(vis=LB_iteration2_cont_p1+'.ms',outputvis=LB_iteration2_cont_p2+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p1+'.ms',outputvis=LB_iteration2_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -4083,8 +3925,8 @@ tclean_wrapper(
     threshold = '0.0834mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -4245,7 +4087,7 @@ applycal(
 )
 LB_iteration2_cont_p3 = LB_iteration2_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p3)
-split(vis=LB_iteration2_cont_p2+'.ms',outputvis=LB_iteration2_cont_p3+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p2+'.ms',outputvis=LB_iteration2_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -4254,8 +4096,8 @@ tclean_wrapper(
     threshold = '0.0756mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -4455,7 +4297,7 @@ applycal(
 
 LB_iteration2_cont_p4 = LB_iteration2_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p4)
-split(vis=LB_iteration2_cont_p3+'.ms',outputvis=LB_iteration2_cont_p4+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p3+'.ms',outputvis=LB_iteration2_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -4464,8 +4306,8 @@ tclean_wrapper(
     threshold = '0.0732mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -4785,7 +4627,7 @@ applycal(
 )
 LB_iteration2_cont_p5 = LB_iteration2_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p5)
-split(vis=LB_iteration2_cont_p4+'.ms',outputvis=LB_iteration2_cont_p5+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p4+'.ms',outputvis=LB_iteration2_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -4794,8 +4636,8 @@ tclean_wrapper(
     threshold = '0.0732mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -5184,7 +5026,7 @@ applycal(
 )
 LB_iteration2_cont_p6 = LB_iteration2_cont_p5.replace('p5','p6')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p6)
-split(vis=LB_iteration2_cont_p5+'.ms',outputvis=LB_iteration2_cont_p6+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p5+'.ms',outputvis=LB_iteration2_cont_p6+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -5193,8 +5035,8 @@ tclean_wrapper(
     threshold = '0.0732mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p6+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -5220,8 +5062,8 @@ tclean_wrapper(
     threshold = '0.0122mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p6+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -5293,7 +5135,7 @@ applycal(
 )
 LB_iteration2_cont_ap0 = prefix+'_SBLB_iteration2_contap0'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_ap0)
-split(vis=LB_iteration2_cont_p6+'.ms',outputvis=LB_iteration2_cont_ap0+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p6+'.ms',outputvis=LB_iteration2_cont_ap0+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN with a ~1sigma threshold before amplitude self-cal
 tclean_wrapper(
@@ -5302,8 +5144,8 @@ tclean_wrapper(
     threshold = '0.0120mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_ap0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -5479,7 +5321,7 @@ applycal(
 )
 LB_iteration2_cont_ap1 = prefix+'_SBLB_iteration2_contap1'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_ap1)
-split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_ap1+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_ap1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN with a ~1sigma threshold before amplitude self-cal
 tclean_wrapper(
@@ -5488,8 +5330,8 @@ tclean_wrapper(
     threshold = '0.0118mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_ap1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_ap1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_ap1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -5542,18 +5384,15 @@ all_LB_iteration2_visibilities['p0'] = LB_iteration2_cont_p0
 
 total_number_of_EBs = number_of_EBs['SB'] + number_of_EBs['LB']
 for self_cal_step,vis_name in all_LB_iteration2_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(total_number_of_EBs):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
 
     for i,exp_ms in enumerate(exported_ms):
         png_filename = f'iteration2_flux_comparison_EB{i}_to_EB{SBLB_flux_ref_EB}'+f'_SBLB_{self_cal_step}.png'
@@ -5600,10 +5439,14 @@ for self_cal_step,vis_name in all_LB_iteration2_visibilities.items():
 
 #Split out final continuum ms table, with a 30s timebin
 LB_iteration2_cont_averaged = f'{prefix}_time_ave_continuum'
+#keepmms=False: delivered product, written as a plain MS
 os.system(f'rm -rf {LB_iteration2_cont_averaged}.ms*')
-split(vis=LB_iteration2_cont_ap1+'.ms',outputvis=LB_iteration2_cont_averaged+'.ms',datacolumn='data',keepflags=False,timebin='30s')
+split(vis=LB_iteration2_cont_ap1+'.ms',outputvis=LB_iteration2_cont_averaged+'.ms',datacolumn='data',keepflags=False,timebin='30s',keepmms=False)
+
+tag_final(LB_iteration2_cont_ap1+'.ms',LB_iteration2_cont_averaged+'.ms')
 
 #Now apply these solutions to the line data
+set_profile_stage('9_apply_cal_to_lines')
 calibrate_linedata_folder = get_figures_folderpath('9_apply_cal_to_lines')
 make_figures_folder(calibrate_linedata_folder)
 
@@ -5645,7 +5488,7 @@ for params in data_params.values():
 
 #Apply statwt to the individual EBs
 for params in data_params.values():
-    shutil.copytree(src=prefix+'_'+params['name']+'.ms',dst=prefix+'_'+params['name']+'_statwt.ms')
+    copy_product(src=prefix+'_'+params['name']+'.ms',dst=prefix+'_'+params['name']+'_statwt.ms')
     statwt(
         vis        = prefix+'_'+params['name']+'_statwt.ms',
         spw        = params['cont_spws'],
@@ -5686,16 +5529,19 @@ for params in data_params.values():
 
 #If you have re-scaled fluxes, you need to re-scale the shifted *no_ave* EBs as well
 rescale_flux(vis=prefix+'_SB_EB0_no_ave_selfcal_shift.ms', gencalparameter=[1.150])
-listobs(vis=prefix+'_SB_EB0_no_ave_selfcal_shift_rescaled.ms',listfile=prefix+'_SB_EB0_no_ave_selfcal_shift_rescaled.ms.listobs.txt',overwrite=True)
+ms_summary(vis=prefix+'_SB_EB0_no_ave_selfcal_shift_rescaled.ms',listfile=prefix+'_SB_EB0_no_ave_selfcal_shift_rescaled.ms.listobs.txt')
 
 #Concat the non-averaged SB data
 SB_combined = f'{prefix}_SB_no_ave_concat'
 os.system('rm -rf %s.ms*' %SB_combined)
-concat(
+#keepcopy=False: dedicated products of the split/rescale above, moved into the multi-MS without copying the data
+virtual_concat(
     vis=[f'{prefix}_SB_EB0_no_ave_selfcal_shift_rescaled.ms',f'{prefix}_SB_EB1_no_ave_selfcal_shift.ms'],
-    concatvis=SB_combined+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=SB_combined+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=SB_combined+'.ms',listfile=SB_combined+'.ms.listobs.txt',overwrite=True)
+#Only read by the applycal and split of the SB no_ave calibration below, freed (in the background) after them
+register_intermediate(SB_combined+'.ms',consumers=['SB_no_ave_calibration'])
+ms_summary(vis=SB_combined+'.ms',listfile=SB_combined+'.ms.listobs.txt')
 #2024-12-27 08:02:02     WARN    MSConcat::copySysCal    /data/beegfs/astro-storage/groups/benisty/frzagaria/SO_detections/CQTau/selfcal_products/CQ_Tau_SB_no_ave_concat.ms does not have a valid syscal table,
 #    the MS to be appended, however, has one. Result won't have one.
 #2024-12-27 08:02:02     WARN    MSConcat::concatenate (file /source/casa6/casatools/casacore/ms/MSOper/MSConcat.cc, line 1000)     Could not merge SysCal subtables 
@@ -5714,17 +5560,22 @@ applycal(
 )
 SB_no_ave_selfcal = f'{prefix}_SB_no_ave_selfcal.ms'
 os.system(f'rm -rf {SB_no_ave_selfcal}*')
-split(vis=SB_combined+'.ms',outputvis=SB_no_ave_selfcal,datacolumn='corrected')
-listobs(vis=SB_no_ave_selfcal,listfile=SB_no_ave_selfcal+'.listobs.txt',overwrite=True)
+split(vis=SB_combined+'.ms',outputvis=SB_no_ave_selfcal,datacolumn='corrected',keepmms=False)
+stage_done('SB_no_ave_calibration')
+ms_summary(vis=SB_no_ave_selfcal,listfile=SB_no_ave_selfcal+'.listobs.txt')
 
 #Concat the non-averaged LB data
 LB_combined = f'{prefix}_SBLB_no_ave_concat'
 os.system('rm -rf %s.ms*' %LB_combined)
-concat(
+#keepcopy=False: dedicated products of the splits above, moved into the multi-MS without copying the data
+virtual_concat(
     vis=[SB_no_ave_selfcal]+[f'{prefix}_LB_EB0_no_ave_selfcal_shift.ms',f'{prefix}_LB_EB1_no_ave_selfcal_shift.ms'],
-    concatvis=LB_combined+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=LB_combined+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=LB_combined+'.ms',listfile=LB_combined+'.ms.listobs.txt',overwrite=True)
+#SB_no_ave_selfcal has been moved into it (keepcopy=False). Only read by the applycal and split of the SBLB no_ave
+#calibration below, freed (in the background) after them
+register_intermediate(LB_combined+'.ms',consumers=['SBLB_no_ave_calibration'])
+ms_summary(vis=LB_combined+'.ms',listfile=LB_combined+'.ms.listobs.txt')
 #2024-12-27 08:23:00     SEVERE  getcell::TIME   Exception Reported: TableProxy::getCell: no such row
 #2024-12-27 08:23:01     WARN    concat::::casa  Some but not all of the input MSs are lacking a populated POINTING table:
 #2024-12-27 08:23:01     WARN    concat::::casa     0: CQ_Tau_SB_no_ave_selfcal.ms
@@ -5750,47 +5601,32 @@ applycal(
 )
 SBLB_no_ave_selfcal = f'{prefix}_SBLB_no_ave_selfcal_time_ave.ms'
 os.system(f'rm -rf {SBLB_no_ave_selfcal}*')
-split(vis=LB_combined+'.ms',outputvis=SBLB_no_ave_selfcal,datacolumn='corrected',keepflags=False,timebin='30s') #Time average of 30s, tests show there is no difference with data without time average
-listobs(vis=SBLB_no_ave_selfcal,listfile=SBLB_no_ave_selfcal+'.listobs.txt',overwrite=True)
+split(vis=LB_combined+'.ms',outputvis=SBLB_no_ave_selfcal,datacolumn='corrected',keepflags=False,timebin='30s',keepmms=False) #Time average of 30s, tests show there is no difference with data without time average
+#Alternatively, baseline-dependent time averaging only (channels untouched for the lines), 1% decorrelation within 4 arcsec:
+#baseline_dependent_average(LB_combined+'.ms',SBLB_no_ave_selfcal,fov=4.,max_timebin='120s',average_channels=False,datacolumn='corrected')
+ms_summary(vis=SBLB_no_ave_selfcal,listfile=SBLB_no_ave_selfcal+'.listobs.txt')
+tag_final(SBLB_no_ave_selfcal)
+stage_done('SBLB_no_ave_calibration')
 
 #Check that the solutions have been applied correctly by flagging the line data, averaging and imaging continuum
 #Continuum has to be the same imaged in the last step of the self-cal
 SBLB_no_ave_selfcal = f'{prefix}_SBLB_no_ave_selfcal_time_ave.ms'
+#Spws containing lines in the concatenated numbering, from the LSRK frequencies of each EB
+#(was [1,4,5,5,6,6,7,7,7, 9,9,9,9,11,13,14,14,15,15, 17,...,23,23, 25,...,31,31] from listobs)
+SBLB_lines = {
+    '12CO':rest_freq_12CO,'13CO':rest_freq_13CO,'C18O':rest_freq_C18O,'SO':rest_freq_SO,
+    'H2CO_303_202':rest_freq_H2CO_303_202,'H2CO_321_220':rest_freq_H2CO_321_220,'H2CO_322_221':rest_freq_H2CO_322_221,
+    'H2CO_918_919':rest_freq_H2CO_918_919,'DCN_F21':rest_freq_DCN_F21,'DCN_F22':rest_freq_DCN_F22,
+}
+SBLB_line_spws,SBLB_line_freqs = line_spws_and_freqs(
+    line_channel_ranges(SBLB_no_ave_selfcal,SBLB_lines,v_sys,velocity_range=(-15.,15.)),SBLB_lines
+)
 complete_dataset_dict = {
     'vis':       SBLB_no_ave_selfcal,
     'name':      'SBLB_concat',
     'field':     'CQ_Tau',
-    'line_spws': np.array([
-        1, 4, 5,5, 6,6, 7,7,7,            #1, 4, 5,5, 6,6, 7,7,7,
-        9,9,9,9, 11, 13, 14,14, 15,15,    #1,1,1,1, 3, 5, 6,6, 7,7,
-        17,17,17,17, 19, 21, 22,22, 23,23,#1,1,1,1, 3, 5, 6,6, 7,7,
-        25,25,25,25, 27, 29, 30,30, 31,31,#1,1,1,1, 3, 5, 6,6, 7,7,
-    ]), # list of spws containing lines
-    'line_freqs':  np.array([
-        rest_freq_12CO, 
-        rest_freq_H2CO_321_220, 
-        rest_freq_SO,rest_freq_13CO, 
-        rest_freq_C18O,rest_freq_SO,
-        rest_freq_H2CO_918_919,rest_freq_DCN_F21,rest_freq_DCN_F22,
-
-        rest_freq_DCN_F21,rest_freq_DCN_F22,rest_freq_H2CO_303_202,rest_freq_H2CO_322_221, 
-        rest_freq_12CO, 
-        rest_freq_H2CO_321_220, 
-        rest_freq_SO,rest_freq_13CO, 
-        rest_freq_C18O,rest_freq_SO,
-        
-        rest_freq_DCN_F21,rest_freq_DCN_F22,rest_freq_H2CO_303_202,rest_freq_H2CO_322_221,
-        rest_freq_12CO,
-        rest_freq_H2CO_321_220,
-        rest_freq_SO,rest_freq_13CO,
-        rest_freq_C18O,rest_freq_SO,
-        
-        rest_freq_DCN_F21,rest_freq_DCN_F22,rest_freq_H2CO_303_202,rest_freq_H2CO_322_221,
-        rest_freq_12CO,
-        rest_freq_H2CO_321_220,
-        rest_freq_SO,rest_freq_13CO,
-        rest_freq_C18O,rest_freq_SO,
-    ]), #frequencies (Hz) corresponding to line_spws
+    'line_spws':   SBLB_line_spws, #list of spws containing lines
+    'line_freqs':  SBLB_line_freqs, #frequencies (Hz) corresponding to line_spws
     'spwcont_forplot': ['2','0','0','0'],
     'cont_spws':       '0~31',
     'width_array':     [
@@ -5829,8 +5665,8 @@ tclean_wrapper(
     threshold = '0.0118mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_averaged+'_image'+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_averaged+'_image'+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_averaged+'_image'+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],save_folder=calibrate_linedata_folder
 )
@@ -5856,8 +5692,8 @@ tclean_wrapper(
     threshold = '0.0118mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(complete_dataset_image+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(complete_dataset_image+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     complete_dataset_image+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],save_folder=calibrate_linedata_folder
 )
@@ -5877,13 +5713,11 @@ generate_image_png(
 
 #Plot ratio of cal then avg, and avg then cal. It should be equal to ~one (only difference being the time average)
 ref_image = LB_iteration2_cont_averaged+'_image'+'.image'
-os.system('rm -rf '+complete_dataset_image+'.ratio')
-immath(
-    imagename=[ref_image,complete_dataset_image+'.image'],mode='evalexpr',
-    outfile=complete_dataset_image+'.ratio',
-    expr='iif(IM0 > 3*'+str(rms_iteration2_LB)+', IM1/IM0, 0)'
+image_ratio(
+    ref_image,complete_dataset_image+'.image',threshold=3*rms_iteration2_LB,
+    size=2*mask_semimajor,outfile=complete_dataset_image+'.ratio'
 )
-generate_image_png(
+render_image_png(
     f'{complete_dataset_image}.ratio',plot_sizes=[2*mask_semimajor,2*mask_semimajor],
     color_scale_limits=[0.5,1.5],image_units='ratio',
     save_folder=calibrate_linedata_folder
@@ -5898,7 +5732,7 @@ uvcontsub(
     vis=SBLB_no_ave_selfcal,spw=complete_dataset_dict['cont_spws'],fitspw=fitspw,
     excludechans=True,solint='int',fitorder=1,want_cont=False
 )
-listobs(vis=SBLB_no_ave_selfcal+'.contsub',listfile=SBLB_no_ave_selfcal+'.contsub.listobs.txt',overwrite=True)
+ms_summary(vis=SBLB_no_ave_selfcal+'.contsub',listfile=SBLB_no_ave_selfcal+'.contsub.listobs.txt')
 #Complaints:
 #2024-12-27 16:35:36     SEVERE  uvcontsub::::casa       Task uvcontsub raised an exception of class ValueError with the following message: combine must include 'spw' when the fit is being applied to spws outside fitspw.
 #2024-12-27 16:35:36     SEVERE  uvcontsub::::casa       Exception Reported: Error in uvcontsub: combine must include 'spw' when the fit is being applied to spws outside fitspw.
@@ -6054,115 +5888,84 @@ for params in data_params.values():
 SBLB_no_ave_selfcal = f'{prefix}_SBLB_no_ave_selfcal_time_ave.ms'
 contsub_vis = f'{SBLB_no_ave_selfcal}.contsub'
 
+#Channel windows of the CO isotopologues (+-30 km/s around v_sys, LSRK) in every spw of the SBLB file
+CO_lines = {'12CO':rest_freq_12CO,'13CO':rest_freq_13CO,'C18O':rest_freq_C18O}
+CO_line_ranges = line_channel_ranges(SBLB_no_ave_selfcal,CO_lines,v_sys,velocity_range=(-30.,30.))
+
 #12CO
 vis_12CO = SBLB_no_ave_selfcal[:-3]+'_12CO.ms'
 os.system(f'rm -rf {vis_12CO}*')
-spw_12CO = '1:81~270,11:112~301,19:65~254,27:65~254'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_12CO,spw=spw_12CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_12CO,listfile=vis_12CO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_12CO}.contsub',spw=spw_12CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_12CO+'.contsub',listfile=vis_12CO+'.contsub.listobs.txt',overwrite=True)
+spw_12CO = check_spw_selection(spw_selection(CO_line_ranges['12CO']),'1:81~270,11:112~301,19:65~254,27:65~254') #expected from listobs
 
 #13CO
 vis_13CO = SBLB_no_ave_selfcal[:-3]+'_13CO.ms'
 os.system(f'rm -rf {vis_13CO}*')
-spw_13CO = '5:23~113,14:8~98,22:30~121,30:30~121'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_13CO,spw=spw_13CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_13CO,listfile=vis_13CO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_13CO}.contsub',spw=spw_13CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_13CO+'.contsub',listfile=vis_13CO+'.contsub.listobs.txt',overwrite=True)
+spw_13CO = check_spw_selection(spw_selection(CO_line_ranges['13CO']),'5:23~113,14:8~98,22:30~121,30:30~121') #expected from listobs
 
 #C18O
 vis_C18O = SBLB_no_ave_selfcal[:-3]+'_C18O.ms'
 os.system(f'rm -rf {vis_C18O}*')
-spw_C18O = '6:780~870,15:765~855,23:787~877,31:787~877'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_C18O,spw=spw_C18O,datacolumn='data',keepflags=False)
-listobs(vis=vis_C18O,listfile=vis_C18O+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_C18O}.contsub',spw=spw_C18O,datacolumn='data',keepflags=False)
-listobs(vis=vis_C18O+'.contsub',listfile=vis_C18O+'.contsub.listobs.txt',overwrite=True)
+spw_C18O = check_spw_selection(spw_selection(CO_line_ranges['C18O']),'6:780~870,15:765~855,23:787~877,31:787~877') #expected from listobs
 
 #H2CO_303_202
 vis_H2CO_303_202 = SBLB_no_ave_selfcal[:-3]+'_H2CO_303_202.ms'
 os.system(f'rm -rf {vis_H2CO_303_202}*')
 spw_H2CO_303_202 = '9:23~26,17:24~27,25:24~27'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_303_202,spw=spw_H2CO_303_202,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_303_202,listfile=vis_H2CO_303_202+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_303_202}.contsub',spw=spw_H2CO_303_202,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_303_202+'.contsub',listfile=vis_H2CO_303_202+'.contsub.listobs.txt',overwrite=True)
-
 #H2CO_321_220
 vis_H2CO_321_220 = SBLB_no_ave_selfcal[:-3]+'_H2CO_321_220.ms'
 os.system(f'rm -rf {vis_H2CO_321_220}*')
 spw_H2CO_321_220 = '4:31~36,13:30~35,21:31~37,29:31~37'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_321_220,spw=spw_H2CO_321_220,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_321_220,listfile=vis_H2CO_321_220+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_321_220}.contsub',spw=spw_H2CO_321_220,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_321_220+'.contsub',listfile=vis_H2CO_321_220+'.contsub.listobs.txt',overwrite=True)
-
 #H2CO_322_221
 vis_H2CO_322_221 = SBLB_no_ave_selfcal[:-3]+'_H2CO_322_221.ms'
 os.system(f'rm -rf {vis_H2CO_322_221}*')
 spw_H2CO_322_221 = '9:7~10,17:8~11,25:8~11'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_322_221,spw=spw_H2CO_322_221,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_322_221,listfile=vis_H2CO_322_221+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_322_221}.contsub',spw=spw_H2CO_322_221,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_322_221+'.contsub',listfile=vis_H2CO_322_221+'.contsub.listobs.txt',overwrite=True)
-
 #H2CO_918_919
 vis_H2CO_918_919 = SBLB_no_ave_selfcal[:-3]+'_H2CO_918_919.ms'
 os.system(f'rm -rf {vis_H2CO_918_919}*')
 spw_H2CO_918_919 = '7:89~92'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_918_919,spw=spw_H2CO_918_919,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_918_919,listfile=vis_H2CO_918_919+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_918_919}.contsub',spw=spw_H2CO_918_919,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_918_919+'.contsub',listfile=vis_H2CO_918_919+'.contsub.listobs.txt',overwrite=True)
-
 #DCN
 vis_DCN = SBLB_no_ave_selfcal[:-3]+'_DCN.ms'
 os.system(f'rm -rf {vis_DCN}*')
 spw_DCN = '7:46~49,9:86~89,17:87~90,25:87~90'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_DCN,spw=spw_DCN,datacolumn='data',keepflags=False)
-listobs(vis=vis_DCN,listfile=vis_DCN+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_DCN}.contsub',spw=spw_DCN,datacolumn='data',keepflags=False)
-listobs(vis=vis_DCN+'.contsub',listfile=vis_DCN+'.contsub.listobs.txt',overwrite=True)
-
 #SiS
 vis_SiS = SBLB_no_ave_selfcal[:-3]+'_SiS.ms'
 os.system(f'rm -rf {vis_SiS}*')
 spw_SiS = '7:9~12,9:49~52,17:50~53,25:50~53'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_SiS,spw=spw_SiS,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiS,listfile=vis_SiS+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_SiS}.contsub',spw=spw_SiS,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiS+'.contsub',listfile=vis_SiS+'.contsub.listobs.txt',overwrite=True)
-
 #SO
 vis_SO = SBLB_no_ave_selfcal[:-3]+'_SO.ms'
 os.system(f'rm -rf {vis_SO}*')
 spw_SO = '5:943~959,6:0~73,14:928~959,15:0~58,22:950~959,23:0~81,30:950~959,31:0~81'
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_SO,spw=spw_SO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SO,listfile=vis_SO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_SO}.contsub',spw=spw_SO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SO+'.contsub',listfile=vis_SO+'.contsub.listobs.txt',overwrite=True)
+#Split all the line MSs from one input before switching to the other: each input is staged once on node-local
+#scratch (scratch_folder, skipped if it exceeds half of scratch_max_bytes) and the line MSs are written back to the
+#shared filesystem in the background while the next splits run
+line_split_spws = {
+    vis_12CO:spw_12CO,
+    vis_13CO:spw_13CO,
+    vis_C18O:spw_C18O,
+    vis_H2CO_303_202:spw_H2CO_303_202,
+    vis_H2CO_321_220:spw_H2CO_321_220,
+    vis_H2CO_322_221:spw_H2CO_322_221,
+    vis_H2CO_918_919:spw_H2CO_918_919,
+    vis_DCN:spw_DCN,
+    vis_SiS:spw_SiS,
+    vis_SO:spw_SO,
+}
+for input_vis,suffix in ((SBLB_no_ave_selfcal,''),(contsub_vis,'.contsub')):
+    with scratch_stage(inputs=[input_vis],outputs=[vis+suffix for vis in line_split_spws]) as ([local_vis],local_outs):
+        for local_out,spw in zip(local_outs,line_split_spws.values()):
+            split(vis=local_vis,outputvis=local_out,spw=spw,datacolumn='data',keepflags=False)
+#The line MSs are read from the shared filesystem from here on
+wait_write_backs()
+for vis in line_split_spws:
+    for suffix in ('','.contsub'):
+        ms_summary(vis=vis+suffix,listfile=vis+suffix+'.listobs.txt')
 """
 for _vis,_freq in zip(
     [vis_12CO,vis_13CO,vis_C18O,vis_H2CO_303_202,vis_H2CO_321_220,vis_H2CO_322_221,vis_H2CO_918_919,vis_DCN,vis_SiS,vis_SO],
@@ -6227,8 +6030,8 @@ nchan     = 100
 imagename = vis_12CO[:-3]+'.contsub_image_1.0robust_4.0sigma'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
-    vis=vis_12CO+'.contsub',imagename=imagename,
+tclean_cube_parallel( #channel chunks imaged by separate CASA processes, merged with the common beam
+    vis=vis_12CO+'.contsub',imagename=imagename,nworkers=8,
     specmode='cube',restoringbeam='common',nterms=1,
     deconvolver='multiscale',scales=[0,2,4,8],
     cell='0.011arcsec',imsize=1200,gain=0.1,niter=50000,
@@ -6237,7 +6040,7 @@ tclean(
     outframe='LSRK',veltype='radio',restfreq='{}Hz'.format(rest_freq_12CO),
     usemask='user',mask=line_mask, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_12CO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.105 arcsec x 0.087 arcsec (0.06 deg)
@@ -6253,8 +6056,8 @@ nchan     = 50
 imagename = vis_13CO[:-3]+'.contsub_image_1.0robust_4.0sigma'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
-    vis=vis_13CO+'.contsub',imagename=imagename,
+tclean_cube_parallel( #channel chunks imaged by separate CASA processes, merged with the common beam
+    vis=vis_13CO+'.contsub',imagename=imagename,nworkers=8,
     specmode='cube',restoringbeam='common',nterms=1,
     deconvolver='multiscale',scales=[0,2,4,8],
     cell='0.012arcsec',imsize=1200,gain=0.1,niter=50000,
@@ -6264,7 +6067,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_13CO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.109 arcsec x 0.092 arcsec (0.08 deg)
@@ -6291,7 +6094,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_C18O.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.110 arcsec x 0.093 arcsec (0.13 deg)
@@ -6318,7 +6121,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_4.0sigma.image
 #Beam 0.126 arcsec x 0.105 arcsec (-1.10 deg)
@@ -6341,7 +6144,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.5robust_4.0sigma.image
 #Beam 0.083 arcsec x 0.063 arcsec (9.97 deg)
@@ -6364,7 +6167,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.75robust_4.0sigma.image
 #Beam 0.098 arcsec x 0.078 arcsec (0.21 deg)
@@ -6387,7 +6190,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.110 arcsec x 0.093 arcsec (0.10 deg)
@@ -6414,7 +6217,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SiS.contsub_image_natural_4.0sigma.image
 #Beam 0.162 arcsec x 0.127 arcsec (-1.23 deg)
@@ -6441,7 +6244,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_H2CO_321_220.contsub_image_natural_4.0sigma.image
 #Beam 0.128 arcsec x 0.110 arcsec (-0.17 deg)
@@ -6468,7 +6271,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_H2CO_303_202.contsub_image_natural_4.0sigma.image
 #Beam 0.162 arcsec x 0.127 arcsec (-1.23 deg)
@@ -6495,7 +6298,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_H2CO_322_221.contsub_image_natural_4.0sigma.image
 #Beam 0.117 arcsec x 0.098 arcsec (0.08 deg)
@@ -6522,7 +6325,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #2025-01-06 17:23:21     WARN    SIImageStore::restore (file /source/casa6/casatools/src/code/synthesis/ImagerObjects/SIImageStore.cc, line 2284)      
 #    Restoring with an empty model image. Only residuals will be processed to form the output restored image.
@@ -6551,11 +6354,19 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_DCN.contsub_image_natural_4.0sigma.image
 #Beam 0.127 arcsec x 0.106 arcsec (0.70 deg)
 #Flux inside disk mask: 135.44 mJy
 #Peak intensity of source: 0.38 mJy/beam
 #rms: 9.51e-02 mJy/beam
-#Peak SNR: 3.96
\ No newline at end of file
+#Peak SNR: 3.96
+
+#Wait for the pngs drawn in the background (errors of the png processes are raised here)
+wait_png_renders()
+
+#Wait for the background deletions of the freed intermediates
+wait_deletions()
+wait_write_backs()
+write_profile(f'{prefix}_profile')
@@ -35,6 +35,11 @@ execfile(os.path.join(github_path,'reduction_utils_py3_mpi.py'))
 
 execfile(os.path.join(github_path,'keplerian_mask.py'))
 
+#path to your local copy of this repository (helper modules shipped with these scripts)
+selfcal_utils_path = '/data/beegfs/astro-storage/groups/benisty/frzagaria/selfcal_CQTau_and_MWC758/'
+execfile(os.path.join(selfcal_utils_path,'imaging_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'image_analysis_utils.py'))
+
 prefix = 'CQ_Tau'
 path_to_vis = '../'
 
@@ -84,7 +89,9 @@ scales    = [
 
 for _robust,_cellsize,_threshold,_scales in zip(robust,cellsize,threshold,scales):
     imagename = LB_iteration2_cont_averaged+f'{_robust}robust_1.0sigma_0.02gain'
-    tclean_wrapper(
+    #Start with a large loop gain/cycleniter and go down to gain=0.02, cycleniter=300 close to the threshold.
+    #The residual trajectory per major cycle is saved in imagename+'.schedule.json'
+    tclean_wrapper_adaptive(
         vis       = path_to_vis+LB_iteration2_cont_averaged+'.ms', 
         imagename = imagename,
         threshold = f'{_threshold}mJy',
@@ -94,7 +101,7 @@ for _robust,_cellsize,_threshold,_scales in zip(robust,cellsize,threshold,scales
         gain      = 0.02,
         **tclean_wrapper_kwargs
     )
-    estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+    estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
     exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 
 #CQ_Tau_time_ave_continuum-1.0robust_1.0sigma_0.02gain.image
@@ -182,8 +189,10 @@ tclean_kwargs = {
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
+#Channels are imaged in chunks by separate CASA processes and merged with a common beam (no MPI needed)
+tclean_cube_parallel(
     vis       = path_to_vis+vis_SO+'.contsub',
+    nworkers  = 8, #do not use more than 8 cores
     imagename = imagename,
     scales    = [0,2,4,8],
     cell      = '0.0215arcsec',
@@ -194,10 +203,10 @@ tclean(
     imsize    = 1600,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [170,171,172,173,174,182,183,184,185,186]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [8.67e-04,8.66e-04,8.83e-04,8.76e-04,8.65e-04,9.18e-04,9.03e-04,8.90e-04,8.93e-04,8.77e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SOwide.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans.image
@@ -253,10 +262,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [8.11e-04,8.12e-04,8.21e-04,8.14e-04,8.10e-04,8.51e-04,8.41e-04,8.34e-04,8.39e-04,8.26e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -281,10 +290,10 @@ tclean(
     imsize    = 1600,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.32e-04,7.34e-04,7.38e-04,7.31e-04,7.29e-04,7.55e-04,7.53e-04,7.52e-04,7.59e-04,7.48e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -308,10 +317,10 @@ tclean(
     imsize    = 2000,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [6.94e-04,6.95e-04,6.96e-04,6.89e-04,6.89e-04,7.09e-04,7.11e-04,7.14e-04,7.22e-04,7.14e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -336,10 +345,10 @@ tclean(
     imsize    = 2400,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.07e-04,7.08e-04,7.05e-04,6.97e-04,6.99e-04,7.17e-04,7.19e-04,7.27e-04,7.37e-04,7.29e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_1.0robust_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -364,10 +373,10 @@ tclean(
     imsize    = 2700,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.26e-04,7.27e-04,7.24e-04,7.16e-04,7.17e-04,7.34e-04,7.38e-04,7.45e-04,7.56e-04,7.49e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.8robust_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -392,10 +401,10 @@ tclean(
     imsize    = 2880,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.40e-04,7.42e-04,7.36e-04,7.27e-04,7.30e-04,7.47e-04,7.51e-04,7.62e-04,7.76e-04,7.68e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.7robust_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -420,10 +429,10 @@ tclean(
     imsize    = 3600,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.86e-04,7.84e-04,7.80e-04,7.74e-04,7.77e-04,7.93e-04,8.00e-04,8.13e-04,8.24e-04,8.14e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.5robust_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -433,9 +442,16 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #rms: 7.93e-01 mJy/beam
 #Peak SNR: 5.60
 
+#The Keplerian masks are computed on the tclean grid from the MS phase centre (no dirty cube, no prior image needed)
+#and cached in keplerian_mask_cache/; the beams are read from the headers of the corresponding images without the
+#Keplerian mask
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.021875arcsec',imsize=1200,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -451,10 +467,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [8.14e-04,8.15e-04,8.24e-04,8.16e-04,8.11e-04,8.51e-04,8.42e-04,8.36e-04,8.42e-04,8.28e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -465,8 +481,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 10.78
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.016625arcsec',imsize=1600,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -482,10 +502,10 @@ tclean(
     imsize    = 1600,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.34e-04,7.36e-04,7.40e-04,7.32e-04,7.30e-04,7.56e-04,7.53e-04,7.53e-04,7.61e-04,7.50e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -496,8 +516,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 10.33
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.013125arcsec',imsize=2000,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -512,10 +536,10 @@ tclean(
     imsize    = 2000,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [6.95e-04,6.96e-04,6.97e-04,6.90e-04,6.89e-04,7.09e-04,7.11e-04,7.15e-04,7.24e-04,7.15e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -526,8 +550,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 9.15
 
 imagename = vis_SO[:-3]+'.contsub_image_1.0robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.011625arcsec',imsize=2400,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -543,10 +571,10 @@ tclean(
     imsize    = 2400,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.08e-04,7.09e-04,7.06e-04,6.98e-04,6.99e-04,7.17e-04,7.20e-04,7.28e-04,7.38e-04,7.31e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_1.0robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -557,8 +585,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 7.95
 
 imagename = vis_SO[:-3]+'.contsub_image_0.8robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.0105arcsec',imsize=2880,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -574,10 +606,10 @@ tclean(
     imsize    = 2880,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.27e-04,7.26e-04,7.23e-04,7.16e-04,7.17e-04,7.34e-04,7.37e-04,7.48e-04,7.59e-04,7.49e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.8robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -588,8 +620,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 6.84
 
 imagename = vis_SO[:-3]+'.contsub_image_0.7robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=2.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.00975arcsec',imsize=2880,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=2.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -605,10 +641,10 @@ tclean(
     imsize    = 2880,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.42e-04,7.43e-04,7.37e-04,7.28e-04,7.31e-04,7.47e-04,7.52e-04,7.63e-04,7.77e-04,7.69e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.7robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -619,8 +655,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 6.42
 
 imagename = vis_SO[:-3]+'.contsub_image_0.5robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=-36.2, PA=235., mstar=1.4, dist=149., vlsr=6.2e3, nbeams=2.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.008375arcsec',imsize=3600,beam=get_image_header(imagename[:-9]+'.image')['beam'],outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=-36.2,PA=235.,mstar=1.4,dist=149.,vlsr=6.2e3,nbeams=2.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -636,10 +676,10 @@ tclean(
     imsize    = 3600,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [4,5,6,7,8,16,17,18,19,20]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [7.91e-04,7.86e-04,7.78e-04,7.73e-04,7.78e-04,7.92e-04,7.99e-04,8.11e-04,8.25e-04,8.17e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.5robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -666,16 +706,27 @@ imagenames = [
     '0.5robust_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask',
 ]
 
+#All the moment maps of each cube and their noise in a single read of the cube: the clipped M0 and M8 over all
+#channels and, without clipping, over the channels with the line emission (the ones whose rms is printed above)
+bestchans = [4,5,6,7,8,16,17,18,19,20]
+moment_products = {**default_moment_products,**bestchans_moment_products(bestchans)}
+moments = {}
+for _fname in imagenames:
+    moments[_fname] = compute_moments(
+        imagename     = f'{vis_SO[:-3]}.contsub_image_{_fname}.image',
+        products      = moment_products,
+        noise_annulus = noise_annulus,
+        output_folder = {0:'./integrated_intensity_8.0ppb_fewchans_new',8:'./peak_intensity_8.0ppb_fewchans_new'},
+    )
+
 for _fname in imagenames:
-    imagename = f'./integrated_intensity_8.0ppb_fewchans_new/CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M0.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam m/s
-    print('#rms_ii: %.2e Jy/beam m/s' %rms)
+    print('#rms_ii: %.2e Jy/beam m/s' %moments[_fname]['M0_rms'])
+    print('#bestchans rms_ii: %.2e Jy/beam m/s' %moments[_fname]['M0_bestchans_rms'])
 
 #rms_bestchans: 4.67e+00,4.22e+00,3.99e+00,4.07e+00,4.17e+00,4.26e+00,4.52e+00,4.68e+00,4.22e+00,4.00e+00,4.07e+00,4.18e+00,4.26e+00,4.54e+00 Jy/beam m/s
 
 for _fname in imagenames:
-    imagename = f'./peak_intensity_8.0ppb_fewchans_new/CQ_Tau_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M8.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam
-    print('#rms_pi: %.2e Jy/beam' %rms)
+    print('#rms_pi: %.2e Jy/beam' %moments[_fname]['M8_rms'])
+    print('#bestchans rms_pi: %.2e Jy/beam' %moments[_fname]['M8_bestchans_rms'])
 
 #rms_bestchans: 1.52e-03,1.37e-03,1.29e-03,1.31e-03,1.34e-03,1.37e-03,1.45e-03,1.53e-03,1.37e-03,1.29e-03,1.31e-03,1.34e-03,1.37e-03,1.45e-03 Jy/beam
\ No newline at end of file
@@ -33,8 +33,27 @@ sys.path.append(github_path)
 import alignment_default as alignment
 execfile(os.path.join(github_path,'reduction_utils_py3_mpi.py'))
 
+#path to your local copy of this repository (helper modules shipped with these scripts)
+selfcal_utils_path = '/data/beegfs/astro-storage/groups/benisty/frzagaria/selfcal_CQTau_and_MWC758/'
+execfile(os.path.join(selfcal_utils_path,'imaging_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'image_analysis_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'visibility_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'pipeline_utils.py'))
+
 prefix = 'MWC_758'
 
+#Time every CASA task and helper call (wall/CPU time, peak memory, I/O), per stage
+profile_tasks(trace_prefix=f'{prefix}_profile')
+#Serial tclean calls that only read their MS (savemodel='none') read it from node-local scratch, copied once for all
+#the major cycles and the following images of the same MS
+scratch_tasks()
+#Store the estimate_SNR/imstat/gaincal/alignment/flux scale results in results_store, queried for the thresholds
+record_task_results()
+#List the products of the previous runs that are not registered as intermediates, with their last reader stage
+#(intermediates_lineage): only a report, the intermediates are freed only when registered below
+lineage_report()
+set_profile_stage('0_initial_split')
+
 # System properties.
 incl  = 21.   # deg, from Dong et al. 2018
 PA    = 62.   # deg, from Dong et al. 2018
@@ -102,10 +121,9 @@ for _path, _data, _name, _field, _spw in zip(PL_calibrated_path, PL_calibrated_d
             keepflags  = False, 
         )
 
-        listobs(
+        ms_summary(
             vis       = f'{prefix}_{_name[i]}.ms',
             listfile  = f'{prefix}_{_name[i]}.ms.listobs.txt',
-            overwrite = True,
         )
 
 # spw_sets = {
@@ -210,6 +228,7 @@ def make_figures_folder(folderpath):
     os.mkdir(folderpath)
     return folderpath
 
+set_profile_stage('1_preselfcal_amp')
 preselfcal_amp_figures_folder = get_figures_folderpath('1_preselfcal_amp_figures')
 make_figures_folder(preselfcal_amp_figures_folder)
 
@@ -329,10 +348,9 @@ for params in data_params.values():
 
     avg_cont(ms_dict=params,output_prefix=prefix+'_flagtest',flagchannels=flagchannels_string,contspws=contspws,width_array=np.ones(len(contspws.split(",")),dtype=int))
 
-    listobs(
+    ms_summary(
         vis       = prefix+'_flagtest_'+params['name']+'_initcont.ms',
         listfile  = prefix+'_flagtest_'+params['name']+'_initcont.ms.listobs.txt',
-        overwrite = True,
     )
 
     plot_filename   = prefix+'_flagtest_'+params['name']+'_amp-v-freq_preselfcal.png'
@@ -380,14 +398,11 @@ for params in data_params.values():
     _, idx_key      = params['name'].split('EB')
     contspws        = np.array(params['cont_spws'].split(","),dtype=int)
     
-    chanfreqs = []
-    for spw in contspws:
-        tb.open(params['vis']+'/SPECTRAL_WINDOW')
-        chanfreqs.append(np.amin(tb.getcol('CHAN_FREQ', startrow=spw, nrow=1)[:,0]))
-        tb.close()
+    #Spw frequencies and baseline lengths from the MS metadata index (one msmd pass per MS, then cached)
+    chanfreqs = [np.amin(ms_chan_freqs(params['vis'],spw)) for spw in contspws]
 
     ref_freq     = np.amin(chanfreqs)
-    max_baseline = au.getBaselineLengths(params['vis'])[-1][1]
+    max_baseline = ms_max_baseline(params['vis'])
     
     max_chan_width.append(delta_freq_smearing(max_baseline=max_baseline,ref_freq=ref_freq/1e9))
 
@@ -432,10 +447,9 @@ for params in data_params.values():
 for baseline_key,n_EB in number_of_EBs.items():
     for i in range(n_EB):
         vis = f'{prefix}_{baseline_key}_EB{i}_initcont.ms'
-        listobs(
+        ms_summary(
             vis       = vis,
             listfile  = f'{vis}.listobs.txt',
-            overwrite = True,
         )
 
 # for params in data_params.values():
@@ -451,6 +465,7 @@ for baseline_key,n_EB in number_of_EBs.items():
 # Flagchannels input string for SB_EB0: '0:837~3005, 2:794~3043, 3:788~3056'
 # Flagchannels input string for SB_EB1: '0:837~3005, 2:794~3043, 3:788~3056'
 
+set_profile_stage('2_preselfcal_initcont_amp')
 preselfcal_initcont_amp_folder = get_figures_folderpath('2_preselfcal_initcont_amp_figures')
 make_figures_folder(preselfcal_initcont_amp_folder)
 
@@ -556,6 +571,7 @@ thresholds = {
 
 image_png_plot_sizes = [3,10] #sizes in arcsec of the zoomed and overview plots of the pngs
 
+set_profile_stage('3_preselfcal_images')
 preselfcal_images_png_folder = get_figures_folderpath('3_preselfcal_images')
 make_figures_folder(preselfcal_images_png_folder)
 
@@ -582,10 +598,10 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
             parallel       = use_parallel,
             savemodel      = 'modelcolumn',
         )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
+        estimate_SNR_cached(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
+        rms = region_statistics(f'{imagename}.image',noise_annulus)['rms']
         p['rms'] = rms
-        generate_image_png(
+        render_image_png(
             image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
             color_scale_limits=[-3*rms,10*rms],
             save_folder=preselfcal_images_png_folder
@@ -660,6 +676,7 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
 single_EB_contspws = '0~3'
 single_EB_spw_mapping = [0,0,0,0]
 
+set_profile_stage('4_individual_EB_selfcal_and_shift')
 individual_EB_selfcal_shift_folder = get_figures_folderpath('4_individual_EB_selfcal_and_shift_figures')
 make_figures_folder(individual_EB_selfcal_shift_folder)
 
@@ -727,10 +744,10 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
             parallel       = use_parallel,
             savemodel      = 'modelcolumn',
         )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
+        estimate_SNR_cached(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
+        rms = region_statistics(f'{imagename}.image',noise_annulus)['rms']
         p['rms'] = rms
-        generate_image_png(
+        render_image_png(
             image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
             color_scale_limits=[-3*rms,10*rms],
             save_folder=individual_EB_selfcal_shift_folder
@@ -807,9 +824,8 @@ for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
         ref_image = f'{prefix}_{baseline_key}_EB0_initcont_selfcal_image.image'
         ref_rms = params[f'{baseline_key}0']['rms']
         ratio_image = imagename+'.ratio'
-        os.system(f'rm -rf {ratio_image}')
-        immath(imagename=[ref_image,imagename+'.image'],mode='evalexpr',outfile=ratio_image,expr=f'iif(IM0 > 3*{ref_rms}, IM1/IM0, 0)')
-        generate_image_png(
+        image_ratio(ref_image,imagename+'.image',threshold=3*ref_rms,size=2*mask_semimajor,outfile=ratio_image)
+        render_image_png(
             ratio_image,plot_sizes=[2*mask_semimajor,2*mask_semimajor],
             color_scale_limits=[0.5,1.5],image_units='ratio',
             save_folder=individual_EB_selfcal_shift_folder
@@ -920,12 +936,16 @@ for shifted_ms in shifted_LB_EBs:
 #Merge shifted LB EBs for aligning SB EBs
 LB_concat_shifted = f'{prefix}_LB_concat_shifted.ms'
 os.system(f'rm -rf {LB_concat_shifted}')
-concat(
+#virtual_concat builds a multi-MS over the EBs, used in the same way by gaincal/applycal/split/tclean (materialize=True
+#for a physical concat); keepcopy=False moves dedicated inputs into it without any copy, keepcopy=True copies inputs still needed
+#The selfcal splits of a multi-MS keep it as a multi-MS (keepmms=True), the delivered products are written as plain MS (keepmms=False)
+#keepcopy=True: the shifted EBs are renamed after the alignment check
+virtual_concat(
     vis=shifted_LB_EBs,concatvis=LB_concat_shifted,
     dirtol='0.1arcsec',freqtol='2.0GHz',
-    copypointing=False
+    copypointing=False,keepcopy=True
 )
-listobs(vis=LB_concat_shifted,listfile=f'{LB_concat_shifted}.listobs.txt',overwrite=True)
+ms_summary(vis=LB_concat_shifted,listfile=f'{LB_concat_shifted}.listobs.txt')
 
 #Align SB EBs to concat shifted LB EBs
 reference_for_SB_alignment = LB_concat_shifted
@@ -1015,177 +1035,15 @@ for params in data_params_SB.values():
 for shifted_EB in shifted_LB_EBs+shifted_SB_EBs:
     os.system('mv {} {}'.format(shifted_EB, shifted_EB.replace('_selfcal', '')))
 
-#Check that the images are indeed aligned after the shift
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for EB_key,p in params.items():
-        os.system(f'rm -rf '+prefix+'_'+p['name']+'_initcont_shift_image*')
-        _, idx_key    = p['name'].split('EB')
-
-        imagename = prefix+'_'+p['name']+'_initcont_shift_image'
-        tclean_wrapper(
-            vis            = prefix+'_'+p['name']+'_initcont_shift.ms',
-            imagename      = imagename,
-            # deconvolver    = 'hogbom',
-            deconvolver    = 'multiscale',
-            scales         = scales[baseline_key],
-            smallscalebias = 0.6,                  #Default from Cornwell et al. (2008) and in CASA 5.5 (biases to smaller scales)
-            gain           = 0.3,                  #Default in DSHARP and exoALMA
-            cycleniter     = 300,                  #Default in DSHARP and exoALMA
-            niter          = 1000000,
-            mask           = mask,
-            threshold      = thresholds[baseline_key][int(idx_key)],
-            cellsize       = cellsize[baseline_key],
-            imsize         = imsize[baseline_key],
-            parallel       = use_parallel,
-            savemodel      = 'modelcolumn',
-        )
-        estimate_SNR(f'{imagename}.image',disk_mask=mask,noise_mask=noise_annulus)
-        rms = imstat(imagename=f'{imagename}.image',region=noise_annulus)['rms'][0]
-        p['rms'] = rms
-        generate_image_png(
-            image=f'{imagename}.image',plot_sizes=image_png_plot_sizes,
-            color_scale_limits=[-3*rms,10*rms],
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-
-#MWC_758_LB_EB0_initcont_shift_1024pixs_image.image
-#Beam 0.030 arcsec x 0.019 arcsec (-12.89 deg)
-#Flux inside disk mask: 5.05 mJy
-#Peak intensity of source: 0.24 mJy/beam
-#rms: 1.33e-02 mJy/beam
-#Peak SNR: 18.39
-
-#MWC_758_LB_EB1_initcont_shift_1024pixs_image.image
-#Beam 0.036 arcsec x 0.019 arcsec (-36.40 deg)
-#Flux inside disk mask: 3.88 mJy
-#Peak intensity of source: 0.21 mJy/beam
-#rms: 1.50e-02 mJy/beam
-#Peak SNR: 13.84
-
-#MWC_758_LB_EB2_initcont_shift_1024pixs_image.image
-#Beam 0.030 arcsec x 0.019 arcsec (14.36 deg)
-#Flux inside disk mask: 1.81 mJy
-#Peak intensity of source: 0.25 mJy/beam
-#rms: 1.93e-02 mJy/beam
-#Peak SNR: 13.11
-
-#MWC_758_LB_EB3_initcont_shift_1024pixs_image.image
-#Beam 0.039 arcsec x 0.022 arcsec (16.03 deg)
-#Flux inside disk mask: 13.70 mJy
-#Peak intensity of source: 0.36 mJy/beam
-#rms: 2.51e-02 mJy/beam
-#Peak SNR: 14.51
-
-#MWC_758_LB_EB4_initcont_shift_1024pixs_image.image
-#Beam 0.035 arcsec x 0.023 arcsec (-7.27 deg)
-#Flux inside disk mask: 13.48 mJy
-#Peak intensity of source: 0.38 mJy/beam
-#rms: 3.24e-02 mJy/beam
-#Peak SNR: 11.57
-
-#MWC_758_SB_EB0_initcont_shift_1024pixs_image.image
-#Beam 0.155 arcsec x 0.108 arcsec (-11.28 deg)
-#Flux inside disk mask: 48.03 mJy
-#Peak intensity of source: 3.21 mJy/beam
-#rms: 3.35e-02 mJy/beam
-#Peak SNR: 95.95
-
-#MWC_758_SB_EB1_initcont_shift_1024pixs_image.image
-#Beam 0.234 arcsec x 0.153 arcsec (-41.10 deg)
-#Flux inside disk mask: 58.62 mJy
-#Peak intensity of source: 5.76 mJy/beam
-#rms: 3.49e-02 mJy/beam
-#Peak SNR: 164.84
-
-#MWC_758_SB_EB2_initcont_shift_1024pixs_image.image
-#Beam 0.201 arcsec x 0.157 arcsec (-31.14 deg)
-#Flux inside disk mask: 54.97 mJy
-#Peak intensity of source: 5.41 mJy/beam
-#rms: 3.35e-02 mJy/beam
-#Peak SNR: 161.32
-
-#MWC_758_SB_EB3_initcont_shift_1024pixs_image.image
-#Beam 0.201 arcsec x 0.157 arcsec (-28.55 deg)
-#Flux inside disk mask: 57.92 mJy
-#Peak intensity of source: 5.72 mJy/beam
-#rms: 2.67e-02 mJy/beam
-#Peak SNR: 214.05
-
-for baseline_key,params in zip(('LB','SB'),(data_params_LB,data_params_SB)):
-    for p in params.values():
-        imagename = prefix+'_'+p['name']+'_initcont_shift_image'
-        #ratio image, to be compared to the ratio image after alignment
-        ref_image = f'{prefix}_{baseline_key}_EB0_initcont_shift_image.image'
-        ref_rms = params[f'{baseline_key}0']['rms']
-        ratio_image = imagename+'.ratio'
-        os.system(f'rm -rf {ratio_image}')
-        immath(imagename=[ref_image,imagename+'.image'],mode='evalexpr',outfile=ratio_image,expr=f'iif(IM0 > 3*{ref_rms}, IM1/IM0, 0)')
-        generate_image_png(
-            ratio_image,plot_sizes=[2*mask_semimajor,2*mask_semimajor],
-            color_scale_limits=[0.5,1.5],image_units='ratio',
-            save_folder=individual_EB_selfcal_shift_folder
-        )
-#By checking the different images in casaviewer, the alignment of some EBs improved, for others LB_EB2 and SB_EB2 it didn't
-
-for i,params in enumerate(data_params_LB.values()):
-    print('#'+params['name'])
-    mask = f"ellipse[[{mask_ra},{mask_dec}], [{mask_semimajor:.3f}arcsec, {mask_semiminor:.3f}arcsec], {mask_pa:.1f}deg]"
-    
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_selfcal_image.image',region=mask)
-
-    #LB_EB0, 05h30m27.519563s +25d19m57.07381s
-    #Pixel coordinates of peak: x = 10111.062 y = 10229.153
-    #LB_EB1, 05h30m27.518385s +25d19m57.06236s
-    #Pixel coordinates of peak: x = 10119.050 y = 10223.432
-    #LB_EB2, 05h30m27.518407s +25d19m57.07056s
-    #Pixel coordinates of peak: x = 10118.897 y = 10227.562
-    #LB_EB3, 05h30m27.518816s +25d19m57.06485s
-    #Pixel coordinates of peak: x = 10116.091 y = 10224.847
-    #LB_EB4, 05h30m27.519260s +25d19m57.05768s
-    #Pixel coordinates of peak: x = 10113.079 y = 10221.300
-    
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_shift_image.image',region=mask)
-
-    #LB_EB0, 05h30m27.520036s +25d19m57.06502s
-    #Pixel coordinates of peak: x = 10120.681 y = 10234.042
-    #LB_EB1, 05h30m27.518671s +25d19m57.04264s
-    #Pixel coordinates of peak: x = 10129.940 y = 10222.849
-    #LB_EB2, 05h30m27.519467s +25d19m57.06156s
-    #Pixel coordinates of peak: x = 10124.542 y = 10232.309
-    #LB_EB3, 05h30m27.520220s +25d19m57.06252s
-    #Pixel coordinates of peak: x = 10119.438 y = 10232.790
-    #LB_EB4, 05h30m27.519858s +25d19m57.06106s
-    #Pixel coordinates of peak: x = 10121.890 y = 10232.059
- 
-    #Differences are huge (but also Gaussians on such a low SNR asymmetric disc... don't know how reliable...)!
-
-for i,params in enumerate(data_params_SB.values()):
-    print('#'+params['name'])
-    mask = f"ellipse[[{mask_ra},{mask_dec}], [{mask_semimajor:.3f}arcsec, {mask_semiminor:.3f}arcsec], {mask_pa:.1f}deg]"
-
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_selfcal_image.image',region=mask)
-
-    #SB_EB0, 05h30m27.523115s +25d19m56.85150s
-    #Pixel coordinates of peak: x = 1812.284 y = 1817.167
-    #SB_EB1, 05h30m27.524016s +25d19m56.79284s
-    #Pixel coordinates of peak: x = 1811.384 y = 1813.020
-    #SB_EB2, 05h30m27.518972s +25d19m56.94008s
-    #Pixel coordinates of peak: x = 1816.234 y = 1823.590
-    #SB_EB3, 05h30m27.522873s +25d19m56.80906s
-    #Pixel coordinates of peak: x = 1812.454 y = 1814.237
-
-    fit_gaussian(prefix+'_'+params['name']+'_initcont_shift_image.image',region=mask)
-
-    #SB_EB0, 05h30m27.523645s +25d19m56.87042s
-    #Pixel coordinates of peak: x = 1813.745 y = 1819.534
-    #SB_EB1, 05h30m27.523252s +25d19m56.83625s
-    #Pixel coordinates of peak: x = 1814.126 y = 1817.094
-    #SB_EB2, 05h30m27.522646s +25d19m56.90281s
-    #Pixel coordinates of peak: x = 1814.713 y = 1821.848
-    #SB_EB3, 05h30m27.524017s +25d19m56.83294s
-    #Pixel coordinates of peak: x = 1813.385 y = 1816.857
-
-    #Differences are sub-pixels in the x-direction but significant in the y-direction!
+#Check the alignment from the existing self-calibrated images of all EBs instead of re-imaging every shifted EB and
+#comparing fit_gaussian peaks before and after the shift (whose differences were not reliable on the low SNR LB EBs):
+#FFT cross-correlation of the masked images, minus the shifts the alignment would apply (residual offsets after the shift)
+EB_names = [params['name'] for params in data_params.values()]
+alignment_region = f"ellipse[[{mask_ra},{mask_dec}], [{mask_semimajor:.3f}arcsec, {mask_semiminor:.3f}arcsec], {mask_pa:.1f}deg]"
+alignment_check = image_alignment_offsets(
+    [prefix+'_'+name+'_initcont_selfcal_image.image' for name in EB_names],region=alignment_region,
+    applied_offsets=[alignment_offsets[name] for name in EB_names],reference=EB_names.index('LB_EB0')
+)
 
 #Chose not to apply the shift because it artificially increases the offset between EBs (regardless of npix, and number of spws included)
 #likely due to the very low SNR of the LB EBs
@@ -1201,6 +1059,7 @@ list_npz_files = []
 for baseline_key,n_EB in number_of_EBs.items():
     list_npz_files += [f'{prefix}_{baseline_key}_EB{i}_initcont_selfcal.vis.npz' for i in range(n_EB)] #list_npz_files += [f'{prefix}_{baseline_key}_EB{i}_initcont_shift.vis.npz' for i in range(n_EB)]
 
+set_profile_stage('5_deprojected_vis_profiles')
 deprojected_vis_profiles_folder = get_figures_folderpath('5_deprojected_vis_profiles')
 make_figures_folder(deprojected_vis_profiles_folder)
 
@@ -1211,6 +1070,18 @@ plot_deprojected(
     plot_label=os.path.join(deprojected_vis_profiles_folder,f'{prefix}_flux_scale_EB_preselfcal.png')
 )
 
+#Fit the disk geometry from the deprojected profile of all EBs, to compare with the literature incl/PA (21/62 deg)
+#The EBs are divided by their flux ratios to SB_EB3 (from estimate_flux_scale below), since they are not rescaled yet
+flux_ratios_preselfcal = {
+    'LB_EB0':0.95742,'LB_EB1':0.93723,'LB_EB2':0.90976,'LB_EB3':1.01642,'LB_EB4':1.11297,
+    'SB_EB0':0.88668,'SB_EB1':0.98104,'SB_EB2':0.93757,'SB_EB3':1.,
+}
+geometry = fit_disk_geometry(
+    list_npz_files,
+    fluxscale=[flux_ratios_preselfcal[f'{baseline_key}_EB{i}'] for baseline_key,n_EB in number_of_EBs.items() for i in range(n_EB)]
+)
+
+set_profile_stage('6_flux_comparisons')
 flux_comparison_folder = get_figures_folderpath('6_flux_comparisons')
 make_figures_folder(flux_comparison_folder)
 
@@ -1228,6 +1099,14 @@ make_figures_folder(flux_comparison_folder)
 
 flux_ref_EB = 'SB_EB3' 
 
+#Joint fit of offset, flux scale and decoherence of every EB against the gridded reference visibilities
+#(no imaging needed; cross-check of find_offset and of the estimate_flux_scale ratios below)
+vis_fit = fit_vis_offsets_fluxscale(
+    reference=f'{prefix}_{flux_ref_EB}_initcont_selfcal.vis.npz',
+    comparisons=[prefix+'_'+params['name']+'_initcont_selfcal.vis.npz' for params in data_params.values() if params['name'] != flux_ref_EB],
+    fit_decoherence=True
+)
+
 for params in data_params.values():
     plot_label = os.path.join(flux_comparison_folder,'flux_comparison_'+params['name']+f'_to_{flux_ref_EB}.png')
     estimate_flux_scale(
@@ -1340,16 +1219,18 @@ for params in data_params.values():
 
 #Begin of SB self-cal - iteration 1
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('7_selfcal_SB')
 SB_selfcal_folder = get_figures_folderpath('7_selfcal_SB_figures')
 make_figures_folder(SB_selfcal_folder)
 
 SB_cont_p0 = prefix+'_SB_contp0'
 os.system('rm -rf %s.ms*' %SB_cont_p0)
-concat(
+#keepcopy=True: the SB EBs are reused for the second selfcal iteration
+virtual_concat(
     vis=[f'{prefix}_SB_EB{i}_initcont_selfcal.ms' for i in range(number_of_EBs['SB'])],#vis=[f'{prefix}_SB_EB{i}_initcont_shift.ms' for i in range(number_of_EBs['SB'])],
-    concatvis=SB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=SB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=True
 )
-listobs(vis=SB_cont_p0+'.ms',listfile=SB_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=SB_cont_p0+'.ms',listfile=SB_cont_p0+'.ms.listobs.txt')
 
 #Define new SB mask using new center read from listobs
 mask_pa        = PA
@@ -1378,9 +1259,9 @@ tclean_wrapper(
     threshold = '0.0960mJy', 
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-rms_SB = imstat(imagename=SB_cont_p0+'.image',region=noise_annulus_SB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(SB_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+rms_SB = region_statistics(SB_cont_p0+'.image',noise_annulus_SB)['rms']
+render_image_png(
     SB_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1421,12 +1302,8 @@ for ref_ant in ('DV08','DA64','DV15','DA60'):
 SB_refant      = 'DV08@A042, DA64@A015, DV15@A047, DA60@A043'
 
 SB_contspws    = '0~15'
-SB_spw_mapping = [
-    0,0,0,0,
-    4,4,4,4,
-    8,8,8,8,
-    12,12,12,12
-]
+#Map every spw onto the first spw of its EB for the combine='spw' solutions ([0]*4+[4]*4+[8]*4+[12]*4)
+SB_spw_mapping = combine_spw_map(SB_cont_p0+'.ms')
 
 #First round of phase-only self-cal
 #NOTE: you need .p1 instead of _p1 in the caltable name if you want flagdata to work (i.e., flagging problematic antennas non interactively)...
@@ -1462,17 +1339,17 @@ applycal(
 )
 SB_cont_p1 = SB_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %SB_cont_p1)
-split(vis=SB_cont_p0+'.ms',outputvis=SB_cont_p1+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p0+'.ms',outputvis=SB_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
     vis       = SB_cont_p1+'.ms',
     imagename = SB_cont_p1,
-    threshold = '0.0918mJy',
+    threshold = threshold_from_results(SB_cont_p0+'.image',factor=6.,default='0.0918mJy'), #6x the p0 rms in the results store
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1520,7 +1397,7 @@ applycal(
 )
 SB_cont_p1_bis = SB_cont_p1.replace('p1','p1_bis')
 os.system('rm -rf %s.ms*' %SB_cont_p1_bis)
-split(vis=SB_cont_p1+'.ms',outputvis=SB_cont_p1_bis+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p1+'.ms',outputvis=SB_cont_p1_bis+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1529,8 +1406,8 @@ tclean_wrapper(
     threshold = '0.0918mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p1_bis+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p1_bis+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p1_bis+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1597,7 +1474,7 @@ applycal(
 )
 SB_cont_p2 = SB_cont_p1_bis.replace('p1_bis','p2')
 os.system('rm -rf %s.ms*' %SB_cont_p2)
-split(vis=SB_cont_p1_bis+'.ms',outputvis=SB_cont_p2+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p1_bis+'.ms',outputvis=SB_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1606,8 +1483,8 @@ tclean_wrapper(
     threshold = '0.0792mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1723,7 +1600,7 @@ applycal(
 )
 SB_cont_p3 = SB_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %SB_cont_p3)
-split(vis=SB_cont_p2+'.ms',outputvis=SB_cont_p3+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p2+'.ms',outputvis=SB_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1732,8 +1609,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -1897,7 +1774,7 @@ applycal(
 )
 SB_cont_p4 = SB_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %SB_cont_p4)
-split(vis=SB_cont_p3+'.ms',outputvis=SB_cont_p4+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p3+'.ms',outputvis=SB_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -1906,8 +1783,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -2467,7 +2344,7 @@ applycal(
 )
 SB_cont_p5 = SB_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %SB_cont_p5)
-split(vis=SB_cont_p4+'.ms',outputvis=SB_cont_p5+'.ms',datacolumn='corrected')
+split(vis=SB_cont_p4+'.ms',outputvis=SB_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2476,8 +2353,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_SB,10*rms_SB],
     save_folder=SB_selfcal_folder
@@ -2523,16 +2400,21 @@ all_SB_visibilities['p0'] = SB_cont_p0
 
 SB_flux_ref_EB = 3 #this is SB_EB3
 
+#Ratio-vs-step table of all EBs: each step is binned once straight from its MS and cached, so re-running after a new
+#selfcal round only bins the new step. Query with flux_ratio_trend(SB_flux_ratio_table)
+SB_flux_ratio_table = prefix+'_SB_flux_ratios.json'
+for self_cal_step,vis_name in {'p0':SB_cont_p0,**self_caled_SB_visibilities}.items():
+    track_flux_ratios(self_cal_step,vis_name+'.ms',SB_flux_ref_EB,incl=incl,PA=PA,table=SB_flux_ratio_table)
+
+#Per-EB exports only for the flux comparison and profile plots of the first and last steps
+SB_flux_plot_steps = ['p0','p5']
+
 for self_cal_step,vis_name in all_SB_visibilities.items():
-    #Split out SB EBs
+    if self_cal_step not in SB_flux_plot_steps:
+        continue
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate) 
-    #Saving observation 0 of MWC_758_SB_contp0.ms to MWC_758_SB_contp0_EB0.ms
-    #Saving observation 1 of MWC_758_SB_contp0.ms to MWC_758_SB_contp0_EB1.ms
-    #...
-    #Saving observation 0 of MWC_758_SB_contp5.ms to MWC_758_SB_contp5_EB0.ms
-    #Saving observation 1 of MWC_758_SB_contp5.ms to MWC_758_SB_contp5_EB1.ms
 
     #If differences in the time intervals corresponding to the different scans... split by scan!
     #for i in range(number_of_EBs['SB']):
@@ -2549,11 +2431,9 @@ for self_cal_step,vis_name in all_SB_visibilities.items():
 
     exported_ms = []
     for i in range(number_of_EBs['SB']):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
         #Measurement set exported to MWC_758_SB_contp0_EB0.vis.npz
         #Measurement set exported to MWC_758_SB_contp0_EB1.vis.npz
         #...
@@ -2586,16 +2466,18 @@ for self_cal_step,vis_name in all_SB_visibilities.items():
 
 #Begin of SB+LB self-cal - iteration 1
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('8_selfcal_SBLB')
 LB_selfcal_folder = get_figures_folderpath('8_selfcal_SBLB_figures')
 make_figures_folder(LB_selfcal_folder)
 
 LB_cont_p0 = prefix+'_SBLB_contp0'
 os.system('rm -rf %s.ms*' %LB_cont_p0)
-concat(
+#keepcopy=True: the LB EBs are reused for the second selfcal iteration
+virtual_concat(
     vis=[SB_cont_p5+'.ms']+[f'{prefix}_LB_EB{i}_initcont_selfcal.ms' for i in range(number_of_EBs['LB'])],#vis=[SB_cont_p5+'.ms']+[f'{prefix}_LB_EB{i}_initcont_shift.ms' for i in range(number_of_EBs['LB'])],
-    concatvis=LB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=LB_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=True
 )
-listobs(vis=LB_cont_p0+'.ms',listfile=LB_cont_p0+'.ms.listobs.txt',overwrite=True)
+ms_summary(vis=LB_cont_p0+'.ms',listfile=LB_cont_p0+'.ms.listobs.txt')
 #2024-12-23 09:24:44     SEVERE  getcell::TIME   Exception Reported: TableProxy::getCell: no such row
 #2024-12-23 09:24:47     WARN    concat::::casa  Some but not all of the input MSs are lacking a populated POINTING table:
 #    0: MWC_758_SB_contp5.ms
@@ -2631,9 +2513,9 @@ tclean_wrapper(
     threshold = '0.0408mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-rms_LB = imstat(imagename=LB_cont_p0+'.image',region=noise_annulus_LB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(LB_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+rms_LB = region_statistics(LB_cont_p0+'.image',noise_annulus_LB)['rms']
+render_image_png(
     LB_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2734,17 +2616,8 @@ for ref_ant in ('PM02','DA50','DV09','DA61', 'DV08','DA64','DV15','DA60'):
 LB_refant = 'PM02@A111, DA50@A108, DV09@A007, DA61@A015, DV08@A042, DA64@A015, DV15@A047, DA60@A043'
 
 LB_contspws    = '0~35'
-LB_spw_mapping = [
-    0,0,0,0,
-    4,4,4,4,
-    8,8,8,8,
-    12,12,12,12,
-    16,16,16,16,
-    20,20,20,20,
-    24,24,24,24,
-    28,28,28,28,
-    32,32,32,32,
-]
+#Map every spw onto the first spw of its EB for the combine='spw' solutions ([0]*4+[4]*4+[8]*4+[12]*4+[16]*4+[20]*4+[24]*4+[28]*4+[32]*4)
+LB_spw_mapping = combine_spw_map(LB_cont_p0+'.ms')
 
 #First round of phase-only self-cal
 #NOTE: you need .p1 instead of _p1 in the caltable name if you want flagdata to work (i.e., flagging problematic antennas non interactively)...
@@ -2801,17 +2674,17 @@ applycal(
 )
 LB_cont_p1 = LB_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %LB_cont_p1)
-split(vis=LB_cont_p0+'.ms',outputvis=LB_cont_p1+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p0+'.ms',outputvis=LB_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
     vis       = LB_cont_p1+'.ms',
     imagename = LB_cont_p1,
-    threshold = '0.0399mJy',
+    threshold = threshold_from_results(LB_cont_p0+'.image',factor=6.,default='0.0399mJy'), #6x the p0 rms in the results store
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2880,7 +2753,7 @@ applycal(
 
 LB_cont_p1_bis = LB_cont_p1.replace('p1','p1_bis')
 os.system('rm -rf %s.ms*' %LB_cont_p1_bis)
-split(vis=LB_cont_p1+'.ms',outputvis=LB_cont_p1_bis+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p1+'.ms',outputvis=LB_cont_p1_bis+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2889,8 +2762,8 @@ tclean_wrapper(
     threshold = '0.0399mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p1_bis+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p1_bis+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p1_bis+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -2985,7 +2858,7 @@ applycal(
 )
 LB_cont_p2 = LB_cont_p1_bis.replace('p1_bis','p2')
 os.system('rm -rf %s.ms*' %LB_cont_p2)
-split(vis=LB_cont_p1_bis+'.ms',outputvis=LB_cont_p2+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p1_bis+'.ms',outputvis=LB_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -2994,8 +2867,8 @@ tclean_wrapper(
     threshold = '0.0396mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -3431,7 +3304,7 @@ applycal(
 )
 LB_cont_p3 = LB_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %LB_cont_p3)
-split(vis=LB_cont_p2+'.ms',outputvis=LB_cont_p3+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p2+'.ms',outputvis=LB_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3440,8 +3313,8 @@ tclean_wrapper(
     threshold = '0.0395mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -3979,7 +3852,7 @@ applycal(
 )
 LB_cont_p4 = LB_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %LB_cont_p4)
-split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -3988,8 +3861,8 @@ tclean_wrapper(
     threshold = '0.0393mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -4984,7 +4857,7 @@ applycal(
 )
 LB_cont_p5 = LB_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %LB_cont_p5)
-split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_p5+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -4993,8 +4866,8 @@ tclean_wrapper(
     threshold = '0.0392mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p5+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -6473,7 +6346,7 @@ applycal(
 )
 LB_cont_p6 = LB_cont_p5.replace('p5','p6')
 os.system('rm -rf %s.ms*' %LB_cont_p6)
-split(vis=LB_cont_p5+'.ms',outputvis=LB_cont_p6+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p5+'.ms',outputvis=LB_cont_p6+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -6482,8 +6355,8 @@ tclean_wrapper(
     threshold = '0.0392mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p6+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p6+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -6498,7 +6371,7 @@ generate_image_png(
 #Maybe worth stopping after p4
 #Check that the applycal p4 -> p5 didn't change the .ms structure (i.e., CLEANing to 6sigma, do I recover the same p5 gain solutions?)
 
-split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p3+'.ms',outputvis=LB_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -6507,8 +6380,8 @@ tclean_wrapper(
     threshold = '0.0393mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -6560,8 +6433,8 @@ tclean_wrapper(
     threshold = '6.49e-03mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -6644,7 +6517,7 @@ applycal(
 )
 LB_cont_ap0 = prefix+'_SBLB_contap0'
 os.system('rm -rf %s.ms*' %LB_cont_ap0)
-split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_ap0+'.ms',datacolumn='corrected')
+split(vis=LB_cont_p4+'.ms',outputvis=LB_cont_ap0+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN with a ~1sigma threshold before amplitude self-cal
 tclean_wrapper(
@@ -6653,8 +6526,8 @@ tclean_wrapper(
     threshold = '6.47e-03mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_cont_ap0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_LB,10*rms_LB],
     save_folder=LB_selfcal_folder
@@ -6708,19 +6581,27 @@ all_LB_visibilities = self_caled_LB_visibilities.copy()
 all_LB_visibilities['p0'] = LB_cont_p0
 
 total_number_of_EBs = number_of_EBs['SB'] + number_of_EBs['LB']
+
+#Ratio-vs-step table of all EBs, binned once per step and cached (see the SB self-cal above)
+LB_flux_ratio_table = prefix+'_SBLB_flux_ratios.json'
+for self_cal_step,vis_name in {'p0':LB_cont_p0,**self_caled_LB_visibilities}.items():
+    track_flux_ratios(self_cal_step,vis_name+'.ms',SBLB_flux_ref_EB,incl=incl,PA=PA,table=LB_flux_ratio_table)
+
+#Per-EB exports only for the flux comparison and profile plots of the first and last steps
+LB_flux_plot_steps = ['p0','ap0']
+
 for self_cal_step,vis_name in all_LB_visibilities.items():
-    #Split out SB EBs
+    if self_cal_step not in LB_flux_plot_steps:
+        continue
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(total_number_of_EBs):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz'))
 
     for i,exp_ms in enumerate(exported_ms):
         png_filename = f'flux_comparison_EB{i}_to_EB{SBLB_flux_ref_EB}'+f'_SBLB_{self_cal_step}.png'
@@ -6734,6 +6615,21 @@ for self_cal_step,vis_name in all_LB_visibilities.items():
     plot_label = os.path.join(LB_selfcal_folder,f'deprojected_vis_profiles_SBLB_{self_cal_step}.png')
     plot_deprojected(filelist=exported_ms,fluxscale=fluxscale,PA=PA,incl=incl,show_err=True,plot_label=plot_label)
 
+#Confidence intervals of all the EB flux ratios at every selfcal step in one call (bootstrap over uv bins and
+#azimuthal sectors), to decide the >4% rescalings without relying on the absolute scale of the weights.
+#The binned profiles of every step come from the cache filled by track_flux_ratios above, so no per-EB export is needed
+step_profiles = {
+    self_cal_step:step_binned_profiles(self_cal_step,vis_name+'.ms',incl=incl,PA=PA)
+    for self_cal_step,vis_name in {'p0':LB_cont_p0,**self_caled_LB_visibilities}.items()
+}
+flux_scale_intervals = bootstrap_flux_scale(
+    {
+        (self_cal_step,i):((S[i],W[i]),(S[SBLB_flux_ref_EB],W[SBLB_flux_ref_EB]))
+        for self_cal_step,(S,W) in step_profiles.items() for i in range(total_number_of_EBs) if i != SBLB_flux_ref_EB
+    },
+    incl=incl,PA=PA
+)
+
 #Redo the flux comparison images without the uvbins parameters, to have clearer plots
 #for self_cal_step,vis in self_caled_LB_visibilities.items():
 #    nametemplate = f'{prefix}_SBLB_cont{self_cal_step}_EB'
@@ -6798,7 +6694,7 @@ for self_cal_step,vis_name in all_LB_visibilities.items():
 for baseline_key,n_EB in number_of_EBs.items():
     for i in range(n_EB):
         vis = f'{prefix}_{baseline_key}_EB{i}_initcont_selfcal.ms'#vis = f'{prefix}_{baseline_key}_EB{i}_initcont_shift.ms'
-        listobs(vis=vis,listfile=f'{vis}.listobs.txt',overwrite=True)
+        ms_summary(vis=vis,listfile=f'{vis}.listobs.txt')
 
 flux_ref_EB = 'SB_EB3' 
 for params in data_params.values():
@@ -6872,36 +6768,14 @@ for params in data_params.values():
 # Measurement set exported to CQ_Tau_SB_EB0_initcont_shift_rescaled.vis.npz
 
 # Rescale the LBs
+#The flux scales are recorded and applied on read (exported visibilities, flux comparison) and as a pre-applied
+#gencal table at the start of the next selfcal, instead of splitting out and re-exporting _rescaled.ms copies
 for i,gencalpar in enumerate([1.017,1.034,0.972,1.029,1.036]): #[0.995,1.029,0.970,1.030,1.031]
-    os.system('rm -rf '+prefix+f'_LB_EB{i}_initcont_selfcal_rescaled.ms')
-    rescale_flux(vis=prefix+f'_LB_EB{i}_initcont_selfcal.ms', gencalparameter=[gencalpar])
-    #Splitting out rescaled values into new MS: MWC_758_SB_LB0_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_LB1_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_LB2_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_LB3_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_LB4_initcont_selfcal_rescaled.ms
-    listobs(vis=prefix+f'_LB_EB{i}_initcont_selfcal_rescaled.ms',listfile=prefix+f'_LB_EB{i}_initcont_selfcal_rescaled.ms.listobs.txt',overwrite=True)
-
-    export_MS(prefix+f'_LB_EB{i}_initcont_selfcal_rescaled.ms')
-    #Measurement set exported to MWC_758_SB_EB0_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB1_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB2_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB3_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB4_initcont_selfcal_rescaled.vis.npz
+    set_flux_scale(prefix+f'_LB_EB{i}_initcont_selfcal.ms',gencalparameter=[gencalpar])
 
 # Rescale the SBs
 for i,gencalpar in enumerate([0.996,0.994,0.998]):
-    os.system('rm -rf '+prefix+f'_SB_EB{i}_initcont_selfcal_rescaled.ms')
-    rescale_flux(vis=prefix+f'_SB_EB{i}_initcont_selfcal.ms', gencalparameter=[gencalpar])
-    #Splitting out rescaled values into new MS: MWC_758_SB_EB0_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_EB1_initcont_selfcal_rescaled.ms
-    #Splitting out rescaled values into new MS: MWC_758_SB_EB2_initcont_selfcal_rescaled.ms
-    listobs(vis=prefix+f'_SB_EB{i}_initcont_selfcal_rescaled.ms',listfile=prefix+f'_SB_EB{i}_initcont_selfcal_rescaled.ms.listobs.txt',overwrite=True)
-
-    export_MS(prefix+f'_SB_EB{i}_initcont_selfcal_rescaled.ms')
-    #Measurement set exported to MWC_758_SB_EB0_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB1_initcont_selfcal_rescaled.vis.npz
-    #Measurement set exported to MWC_758_SB_EB2_initcont_selfcal_rescaled.vis.npz
+    set_flux_scale(prefix+f'_SB_EB{i}_initcont_selfcal.ms',gencalparameter=[gencalpar])
 
 # output = f'flux_comparison_LB_EB{i}_rescaled_to_SB_EB3.png'
 # plot_label = os.path.join(LB_selfcal_folder,output)
@@ -6928,7 +6802,7 @@ for params in data_params.values():
     else:
         estimate_flux_scale(
             reference=f'{prefix}_{flux_ref_EB}_initcont_selfcal.vis.npz',
-            comparison=prefix+'_'+params['name']+'_initcont_selfcal_rescaled.vis.npz',
+            comparison=scaled_vis_npz(prefix+'_'+params['name']+'_initcont_selfcal.vis.npz'),
             incl=incl,PA=PA,plot_label=plot_label
         )
 
@@ -6988,21 +6862,25 @@ for params in data_params.values():
 
 #Begin of SB self-cal - iteration 2
 #For phase self-cal, clean down to ~6sigma
+set_profile_stage('7.1_selfcal_SB_iteration2')
 SB_selfcal_iteration2_folder = get_figures_folderpath('7.1_selfcal_SB_iteration2_figures')
 make_figures_folder(SB_selfcal_iteration2_folder)
 
 SB_iteration2_cont_p0 = prefix+'_SB_iteration2_contp0'
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p0)
-concat(
-    vis=[
-        f'{prefix}_SB_EB0_initcont_selfcal_rescaled.ms',#f'{prefix}_SB_EB0_initcont_shift_rescaled.ms',
-        f'{prefix}_SB_EB1_initcont_selfcal_rescaled.ms',#f'{prefix}_SB_EB1_initcont_shift_rescaled.ms',
-        f'{prefix}_SB_EB2_initcont_selfcal_rescaled.ms',#f'{prefix}_SB_EB2_initcont_shift_rescaled.ms',
-        f'{prefix}_SB_EB3_initcont_selfcal.ms',#f'{prefix}_SB_EB3_initcont_shift.ms',
-    ],
-    concatvis=SB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
-)
-listobs(vis=SB_iteration2_cont_p0+'.ms',listfile=SB_iteration2_cont_p0+'.ms.listobs.txt',overwrite=True)
+SB_iteration2_EBs = [
+    f'{prefix}_SB_EB0_initcont_selfcal.ms',#f'{prefix}_SB_EB0_initcont_shift.ms',
+    f'{prefix}_SB_EB1_initcont_selfcal.ms',#f'{prefix}_SB_EB1_initcont_shift.ms',
+    f'{prefix}_SB_EB2_initcont_selfcal.ms',#f'{prefix}_SB_EB2_initcont_shift.ms',
+    f'{prefix}_SB_EB3_initcont_selfcal.ms',#f'{prefix}_SB_EB3_initcont_shift.ms',
+]
+SB_iteration2_obs_scales = concat_flux_scales(SB_iteration2_EBs) #read before the EBs are moved into the multi-MS
+#keepcopy=False: last use of these EBs, they are moved into the multi-MS without copying the data (flux scales read before)
+virtual_concat(vis=SB_iteration2_EBs,concatvis=SB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False)
+ms_summary(vis=SB_iteration2_cont_p0+'.ms',listfile=SB_iteration2_cont_p0+'.ms.listobs.txt')
+#Apply the recorded flux scales on the fly: CORRECTED_DATA for the p0 image, pre-applied table in the first gaincal/applycal
+SB_iteration2_fluxscale = flux_scale_caltable(SB_iteration2_cont_p0+'.ms',obs_scales=SB_iteration2_obs_scales)
+applycal(vis=SB_iteration2_cont_p0+'.ms',gaintable=[SB_iteration2_fluxscale],calwt=True,applymode='calonly')
 #2025-01-29 06:42:49     WARN    concat::::casa  The setup of the input MSs is not fully consistent. The concatenation may fail
 #2025-01-29 06:42:49     WARN    concat::::casa  and/or the affected columns may contain partially only default data.
 #2025-01-29 06:42:49     WARN    concat::::casa  
@@ -7035,9 +6913,9 @@ tclean_wrapper(
     threshold = '0.0960mJy', 
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-rms_iteration2_SB = imstat(imagename=SB_iteration2_cont_p0+'.image',region=noise_annulus_SB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p0+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+rms_iteration2_SB = region_statistics(SB_iteration2_cont_p0+'.image',noise_annulus_SB)['rms']
+render_image_png(
     SB_iteration2_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -7063,7 +6941,7 @@ os.system('rm -rf '+SB_iteration2_p1)
 gaincal(
     vis=SB_iteration2_cont_p0+'.ms',caltable=SB_iteration2_p1,
     gaintype='G',combine='scan,spw',calmode='p',solint='inf',
-    spw=SB_contspws,refant=SB_refant,
+    spw=SB_contspws,refant=SB_refant,gaintable=[SB_iteration2_fluxscale],
     minsnr=3.,minblperant=4
 )
 
@@ -7085,12 +6963,12 @@ plotms(
 
 #Apply the calibration gains and split-off the corrected ms
 applycal(
-    vis=SB_iteration2_cont_p0+'.ms',spw=SB_contspws,spwmap=SB_spw_mapping,
-    gaintable=[SB_iteration2_p1],interp='linearPD',calwt=True,applymode='calonly'
+    vis=SB_iteration2_cont_p0+'.ms',spw=SB_contspws,spwmap=[[],SB_spw_mapping],
+    gaintable=[SB_iteration2_fluxscale,SB_iteration2_p1],interp=['nearest','linearPD'],calwt=True,applymode='calonly'
 )
 SB_iteration2_cont_p1 = SB_iteration2_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p1)
-split(vis=SB_iteration2_cont_p0+'.ms',outputvis=SB_iteration2_cont_p1+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p0+'.ms',outputvis=SB_iteration2_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -7099,8 +6977,8 @@ tclean_wrapper(
     threshold = '0.0924mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p1+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -7155,7 +7033,7 @@ applycal(
 )
 SB_iteration2_cont_p1_bis = SB_iteration2_cont_p1.replace('p1','p1_bis')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p1_bis)
-split(vis=SB_iteration2_cont_p1+'.ms',outputvis=SB_iteration2_cont_p1_bis+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p1+'.ms',outputvis=SB_iteration2_cont_p1_bis+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -7164,8 +7042,8 @@ tclean_wrapper(
     threshold = '0.0918mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p1_bis+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p1_bis+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p1_bis+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -7239,7 +7117,7 @@ applycal(
 )
 SB_iteration2_cont_p2 = SB_iteration2_cont_p1_bis.replace('p1_bis','p2')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p2)
-split(vis=SB_iteration2_cont_p1_bis+'.ms',outputvis=SB_iteration2_cont_p2+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p1_bis+'.ms',outputvis=SB_iteration2_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -7248,8 +7126,8 @@ tclean_wrapper(
     threshold = '0.0792mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p2+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -7372,7 +7250,7 @@ applycal(
 )
 SB_iteration2_cont_p3 = SB_iteration2_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p3)
-split(vis=SB_iteration2_cont_p2+'.ms',outputvis=SB_iteration2_cont_p3+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p2+'.ms',outputvis=SB_iteration2_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -7381,8 +7259,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p3+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -7553,7 +7431,7 @@ applycal(
 )
 SB_iteration2_cont_p4 = SB_iteration2_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p4)
-split(vis=SB_iteration2_cont_p3+'.ms',outputvis=SB_iteration2_cont_p4+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p3+'.ms',outputvis=SB_iteration2_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -7562,8 +7440,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p4+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -8138,7 +8016,7 @@ applycal(
 
 SB_iteration2_cont_p5 = SB_iteration2_cont_p4.replace('p4','p5')
 os.system('rm -rf %s.ms*' %SB_iteration2_cont_p5)
-split(vis=SB_iteration2_cont_p4+'.ms',outputvis=SB_iteration2_cont_p5+'.ms',datacolumn='corrected')
+split(vis=SB_iteration2_cont_p4+'.ms',outputvis=SB_iteration2_cont_p5+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -8147,8 +8025,8 @@ tclean_wrapper(
     threshold = '0.0768mJy',
     **SB_tclean_wrapper_kwargs
 )
-estimate_SNR(SB_iteration2_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
-generate_image_png(
+estimate_SNR_cached(SB_iteration2_cont_p5+'.image',disk_mask=SB_mask,noise_mask=noise_annulus_SB)
+render_image_png(
     SB_iteration2_cont_p5+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_SB,10*rms_iteration2_SB],
     save_folder=SB_selfcal_iteration2_folder
@@ -8198,19 +8076,20 @@ all_SB_iteration2_visibilities['p0'] = SB_iteration2_cont_p0
 
 SB_flux_ref_EB = 3 #this is SB_EB3
 
+#The flux scales of the p0 EBs are only applied through SB_iteration2_fluxscale, apply them when exporting
 for self_cal_step,vis_name in all_SB_iteration2_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(number_of_EBs['SB']):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(
+            ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz',
+            flux_scale=SB_iteration2_obs_scales[i] if self_cal_step == 'p0' else 1.
+        ))
 
     for i,exp_ms in enumerate(exported_ms):
         # png_filename = f'iteration2_flux_comparison_SB_EB{i}_{self_cal_step}_to_{flux_ref_EB}.png'
@@ -8244,23 +8123,27 @@ for self_cal_step,vis_name in all_SB_iteration2_visibilities.items():
 
 #Begin of SB+LB self-cal - iteration 2
 #For phase self-cal, clean down to ~6sigma; for amplitude self-cal, clean down to ~1 sigma
+set_profile_stage('8.1_selfcal_SBLB_iteration2')
 LB_selfcal_iteration2_folder = get_figures_folderpath('8.1_selfcal_SBLB_iteration2_figures')
 make_figures_folder(LB_selfcal_iteration2_folder)
 
 LB_iteration2_cont_p0 = prefix+'_SBLB_iteration2_contp0'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p0)
-concat(
-    vis=[
-        SB_iteration2_cont_p5+'.ms',
-        f'{prefix}_LB_EB0_initcont_selfcal_rescaled.ms',#f'{prefix}_LB_EB0_initcont_shift_rescaled.ms',
-        f'{prefix}_LB_EB1_initcont_selfcal_rescaled.ms',#f'{prefix}_LB_EB1_initcont_shift_rescaled.ms',
-        f'{prefix}_LB_EB2_initcont_selfcal_rescaled.ms',#f'{prefix}_LB_EB2_initcont_shift_rescaled.ms',
-        f'{prefix}_LB_EB3_initcont_selfcal_rescaled.ms',#f'{prefix}_LB_EB3_initcont_shift_rescaled.ms',
-        f'{prefix}_LB_EB4_initcont_selfcal_rescaled.ms',#f'{prefix}_LB_EB4_initcont_shift_rescaled.ms',
-    ],
-    concatvis=LB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False
-)
-listobs(vis=LB_iteration2_cont_p0+'.ms',listfile=LB_iteration2_cont_p0+'.ms.listobs.txt',overwrite=True)
+LB_iteration2_EBs = [
+    SB_iteration2_cont_p5+'.ms',
+    f'{prefix}_LB_EB0_initcont_selfcal.ms',#f'{prefix}_LB_EB0_initcont_shift.ms',
+    f'{prefix}_LB_EB1_initcont_selfcal.ms',#f'{prefix}_LB_EB1_initcont_shift.ms',
+    f'{prefix}_LB_EB2_initcont_selfcal.ms',#f'{prefix}_LB_EB2_initcont_shift.ms',
+    f'{prefix}_LB_EB3_initcont_selfcal.ms',#f'{prefix}_LB_EB3_initcont_shift.ms',
+    f'{prefix}_LB_EB4_initcont_selfcal.ms',#f'{prefix}_LB_EB4_initcont_shift.ms',
+]
+LB_iteration2_obs_scales = concat_flux_scales(LB_iteration2_EBs) #read before the EBs are moved into the multi-MS
+#keepcopy=False: last use of these MSs, they are moved into the multi-MS without copying the data (flux scales read before)
+virtual_concat(vis=LB_iteration2_EBs,concatvis=LB_iteration2_cont_p0+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False)
+ms_summary(vis=LB_iteration2_cont_p0+'.ms',listfile=LB_iteration2_cont_p0+'.ms.listobs.txt')
+#Apply the recorded LB flux scales on the fly (the SB EBs in SB_iteration2_cont_p5 are already rescaled)
+LB_iteration2_fluxscale = flux_scale_caltable(LB_iteration2_cont_p0+'.ms',obs_scales=LB_iteration2_obs_scales)
+applycal(vis=LB_iteration2_cont_p0+'.ms',gaintable=[LB_iteration2_fluxscale],calwt=True,applymode='calonly')
 #2025-01-29 14:41:16     SEVERE  getcell::TIME   Exception Reported: TableProxy::getCell: no such row
 #2025-01-29 14:41:20     WARN    concat::::casa  Some but not all of the input MSs are lacking a populated POINTING table:
 #2025-01-29 14:41:20     WARN    concat::::casa     0: MWC_758_SB_iteration2_contp5.ms
@@ -8302,9 +8185,9 @@ tclean_wrapper(
     threshold = '0.0408mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-rms_iteration2_LB = imstat(imagename=LB_iteration2_cont_p0+'.image',region=noise_annulus_LB)['rms'][0]
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+rms_iteration2_LB = region_statistics(LB_iteration2_cont_p0+'.image',noise_annulus_LB)['rms']
+render_image_png(
     LB_iteration2_cont_p0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -8331,7 +8214,7 @@ os.system('rm -rf '+LB_iteration2_p1)
 gaincal(
     vis=LB_iteration2_cont_p0+'.ms',caltable=LB_iteration2_p1,
     gaintype='G',combine='scan,spw',calmode='p',solint='inf',
-    spw=LB_contspws,refant=LB_refant,
+    spw=LB_contspws,refant=LB_refant,gaintable=[LB_iteration2_fluxscale],
     minsnr=3.,minblperant=4
 )
 # 9 of 92 solutions flagged due to SNR < 3 in spw=0  at 2017/10/10/09:36:59.3
@@ -8372,12 +8255,12 @@ plotms(
 
 #Apply the calibration gains and split-off the corrected ms
 applycal(
-    vis=LB_iteration2_cont_p0+'.ms',spw=LB_contspws,spwmap=LB_spw_mapping,
-    gaintable=[LB_iteration2_p1],interp='linearPD',calwt=True,applymode='calonly'
+    vis=LB_iteration2_cont_p0+'.ms',spw=LB_contspws,spwmap=[[],LB_spw_mapping],
+    gaintable=[LB_iteration2_fluxscale,LB_iteration2_p1],interp=['nearest','linearPD'],calwt=True,applymode='calonly'
 )
 LB_iteration2_cont_p1 = LB_iteration2_cont_p0.replace('p0','p1')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p1)
-split(vis=LB_iteration2_cont_p0+'.ms',outputvis=LB_iteration2_cont_p1+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p0+'.ms',outputvis=LB_iteration2_cont_p1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -8386,8 +8269,8 @@ tclean_wrapper(
     threshold = '0.0399mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -8461,7 +8344,7 @@ applycal(
 )
 LB_iteration2_cont_p1_bis = LB_iteration2_cont_p1.replace('p1','p1_bis')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p1_bis)
-split(vis=LB_iteration2_cont_p1+'.ms',outputvis=LB_iteration2_cont_p1_bis+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p1+'.ms',outputvis=LB_iteration2_cont_p1_bis+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -8470,8 +8353,8 @@ tclean_wrapper(
     threshold = '0.0392mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p1_bis+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p1_bis+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p1_bis+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -8694,7 +8577,7 @@ applycal(
 )
 LB_iteration2_cont_p2 = LB_iteration2_cont_p1_bis.replace('p1_bis','p2')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p2)
-split(vis=LB_iteration2_cont_p1_bis+'.ms',outputvis=LB_iteration2_cont_p2+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p1_bis+'.ms',outputvis=LB_iteration2_cont_p2+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -8703,8 +8586,8 @@ tclean_wrapper(
     threshold = '0.0391mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p2+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p2+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -8890,7 +8773,7 @@ applycal(
 )
 LB_iteration2_cont_p3 = LB_iteration2_cont_p2.replace('p2','p3')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p3)
-split(vis=LB_iteration2_cont_p2+'.ms',outputvis=LB_iteration2_cont_p3+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p2+'.ms',outputvis=LB_iteration2_cont_p3+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -8899,8 +8782,8 @@ tclean_wrapper(
     threshold = '0.0389mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p3+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p3+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -9455,7 +9338,7 @@ applycal(
 
 LB_iteration2_cont_p4 = LB_iteration2_cont_p3.replace('p3','p4')
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_p4)
-split(vis=LB_iteration2_cont_p3+'.ms',outputvis=LB_iteration2_cont_p4+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p3+'.ms',outputvis=LB_iteration2_cont_p4+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN, again with a ~6sigma threshold
 tclean_wrapper(
@@ -9464,8 +9347,8 @@ tclean_wrapper(
     threshold = '0.0386mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -9491,8 +9374,8 @@ tclean_wrapper(
     threshold = '6.41e-03mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_p4+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_p4+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -9575,7 +9458,7 @@ applycal(
 )
 LB_iteration2_cont_ap0 = prefix+'_SBLB_iteration2_contap0'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_ap0)
-split(vis=LB_iteration2_cont_p4+'.ms',outputvis=LB_iteration2_cont_ap0+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_p4+'.ms',outputvis=LB_iteration2_cont_ap0+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN with a ~1sigma threshold before amplitude self-cal
 tclean_wrapper(
@@ -9584,8 +9467,8 @@ tclean_wrapper(
     threshold = '6.36e-03mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_ap0+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_ap0+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -9727,7 +9610,7 @@ applycal(
 )
 LB_iteration2_cont_ap1 = prefix+'_SBLB_iteration2_contap1'
 os.system('rm -rf %s.ms*' %LB_iteration2_cont_ap1)
-split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_ap1+'.ms',datacolumn='corrected')
+split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_ap1+'.ms',datacolumn='corrected',keepmms=True)
 
 #CLEAN with a ~1sigma threshold before amplitude self-cal
 tclean_wrapper(
@@ -9736,8 +9619,8 @@ tclean_wrapper(
     threshold = '0.0060mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(LB_iteration2_cont_ap1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_ap1+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_ap1+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],
     save_folder=LB_selfcal_iteration2_folder
@@ -9786,19 +9669,20 @@ all_LB_iteration2_visibilities = self_caled_LB_iteration2_visibilities.copy()
 all_LB_iteration2_visibilities['p0'] = LB_iteration2_cont_p0
 
 total_number_of_EBs = number_of_EBs['SB'] + number_of_EBs['LB']
+#The flux scales of the p0 EBs are only applied through LB_iteration2_fluxscale, apply them when exporting
 for self_cal_step,vis_name in all_LB_iteration2_visibilities.items():
-    #Split out SB EBs
+    #Read each EB as a view of the concatenated MS (row selection) instead of split_all_obs copies
     vis_ms = vis_name+'.ms'
     nametemplate = vis_ms.replace('.ms','_EB')
-    split_all_obs(msfile=vis_ms,nametemplate=nametemplate)
 
     exported_ms = []
     for i in range(total_number_of_EBs):
-        EB_vis = f'{nametemplate}{i}.ms'
-        listobs(vis=EB_vis,listfile=EB_vis+'.listobs.txt',overwrite=True)
-        #Export MS contents into numpy save files
-        export_MS(EB_vis)
-        exported_ms.append(EB_vis.replace('.ms','.vis.npz'))
+        ms_summary(vis=vis_ms,observation=i,listfile=f'{nametemplate}{i}.ms.listobs.txt')
+        #Export the rows of the EB into numpy save files
+        exported_ms.append(export_ms_view(
+            ms_observation_view(vis_ms,i),outfile=f'{nametemplate}{i}.vis.npz',
+            flux_scale=LB_iteration2_obs_scales[i] if self_cal_step == 'p0' else 1.
+        ))
 
     for i,exp_ms in enumerate(exported_ms):
         png_filename = f'iteration2_flux_comparison_EB{i}_to_EB{SBLB_flux_ref_EB}'+f'_SBLB_{self_cal_step}.png'
@@ -9880,10 +9764,14 @@ for self_cal_step,vis_name in all_LB_iteration2_visibilities.items():
 
 #Split out final continuum ms table, with a 30s timebin
 LB_iteration2_cont_averaged = f'{prefix}_time_ave_continuum'
+#keepmms=False: delivered product, written as a plain MS
 os.system(f'rm -rf {LB_iteration2_cont_averaged}.ms*')
-split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_averaged+'.ms',datacolumn='data',keepflags=False,timebin='30s')
+split(vis=LB_iteration2_cont_ap0+'.ms',outputvis=LB_iteration2_cont_averaged+'.ms',datacolumn='data',keepflags=False,timebin='30s',keepmms=False)
+
+tag_final(LB_iteration2_cont_ap0+'.ms',LB_iteration2_cont_averaged+'.ms')
 
 #Now apply these solutions to the line data
+set_profile_stage('9_apply_cal_to_lines')
 calibrate_linedata_folder = get_figures_folderpath('9_apply_cal_to_lines')
 make_figures_folder(calibrate_linedata_folder)
 
@@ -9964,27 +9852,30 @@ for i,gencalpar in enumerate([1.017,1.034,0.972,1.029,1.036]):
     # os.system('rm -rf '+prefix+f'_LB_EB{i}_no_ave_selfcal_rescaled.ms')
     rescale_flux(vis=prefix+f'_LB_EB{i}_no_ave_selfcal.ms', gencalparameter=[gencalpar])
     
-    listobs(vis=prefix+f'_LB_EB{i}_no_ave_selfcal_rescaled.ms',listfile=prefix+f'_LB_EB{i}_no_ave_selfcal_rescaled.ms.listobs.txt',overwrite=True)
+    ms_summary(vis=prefix+f'_LB_EB{i}_no_ave_selfcal_rescaled.ms',listfile=prefix+f'_LB_EB{i}_no_ave_selfcal_rescaled.ms.listobs.txt')
 
 for i,gencalpar in enumerate([0.996,0.994,0.998]):
     # os.system('rm -rf '+prefix+f'_SB_EB{i}_no_ave_selfcal_rescaled.ms')
     rescale_flux(vis=prefix+f'_SB_EB{i}_no_ave_selfcal.ms', gencalparameter=[gencalpar])
     
-    listobs(vis=prefix+f'_SB_EB{i}_no_ave_selfcal_rescaled.ms',listfile=prefix+f'_SB_EB{i}_no_ave_selfcal_rescaled.ms.listobs.txt',overwrite=True)
+    ms_summary(vis=prefix+f'_SB_EB{i}_no_ave_selfcal_rescaled.ms',listfile=prefix+f'_SB_EB{i}_no_ave_selfcal_rescaled.ms.listobs.txt')
 
 #Concat the non-averaged SB data
 SB_combined = f'{prefix}_SB_no_ave_concat'
 os.system('rm -rf %s.ms*' %SB_combined)
-concat(
+#keepcopy=False: dedicated products of the split/rescale above, moved into the multi-MS without copying the data
+virtual_concat(
     vis=[
         f'{prefix}_SB_EB0_no_ave_selfcal_rescaled.ms',
         f'{prefix}_SB_EB1_no_ave_selfcal_rescaled.ms',
         f'{prefix}_SB_EB2_no_ave_selfcal_rescaled.ms',
         f'{prefix}_SB_EB3_no_ave_selfcal.ms',
     ],
-    concatvis=SB_combined+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=SB_combined+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=SB_combined+'.ms',listfile=SB_combined+'.ms.listobs.txt',overwrite=True)
+#Only read by the applycal and split of the SB no_ave calibration below, freed (in the background) after them
+register_intermediate(SB_combined+'.ms',consumers=['SB_no_ave_calibration'])
+ms_summary(vis=SB_combined+'.ms',listfile=SB_combined+'.ms.listobs.txt')
 #2024-12-27 08:02:02     WARN    MSConcat::copySysCal    /data/beegfs/astro-storage/groups/benisty/frzagaria/SO_detections/CQTau/selfcal_products/CQ_Tau_SB_no_ave_concat.ms does not have a valid syscal table,
 #    the MS to be appended, however, has one. Result won't have one.
 #2024-12-27 08:02:02     WARN    MSConcat::concatenate (file /source/casa6/casatools/casacore/ms/MSOper/MSConcat.cc, line 1000)     Could not merge SysCal subtables 
@@ -10003,13 +9894,15 @@ applycal(
 )
 SB_no_ave_selfcal = f'{prefix}_SB_no_ave_selfcal.ms'
 os.system(f'rm -rf {SB_no_ave_selfcal}*')
-split(vis=SB_combined+'.ms',outputvis=SB_no_ave_selfcal,datacolumn='corrected')
-listobs(vis=SB_no_ave_selfcal,listfile=SB_no_ave_selfcal+'.listobs.txt',overwrite=True)
+split(vis=SB_combined+'.ms',outputvis=SB_no_ave_selfcal,datacolumn='corrected',keepmms=False)
+stage_done('SB_no_ave_calibration')
+ms_summary(vis=SB_no_ave_selfcal,listfile=SB_no_ave_selfcal+'.listobs.txt')
 
 #Concat the non-averaged LB data
 LB_combined = f'{prefix}_SBLB_no_ave_concat'
 os.system('rm -rf %s.ms*' %LB_combined)
-concat(
+#keepcopy=False: dedicated products of the splits/rescale above, moved into the multi-MS without copying the data
+virtual_concat(
     vis=[SB_no_ave_selfcal]+[
         f'{prefix}_LB_EB0_no_ave_selfcal_rescaled.ms',
         f'{prefix}_LB_EB1_no_ave_selfcal_rescaled.ms',
@@ -10017,9 +9910,12 @@ concat(
         f'{prefix}_LB_EB3_no_ave_selfcal_rescaled.ms',
         f'{prefix}_LB_EB4_no_ave_selfcal_rescaled.ms',
     ],
-    concatvis=LB_combined+'.ms',dirtol='0.1arcsec',copypointing=False
+    concatvis=LB_combined+'.ms',dirtol='0.1arcsec',copypointing=False,keepcopy=False
 )
-listobs(vis=LB_combined+'.ms',listfile=LB_combined+'.ms.listobs.txt',overwrite=True)
+#SB_no_ave_selfcal has been moved into it (keepcopy=False). Only read by the applycal and split of the SBLB no_ave
+#calibration below, freed (in the background) after them
+register_intermediate(LB_combined+'.ms',consumers=['SBLB_no_ave_calibration'])
+ms_summary(vis=LB_combined+'.ms',listfile=LB_combined+'.ms.listobs.txt')
 #2024-12-27 08:23:00     SEVERE  getcell::TIME   Exception Reported: TableProxy::getCell: no such row
 #2024-12-27 08:23:01     WARN    concat::::casa  Some but not all of the input MSs are lacking a populated POINTING table:
 #2024-12-27 08:23:01     WARN    concat::::casa     0: CQ_Tau_SB_no_ave_selfcal.ms
@@ -10045,8 +9941,12 @@ applycal(
 )
 SBLB_no_ave_selfcal = f'{prefix}_SBLB_no_ave_selfcal_time_ave.ms'
 os.system(f'rm -rf {SBLB_no_ave_selfcal}*')
-split(vis=LB_combined+'.ms',outputvis=SBLB_no_ave_selfcal,datacolumn='corrected',keepflags=False,timebin='30s') #Time average of 30s, tests show there is no difference with data without time average
-listobs(vis=SBLB_no_ave_selfcal,listfile=SBLB_no_ave_selfcal+'.listobs.txt',overwrite=True)
+split(vis=LB_combined+'.ms',outputvis=SBLB_no_ave_selfcal,datacolumn='corrected',keepflags=False,timebin='30s',keepmms=False) #Time average of 30s, tests show there is no difference with data without time average
+#Alternatively, baseline-dependent time averaging only (channels untouched for the lines), 1% decorrelation within 4 arcsec:
+#baseline_dependent_average(LB_combined+'.ms',SBLB_no_ave_selfcal,fov=4.,max_timebin='120s',average_channels=False,datacolumn='corrected')
+ms_summary(vis=SBLB_no_ave_selfcal,listfile=SBLB_no_ave_selfcal+'.listobs.txt')
+tag_final(SBLB_no_ave_selfcal)
+stage_done('SBLB_no_ave_calibration')
 
 #Check that the solutions have been applied correctly by flagging the line data, averaging and imaging continuum
 #Continuum has to be the same imaged in the last step of the self-cal
@@ -10122,8 +10022,8 @@ tclean_wrapper(
     **LB_tclean_wrapper_kwargs
 )
 
-estimate_SNR(LB_iteration2_cont_averaged+'_image'+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(LB_iteration2_cont_averaged+'_image'+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     LB_iteration2_cont_averaged+'_image'+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],save_folder=calibrate_linedata_folder
 )
@@ -10149,8 +10049,8 @@ tclean_wrapper(
     threshold = '6.44e-03mJy',
     **LB_tclean_wrapper_kwargs
 )
-estimate_SNR(complete_dataset_image+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
-generate_image_png(
+estimate_SNR_cached(complete_dataset_image+'.image',disk_mask=LB_mask,noise_mask=noise_annulus_LB)
+render_image_png(
     complete_dataset_image+'.image',plot_sizes=image_png_plot_sizes,
     color_scale_limits=[-3*rms_iteration2_LB,10*rms_iteration2_LB],save_folder=calibrate_linedata_folder
 )
@@ -10170,13 +10070,11 @@ generate_image_png(
 
 #Plot ratio of cal then avg, and avg then cal. It should be equal to ~one (only difference being the time average)
 ref_image = LB_iteration2_cont_averaged+'_image'+'.image'
-os.system('rm -rf '+complete_dataset_image+'.ratio')
-immath(
-    imagename=[ref_image,complete_dataset_image+'.image'],mode='evalexpr',
-    outfile=complete_dataset_image+'.ratio',
-    expr='iif(IM0 > 3*'+str(rms_iteration2_LB)+', IM1/IM0, 0)'
+image_ratio(
+    ref_image,complete_dataset_image+'.image',threshold=3*rms_iteration2_LB,
+    size=2*mask_semimajor,outfile=complete_dataset_image+'.ratio'
 )
-generate_image_png(
+render_image_png(
     f'{complete_dataset_image}.ratio',plot_sizes=[2*mask_semimajor,2*mask_semimajor],
     color_scale_limits=[0.5,1.5],image_units='ratio',
     save_folder=calibrate_linedata_folder
@@ -10191,7 +10089,7 @@ uvcontsub(
     vis=SBLB_no_ave_selfcal,spw=complete_dataset_dict['cont_spws'],fitspw=fitspw,
     excludechans=True,solint='int',fitorder=1,want_cont=False
 )
-listobs(vis=SBLB_no_ave_selfcal+'.contsub',listfile=SBLB_no_ave_selfcal+'.contsub.listobs.txt',overwrite=True)
+ms_summary(vis=SBLB_no_ave_selfcal+'.contsub',listfile=SBLB_no_ave_selfcal+'.contsub.listobs.txt')
 #2025-01-05 07:33:16     WARN    calibrater::setvi(bool,bool)    Forcing use of OLD VisibilityIterator.
 #2025-01-05 09:04:50     WARN    VBContinuumSubtractor::apply    Extrapolating to cover [233.22, 235.205] (GHz).
 #2025-01-05 09:04:50     WARN    VBContinuumSubtractor::apply+   The frequency range used for the continuum fit was [233.236, 235.205] (GHz).
@@ -10368,137 +10266,101 @@ for params in data_params.values():
 SBLB_no_ave_selfcal = f'{prefix}_SBLB_no_ave_selfcal_time_ave.ms'
 contsub_vis = f'{SBLB_no_ave_selfcal}.contsub'
 
+#Channel windows of the lines (+-30 km/s around v_sys, LSRK) in every spw of the SBLB file, checked against the
+#get_flagchannels selections above (SB and LB EBs differ by up to one channel)
+split_lines = {
+    '12CO':rest_freq_12CO,'13CO':rest_freq_13CO,'C18O':rest_freq_C18O,'H2CO_303_202':rest_freq_H2CO_303_202,
+    'H2CO_321_220':rest_freq_H2CO_321_220,'H2CO_322_221':rest_freq_H2CO_322_221,'H2CO_918_919':rest_freq_H2CO_918_919,
+    'H2S':rest_freq_H2S_220_211,'SiO':rest_freq_SiO,'DCN':rest_freq_DCN_F21,'SiS':rest_freq_SiS_1211,'SO':rest_freq_SO,
+}
+split_line_ranges = line_channel_ranges(SBLB_no_ave_selfcal,split_lines,v_sys,velocity_range=(-30.,30.))
+
 #12CO
 vis_12CO = SBLB_no_ave_selfcal[:-3]+'_12CO.ms'
 os.system(f'rm -rf {vis_12CO}*')
-spw_12CO = '2:0~29,6:0~29,10:0~29,14:0~29,18:0~29,22:0~29,26:0~29,30:0~29,34:0~29'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_12CO,spw=spw_12CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_12CO,listfile=vis_12CO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_12CO}.contsub',spw=spw_12CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_12CO+'.contsub',listfile=vis_12CO+'.contsub.listobs.txt',overwrite=True)
+spw_12CO = check_spw_selection(spw_selection(split_line_ranges['12CO']),'2:0~29,6:0~29,10:0~29,14:0~29,18:0~29,22:0~29,26:0~29,30:0~29,34:0~29') #expected from get_flagchannels
 
 #13CO
 vis_13CO = SBLB_no_ave_selfcal[:-3]+'_13CO.ms'
 os.system(f'rm -rf {vis_13CO}*')
-spw_13CO = '3:0~32,7:0~32,11:0~32,15:0~32,19:0~32,23:0~32,27:0~32,31:0~32,35:0~32'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_13CO,spw=spw_13CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_13CO,listfile=vis_13CO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_13CO}.contsub',spw=spw_13CO,datacolumn='data',keepflags=False)
-listobs(vis=vis_13CO+'.contsub',listfile=vis_13CO+'.contsub.listobs.txt',overwrite=True)
+spw_13CO = check_spw_selection(spw_selection(split_line_ranges['13CO']),'3:0~32,7:0~32,11:0~32,15:0~32,19:0~32,23:0~32,27:0~32,31:0~32,35:0~32') #expected from get_flagchannels
 
 #C18O
 vis_C18O = SBLB_no_ave_selfcal[:-3]+'_C18O.ms'
 os.system(f'rm -rf {vis_C18O}*')
-spw_C18O = '3:845~890,7:845~890,11:845~890,15:845~890,19:845~890,23:845~890,27:845~890,31:845~890,35:845~890'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_C18O,spw=spw_C18O,datacolumn='data',keepflags=False)
-listobs(vis=vis_C18O,listfile=vis_C18O+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_C18O}.contsub',spw=spw_C18O,datacolumn='data',keepflags=False)
-listobs(vis=vis_C18O+'.contsub',listfile=vis_C18O+'.contsub.listobs.txt',overwrite=True)
+spw_C18O = check_spw_selection(spw_selection(split_line_ranges['C18O']),'3:845~890,7:845~890,11:845~890,15:845~890,19:845~890,23:845~890,27:845~890,31:845~890,35:845~890') #expected from get_flagchannels
 
 #H2CO_303_202
 vis_H2CO_303_202 = SBLB_no_ave_selfcal[:-3]+'_H2CO_303_202.ms'
 os.system(f'rm -rf {vis_H2CO_303_202}*')
-spw_H2CO_303_202 = '1:17~19,5:17~19,9:17~19,13:17~19,17:17~19,21:17~19,25:17~19,29:17~19,33:17~19'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_303_202,spw=spw_H2CO_303_202,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_303_202,listfile=vis_H2CO_303_202+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_303_202}.contsub',spw=spw_H2CO_303_202,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_303_202+'.contsub',listfile=vis_H2CO_303_202+'.contsub.listobs.txt',overwrite=True)
+spw_H2CO_303_202 = check_spw_selection(spw_selection(split_line_ranges['H2CO_303_202']),'1:17~19,5:17~19,9:17~19,13:17~19,17:17~19,21:17~19,25:17~19,29:17~19,33:17~19') #expected from get_flagchannels
 
 #H2CO_321_220
 vis_H2CO_321_220 = SBLB_no_ave_selfcal[:-3]+'_H2CO_321_220.ms'
 os.system(f'rm -rf {vis_H2CO_321_220}*')
-spw_H2CO_321_220 = '3:1665~1709,7:1665~1709,11:1665~1709,15:1665~1709,19:1665~1709,23:1665~1709,27:1665~1709,31:1665~1709,35:1665~1709'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_321_220,spw=spw_H2CO_321_220,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_321_220,listfile=vis_H2CO_321_220+'.listobs.txt',overwrite=True)
+spw_H2CO_321_220 = check_spw_selection(spw_selection(split_line_ranges['H2CO_321_220']),'3:1665~1709,7:1665~1709,11:1665~1709,15:1665~1709,19:1665~1709,23:1665~1709,27:1665~1709,31:1665~1709,35:1665~1709') #expected from get_flagchannels
 
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_321_220}.contsub',spw=spw_H2CO_321_220,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_321_220+'.contsub',listfile=vis_H2CO_321_220+'.contsub.listobs.txt',overwrite=True)
 """
 #H2CO_322_221 essentially empty because channels were flagged by pipeline crosscal
 vis_H2CO_322_221 = SBLB_no_ave_selfcal[:-3]+'_H2CO_322_221.ms'
 os.system(f'rm -rf {vis_H2CO_322_221}*')
-spw_H2CO_322_221 = '1:0~3,5:0~3,9:0~3,13:0~3,17:0~3,21:0~3,25:0~3,29:0~3,33:0~3,3:1919~1919,7:1919~1919,11:1919~1919,15:1919~1919,19:1919~1919,23:1919~1919,27:1919~1919,31:1919~1919,35:1919~1919'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_322_221,spw=spw_H2CO_322_221,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_322_221,listfile=vis_H2CO_322_221+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_322_221}.contsub',spw=spw_H2CO_322_221,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_322_221+'.contsub',listfile=vis_H2CO_322_221+'.contsub.listobs.txt',overwrite=True)
+spw_H2CO_322_221 = check_spw_selection(spw_selection(split_line_ranges['H2CO_322_221']),'1:0~3,5:0~3,9:0~3,13:0~3,17:0~3,21:0~3,25:0~3,29:0~3,33:0~3,3:1919~1919,7:1919~1919,11:1919~1919,15:1919~1919,19:1919~1919,23:1919~1919,27:1919~1919,31:1919~1919,35:1919~1919') #expected from get_flagchannels
 
 #H2CO_918_919 essentially empty because channels were flagged by pipeline crosscal
 vis_H2CO_918_919 = SBLB_no_ave_selfcal[:-3]+'_H2CO_918_919.ms'
 os.system(f'rm -rf {vis_H2CO_918_919}*')
-spw_H2CO_918_919 = '1:123~125,5:123~125,9:123~125,13:123~125,17:123~125,21:123~125,25:123~125,29:123~125,33:123~125'
+spw_H2CO_918_919 = check_spw_selection(spw_selection(split_line_ranges['H2CO_918_919']),'1:123~125,5:123~125,9:123~125,13:123~125,17:123~125,21:123~125,25:123~125,29:123~125,33:123~125') #expected from get_flagchannels
 
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2CO_918_919,spw=spw_H2CO_918_919,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_918_919,listfile=vis_H2CO_918_919+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2CO_918_919}.contsub',spw=spw_H2CO_918_919,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2CO_918_919+'.contsub',listfile=vis_H2CO_918_919+'.contsub.listobs.txt',overwrite=True)
 """
 #H2S
 vis_H2S = SBLB_no_ave_selfcal[:-3]+'_H2S.ms'
 os.system(f'rm -rf {vis_H2S}*')
-spw_H2S = '1:113~116,5:113~116,9:113~116,13:113~116,17:113~116,21:113~116,25:113~116,29:113~116,33:113~116'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_H2S,spw=spw_H2S,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2S,listfile=vis_H2S+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_H2S}.contsub',spw=spw_H2S,datacolumn='data',keepflags=False)
-listobs(vis=vis_H2S+'.contsub',listfile=vis_H2S+'.contsub.listobs.txt',overwrite=True)
+spw_H2S = check_spw_selection(spw_selection(split_line_ranges['H2S']),'1:113~116,5:113~116,9:113~116,13:113~116,17:113~116,21:113~116,25:113~116,29:113~116,33:113~116') #expected from get_flagchannels
 
 #SiO
 vis_SiO = SBLB_no_ave_selfcal[:-3]+'_SiO.ms'
 os.system(f'rm -rf {vis_SiO}*')
-spw_SiO = '1:88~91,5:88~91,9:88~91,13:88~91,17:88~91,21:88~91,25:88~91,29:88~91,33:88~91'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_SiO,spw=spw_SiO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiO,listfile=vis_SiO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_SiO}.contsub',spw=spw_SiO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiO+'.contsub',listfile=vis_SiO+'.contsub.listobs.txt',overwrite=True)
+spw_SiO = check_spw_selection(spw_selection(split_line_ranges['SiO']),'1:88~91,5:88~91,9:88~91,13:88~91,17:88~91,21:88~91,25:88~91,29:88~91,33:88~91') #expected from get_flagchannels
 
 #DCN
 vis_DCN = SBLB_no_ave_selfcal[:-3]+'_DCN.ms'
 os.system(f'rm -rf {vis_DCN}*')
-spw_DCN = '1:80~82,5:80~82,9:80~82,13:80~82,17:80~82,21:80~82,25:80~82,29:80~82,33:80~82'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_DCN,spw=spw_DCN,datacolumn='data',keepflags=False)
-listobs(vis=vis_DCN,listfile=vis_DCN+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_DCN}.contsub',spw=spw_DCN,datacolumn='data',keepflags=False)
-listobs(vis=vis_DCN+'.contsub',listfile=vis_DCN+'.contsub.listobs.txt',overwrite=True)
+spw_DCN = check_spw_selection(spw_selection(split_line_ranges['DCN']),'1:80~82,5:80~82,9:80~82,13:80~82,17:80~82,21:80~82,25:80~82,29:80~82,33:80~82') #expected from get_flagchannels
 
 #SiS
 vis_SiS = SBLB_no_ave_selfcal[:-3]+'_SiS.ms'
 os.system(f'rm -rf {vis_SiS}*')
-spw_SiS = '1:43~45,5:43~45,9:43~45,13:43~45,17:43~45,21:43~45,25:43~45,29:43~45,33:43~45'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_SiS,spw=spw_SiS,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiS,listfile=vis_SiS+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_SiS}.contsub',spw=spw_SiS,datacolumn='data',keepflags=False)
-listobs(vis=vis_SiS+'.contsub',listfile=vis_SiS+'.contsub.listobs.txt',overwrite=True)
+spw_SiS = check_spw_selection(spw_selection(split_line_ranges['SiS']),'1:43~45,5:43~45,9:43~45,13:43~45,17:43~45,21:43~45,25:43~45,29:43~45,33:43~45') #expected from get_flagchannels
 
 #SO
 vis_SO = SBLB_no_ave_selfcal[:-3]+'_SO.ms'
 os.system(f'rm -rf {vis_SO}*')
-spw_SO = '3:446~492,7:446~492,11:446~492,15:446~492,19:446~492,23:446~492,27:446~492,31:446~492,35:446~492'
-
-split(vis=SBLB_no_ave_selfcal,outputvis=vis_SO,spw=spw_SO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SO,listfile=vis_SO+'.listobs.txt',overwrite=True)
-
-split(vis=contsub_vis,outputvis=f'{vis_SO}.contsub',spw=spw_SO,datacolumn='data',keepflags=False)
-listobs(vis=vis_SO+'.contsub',listfile=vis_SO+'.contsub.listobs.txt',overwrite=True)
+spw_SO = check_spw_selection(spw_selection(split_line_ranges['SO']),'3:446~492,7:446~492,11:446~492,15:446~492,19:446~492,23:446~492,27:446~492,31:446~492,35:446~492') #expected from get_flagchannels
+
+#Split all the line MSs from one input before switching to the other: each input is staged once on node-local
+#scratch (scratch_folder, skipped if it exceeds half of scratch_max_bytes) and the line MSs are written back to the
+#shared filesystem in the background while the next splits run
+line_split_spws = {
+    vis_12CO:spw_12CO,
+    vis_13CO:spw_13CO,
+    vis_C18O:spw_C18O,
+    vis_H2CO_303_202:spw_H2CO_303_202,
+    vis_H2CO_321_220:spw_H2CO_321_220,
+    vis_H2S:spw_H2S,
+    vis_SiO:spw_SiO,
+    vis_DCN:spw_DCN,
+    vis_SiS:spw_SiS,
+    vis_SO:spw_SO,
+}
+for input_vis,suffix in ((SBLB_no_ave_selfcal,''),(contsub_vis,'.contsub')):
+    with scratch_stage(inputs=[input_vis],outputs=[vis+suffix for vis in line_split_spws]) as ([local_vis],local_outs):
+        for local_out,spw in zip(local_outs,line_split_spws.values()):
+            split(vis=local_vis,outputvis=local_out,spw=spw,datacolumn='data',keepflags=False)
+#The line MSs are read from the shared filesystem from here on
+wait_write_backs()
+for vis in line_split_spws:
+    for suffix in ('','.contsub'):
+        ms_summary(vis=vis+suffix,listfile=vis+suffix+'.listobs.txt')
 """
 for _vis,_freq in zip(
     [vis_12CO,vis_13CO,vis_C18O,vis_H2CO_303_202,vis_H2CO_321_220,vis_DCN,vis_SiS,vis_SO],#vis_H2CO_322_221,vis_H2CO_918_919,
@@ -10563,8 +10425,8 @@ nchan     = 15
 imagename = vis_12CO[:-3]+'.contsub_image_1.0robust_4.0sigma'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
-    vis=vis_12CO+'.contsub',imagename=imagename,
+tclean_cube_parallel( #channel chunks imaged by separate CASA processes, merged with the common beam
+    vis=vis_12CO+'.contsub',imagename=imagename,nworkers=8,
     specmode='cube',restoringbeam='common',nterms=1,
     deconvolver='multiscale',scales=[0,2,4,8],
     cell='0.006arcsec',imsize=2400,gain=0.1,niter=50000,
@@ -10573,7 +10435,7 @@ tclean(
     outframe='LSRK',veltype='radio',restfreq='{}Hz'.format(rest_freq_12CO),
     usemask='user',mask=line_mask, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_12CO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.064 arcsec x 0.044 arcsec (0.13 deg)
@@ -10589,8 +10451,8 @@ nchan     = 15
 imagename = vis_13CO[:-3]+'.contsub_image_1.0robust_4.0sigma'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
-    vis=vis_13CO+'.contsub',imagename=imagename,
+tclean_cube_parallel( #channel chunks imaged by separate CASA processes, merged with the common beam
+    vis=vis_13CO+'.contsub',imagename=imagename,nworkers=8,
     specmode='cube',restoringbeam='common',nterms=1,
     deconvolver='multiscale',scales=[0,2,4,8],
     cell='0.006arcsec',imsize=1200,gain=0.1,niter=50000,
@@ -10600,7 +10462,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_13CO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.068 arcsec x 0.044 arcsec (0.15 deg)
@@ -10623,7 +10485,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_C18O.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.069 arcsec x 0.045 arcsec (0.15 deg)
@@ -10646,7 +10508,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_4.0sigma.image
 #Beam 0.091 arcsec x 0.072 arcsec (-18.61 deg)
@@ -10669,7 +10531,7 @@ tclean(
     usemask='user',mask=line_mask,
     uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_4.0sigma_uvtaper0.1arcsec.image
 #Beam 0.247 arcsec x 0.201 arcsec (-32.34 deg)
@@ -10692,7 +10554,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.5robust_4.0sigma.image
 #Beam 0.047 arcsec x 0.028 arcsec (0.16 deg)
@@ -10715,7 +10577,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_0.75robust_4.0sigma.image
 #Beam 0.059 arcsec x 0.033 arcsec (0.22 deg)
@@ -10738,7 +10600,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_1.0robust_4.0sigma.image
 #Beam 0.068 arcsec x 0.044 arcsec (8.38 deg)
@@ -10761,7 +10623,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_H2CO_321_220.contsub_image_natural_4.0sigma.image
 #Beam 0.093 arcsec x 0.072 arcsec (-22.00 deg)
@@ -10788,7 +10650,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SiS.contsub_image_natural_4.0sigma.image
 #Beam 0.285 arcsec x 0.218 arcsec (-33.60 deg)
@@ -10815,7 +10677,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_H2CO_303_202.contsub_image_natural_4.0sigma.image
 #Beam 0.278 arcsec x 0.217 arcsec (-31.39 deg)
@@ -10842,7 +10704,7 @@ tclean(
     usemask='user',mask=line_mask,
     #uvtaper='0.1arcsec',#interactive=True, 
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_DCN.contsub_image_natural_4.0sigma.image
 #Beam 0.290 arcsec x 0.219 arcsec (-35.68 deg)
@@ -10864,7 +10726,7 @@ tclean(
     outframe='LSRK',veltype='radio',restfreq='{}Hz'.format(rest_freq_SiO),
     usemask='user',mask=line_mask
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SiO.contsub_image_natural_4.0sigma.image
 #Beam 0.085 arcsec x 0.072 arcsec (-10.93 deg)
@@ -10886,11 +10748,19 @@ tclean(
     outframe='LSRK',veltype='radio',restfreq='{}Hz'.format(rest_freq_H2S_220_211),
     usemask='user',mask=line_mask
 )
-estimate_SNR(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
+estimate_SNR_cached(imagename+'.image',disk_mask=line_mask,noise_mask=noise_annulus_line)
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_H2S.contsub_image_natural_4.0sigma.image
 #Beam 0.085 arcsec x 0.072 arcsec (-10.68 deg)
 #Flux inside disk mask: -351.95 mJy
 #Peak intensity of source: 0.26 mJy/beam
 #rms: 6.04e-02 mJy/beam
-#Peak SNR: 4.33
\ No newline at end of file
+#Peak SNR: 4.33
+
+#Wait for the pngs drawn in the background (errors of the png processes are raised here)
+wait_png_renders()
+
+#Wait for the background deletions of the freed intermediates
+wait_deletions()
+wait_write_backs()
+write_profile(f'{prefix}_profile')
@@ -35,6 +35,11 @@ execfile(os.path.join(github_path,'reduction_utils_py3_mpi.py'))
 
 execfile(os.path.join(github_path,'keplerian_mask.py'))
 
+#path to your local copy of this repository (helper modules shipped with these scripts)
+selfcal_utils_path = '/data/beegfs/astro-storage/groups/benisty/frzagaria/selfcal_CQTau_and_MWC758/'
+execfile(os.path.join(selfcal_utils_path,'imaging_utils.py'))
+execfile(os.path.join(selfcal_utils_path,'image_analysis_utils.py'))
+
 prefix = 'MWC_758'
 path_to_vis = '../'
 
@@ -82,7 +87,9 @@ scales    = [
 
 for _robust,_cellsize,_threshold,_scales,_imsize in zip(robust,cellsize,threshold,scales,imsize):
     imagename = LB_iteration2_cont_averaged+f'{_robust}robust_1.0sigma_0.02gain'
-    tclean_wrapper(
+    #Start with a large loop gain/cycleniter and go down to gain=0.02, cycleniter=300 close to the threshold.
+    #The residual trajectory per major cycle is saved in imagename+'.schedule.json'
+    tclean_wrapper_adaptive(
         vis       = path_to_vis+LB_iteration2_cont_averaged+'.ms', 
         imagename = imagename,
         threshold = f'{_threshold}mJy',
@@ -93,7 +100,7 @@ for _robust,_cellsize,_threshold,_scales,_imsize in zip(robust,cellsize,threshol
         imsize    = _imsize,
         **tclean_wrapper_kwargs
     )
-    estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+    estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
     exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 
 #MWC_758_time_ave_continuum0.5robust_1.0sigma_0.02gain.image
@@ -160,8 +167,10 @@ tclean_kwargs = {
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.25arcsec_0.01gain_8.0ppb'
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
-tclean(
+#Channels are imaged in chunks by separate CASA processes and merged with a common beam (no MPI needed)
+tclean_cube_parallel(
     vis       = path_to_vis+vis_SO+'.contsub',
+    nworkers  = 8, #do not use more than 8 cores
     imagename = imagename,
     scales    = [0,2,4,8],
     cell      = '0.04825arcsec',
@@ -172,10 +181,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [70,71,72,73,74,75]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [6.60e-04,6.32e-04,6.25e-04,6.31e-04,6.37e-04,6.32e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SOwide.contsub_image_natural_1.0sigma_uvtaper0.25arcsec_0.01gain_8.0ppb.image
@@ -231,10 +240,10 @@ tclean(
     imsize    = 800,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [8.39e-04,8.16e-04,8.32e-04,8.46e-04,8.31e-04,8.21e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.5arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -259,10 +268,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [6.32e-04,6.26e-04,6.32e-04,6.37e-04,6.32e-04,6.31e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.25arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -287,10 +296,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.88e-04,5.83e-04,5.89e-04,5.90e-04,5.87e-04,5.86e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.2arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -315,10 +324,10 @@ tclean(
     imsize    = 1200,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.44e-04,5.38e-04,5.45e-04,5.41e-04,5.39e-04,5.38e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.15arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -343,10 +352,10 @@ tclean(
     imsize    = 1440,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.00e-04,4.95e-04,5.00e-04,4.94e-04,4.92e-04,4.90e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -371,10 +380,10 @@ tclean(
     imsize    = 2000,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [4.52e-04,4.48e-04,4.51e-04,4.43e-04,4.39e-04,4.36e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new.image
@@ -398,10 +407,10 @@ tclean(
     imsize    = 4000,
     **tclean_kwargs
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [3.93e-04,3.94e-04,3.92e-04,3.81e-04,3.73e-04,3.66e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new.image
@@ -411,9 +420,15 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #rms: 3.82e-01 mJy/beam
 #Peak SNR: 5.25
 
+#The Keplerian masks are computed on the tclean grid from the MS phase centre (no dirty cube, no prior image needed)
+#and cached in keplerian_mask_cache/; the beams are those of the corresponding images without the Keplerian mask
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.5arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.079625arcsec',imsize=800,beam=(0.720,0.637,-6.54),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -429,10 +444,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [8.40e-04,8.15e-04,8.28e-04,8.47e-04,8.30e-04,8.23e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.5arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -443,8 +458,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 7.93
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.25arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.04825arcsec',imsize=1200,beam=(0.428,0.386,-11.73),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -460,10 +479,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [6.32e-04,6.25e-04,6.28e-04,6.34e-04,6.31e-04,6.32e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.25arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -474,8 +493,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 6.48
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.2arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.041arcsec',imsize=1200,beam=(0.367,0.328,-20.29),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -491,10 +514,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.89e-04,5.83e-04,5.85e-04,5.87e-04,5.86e-04,5.88e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.2arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -505,8 +528,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 5.96
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.15arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.033arcsec',imsize=1200,beam=(0.305,0.264,-29.12),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -522,10 +549,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.44e-04,5.38e-04,5.42e-04,5.39e-04,5.38e-04,5.39e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.15arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -536,8 +563,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 5.59
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.025125arcsec',imsize=1440,beam=(0.247,0.201,-32.14),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -553,10 +584,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [5.01e-04,4.95e-04,4.98e-04,4.92e-04,4.92e-04,4.91e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.1arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -567,8 +598,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 5.72
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.0, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.017625arcsec',imsize=2000,beam=(0.185,0.141,-29.71),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.0,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -584,10 +619,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [4.53e-04,4.48e-04,4.49e-04,4.42e-04,4.39e-04,4.37e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_uvtaper0.05arcsec_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -598,8 +633,12 @@ exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwr
 #Peak SNR: 5.99
 
 imagename = vis_SO[:-3]+'.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask'
-make_mask(image=imagename[:-9]+'.image', inc=19, PA=240., mstar=1.4, dist=156., vlsr=5.9e3, nbeams=1.25, r_min=0.0, r_max=1.0)
 keplmask = imagename[:-9]+'.mask.image'
+make_mask_fast(
+    vis=path_to_vis+vis_SO+'.contsub',cell='0.009arcsec',imsize=4000,beam=(0.091,0.072,-18.61),outfile=keplmask,
+    start=tclean_kwargs_keplmask['start'],width=tclean_kwargs_keplmask['width'],nchan=tclean_kwargs_keplmask['nchan'],
+    restfreq=tclean_kwargs_keplmask['restfreq'],inc=19,PA=240.,mstar=1.4,dist=156.,vlsr=5.9e3,nbeams=1.25,r_min=0.0,r_max=1.0
+)
 for ext in ['.image','.mask','.model','.pb','.psf','.residual','.sumwt','.image.fits']:
     os.system('rm -rf '+ imagename + ext)
 tclean(
@@ -614,10 +653,10 @@ tclean(
     mask      = keplmask,
     **tclean_kwargs_keplmask
 )
-estimate_SNR(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+estimate_SNR_cached(imagename+'.image',disk_mask=mask,noise_mask=noise_annulus)
+noise = noise_spectrum(imagename+'.image',noise_region=noise_annulus)
 for _chans in [3,4,5,6,7,8]:
-    rms = imstat(imagename=imagename+'.image',region=noise_annulus,chans=f'{_chans}')['rms'][0]
-    print('#rms: %.2e Jy/beam' %rms)
+    print('#rms: %.2e Jy/beam' %noise['rms'][_chans])
 #rms: [3.93e-04,3.94e-04,3.92e-04,3.81e-04,3.73e-04,3.67e-04] Jy/beam
 exportfits(imagename=imagename+'.image',fitsimage=imagename+'.image.fits',overwrite=True)
 #MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_natural_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask.image
@@ -644,27 +683,35 @@ imagenames = [
     'natural_1.0sigma_0.01gain_8.0ppb_fewchans_new_keplmask',
 ]
 
+#All the moment maps of each cube and their noise in a single read of the cube: M0 without clipping and M8 over
+#all channels and over the two sets of channels with the line emission (the ones whose rms is printed above)
+moment_products = {
+    **default_moment_products,
+    **bestchans_moment_products([3,4,5,6,7],suffix='bestchans_37'),
+    **bestchans_moment_products([2,3,4,5,6,7,8],suffix='bestchans_28'),
+}
+moments = {}
 for _fname in imagenames:
-    imagename = f'./integrated_intensity_8.0ppb_fewchans_new/MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M0_noclip.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam m/s
-    print('#noclip rms_ii: %.2e Jy/beam m/s' %rms)
+    moments[_fname] = compute_moments(
+        imagename     = f'{vis_SO[:-3]}.contsub_image_{_fname}.image',
+        products      = moment_products,
+        noise_annulus = noise_annulus,
+        output_folder = {0:'./integrated_intensity_8.0ppb_fewchans_new',8:'./peak_intensity_8.0ppb_fewchans_new'},
+    )
 
-    imagename = f'./integrated_intensity_8.0ppb_fewchans_new/MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M0_bestchans.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam m/s
-    print('#bestchans rms_ii: %.2e Jy/beam m/s' %rms)
+for _fname in imagenames:
+    print('#noclip rms_ii: %.2e Jy/beam m/s' %moments[_fname]['M0_noclip_rms'])
+    for _chans in ['37','28']:
+        print(f'#bestchans_{_chans} rms_ii: %.2e Jy/beam m/s' %moments[_fname][f'M0_bestchans_{_chans}_rms'])
 
 #rms_noclip:       5.28e+00,3.95e+00,3.64e+00,3.31e+00,2.98e+00,2.62e+00,2.15e+00,5.30e+00,3.95e+00,3.63e+00,3.31e+00,2.98e+00,2.62e+00,2.15e+00 Jy/beam m/s
 #rms_bestchans_37: 3.83e+00,2.83e+00,2.61e+00,2.38e+00,2.15e+00,1.90e+00,1.57e+00,3.84e+00,2.83e+00,2.60e+00,2.38e+00,2.15e+00,1.90e+00,1.57e+00 Jy/beam m/s
 #rms_bsetchans_28: 4.64e+00,3.48e+00,3.21e+00,2.92e+00,2.64e+00,2.32e+00,1.90e+00,4.65e+00,3.48e+00,3.20e+00,2.38e+00,2.63e+00,2.31e+00,1.90e+00 Jy/beam m/s
 
 for _fname in imagenames:
-    imagename = f'./peak_intensity_8.0ppb_fewchans_new/MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M8_noclip.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam
-    print('#noclip rms_pi: %.2e Jy/beam' %rms)
-
-    imagename = f'./peak_intensity_8.0ppb_fewchans_new/MWC_758_SBLB_no_ave_selfcal_time_ave_SO.contsub_image_{_fname}.image_M8_bestchans.fits'
-    rms = imstat(imagename=imagename,region=noise_annulus)['rms'][0] #Jy/beam
-    print('#bestchans rms_pi: %.2e Jy/beam' %rms)
+    print('#noclip rms_pi: %.2e Jy/beam' %moments[_fname]['M8_rms'])
+    for _chans in ['37','28']:
+        print(f'#bestchans_{_chans} rms_pi: %.2e Jy/beam' %moments[_fname][f'M8_bestchans_{_chans}_rms'])
 
 #rms_noclip:       1.40e-03,1.04e-03,9.58e-04,8.77e-04,7.97e-04,7.10e-04,6.05e-04,1.40e-03,1.04e-03,9.59e-04,8.78e-04,7.98e-04,7.11e-04,6.06e-04 Jy/beam
 #rms_bestchans_37: 1.06e-03,7.93e-04,7.37e-04,6.80e-04,6.25e-04,5.66e-04,4.96e-04,1.06e-03,7.91e-04,7.36e-04,6.80e-04,6.25e-04,5.66e-04,4.96e-04 Jy/beam
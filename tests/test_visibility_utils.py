@@ -0,0 +1,183 @@
+"""
+Tests of visibility_utils.py. The helper modules are execfile'd in CASA, so they are exec'd here into a namespace
+holding a minimal in-memory stand-in of the CASA table tool (tb) instead of casatools.
+"""
+
+import os
+import re
+import numpy as np
+import pytest
+
+utils_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'visibility_utils.py')
+
+
+class _Selection:
+    """
+    Rows of a table, as returned by tb.selectrows/tb.query.
+    """
+    def __init__(self, table, rows):
+        self.table,self.rows = table,np.asarray(rows,dtype=int)
+
+    def rownumbers(self):
+        return self.rows
+
+    def nrows(self):
+        return len(self.rows)
+
+    def getcol(self, column, startrow=0, nrow=-1):
+        rows = self.rows[startrow:] if nrow < 0 else self.rows[startrow:startrow+nrow]
+        return self.table.columns[column][...,rows]
+
+    def putcol(self, column, values):
+        columns = self.table.columns
+        if columns[column] is None:
+            columns[column] = np.zeros(values.shape[:-1]+(self.table.nrows(),),dtype=values.dtype)
+        columns[column][...,self.rows] = values
+
+    def close(self):
+        pass
+
+
+class _Table:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def nrows(self):
+        return next(len(values) if isinstance(values,list) else values.shape[-1] for values in self.columns.values() if values is not None)
+
+
+class FakeTableTool:
+    """
+    In-memory tables keyed by path. The main table of a multi-MS is the concatenation of its sub-MSs, as the
+    reference table virtualconcat writes.
+    """
+    def __init__(self):
+        self.tables = {}
+        self.table  = None
+
+    def open(self, path, nomodify=True):
+        path = os.path.abspath(path)
+        submss = os.path.join(path,'SUBMSS')
+        if path not in self.tables and os.path.isdir(submss):
+            members = [self.tables[os.path.join(submss,name)] for name in sorted(os.listdir(submss))]
+            names = [name for name in members[0].columns if all(m.columns.get(name) is not None for m in members)]
+            self.table = _Table({name:np.concatenate([m.columns[name] for m in members],axis=-1) for name in names})
+        elif path.endswith(('SPECTRAL_WINDOW','DATA_DESCRIPTION')) and os.path.isdir(os.path.join(os.path.dirname(path),'SUBMSS')):
+            self.table = self.tables[os.path.join(os.path.dirname(path),'SUBMSS',sorted(os.listdir(os.path.join(os.path.dirname(path),'SUBMSS')))[0],os.path.basename(path))]
+        else:
+            self.table = self.tables[path]
+
+    def close(self):
+        self.table = None
+
+    def nrows(self):
+        return self.table.nrows()
+
+    def colnames(self):
+        return [name for name,values in self.table.columns.items() if values is not None]
+
+    def getcell(self, column, row):
+        return self.table.columns[column][row]
+
+    def getcol(self, column, startrow=0, nrow=-1):
+        return _Selection(self.table,np.arange(self.nrows())).getcol(column,startrow,nrow)
+
+    def selectrows(self, rows):
+        return _Selection(self.table,rows)
+
+    def query(self, taql):
+        keep = np.ones(self.nrows(),dtype=bool)
+        for column,value in re.findall(r'(\w+)==(\d+)',taql):
+            keep &= self.table.columns[column] == int(value)
+        return _Selection(self.table,np.nonzero(keep)[0])
+
+    def getdminfo(self):
+        return {'*1':{'NAME':'StandardStMan','COLUMNS':self.colnames()}}
+
+    def getcoldesc(self, column):
+        return {'valueType':str(self.table.columns[column].dtype)}
+
+    def removecols(self, columns):
+        for column in columns:
+            self.table.columns[column] = None
+
+    def addcols(self, desc, dminfo):
+        for column in desc:
+            self.table.columns[column] = None
+
+
+def _add_ms(tb, path, obsid, nrows, rng, freqs=(230e9,230.1e9)):
+    os.makedirs(path)
+    for name in ('SPECTRAL_WINDOW','DATA_DESCRIPTION'):
+        os.makedirs(os.path.join(path,name))
+    data = (rng.normal(size=(2,len(freqs),nrows))+1j*rng.normal(size=(2,len(freqs),nrows))).astype(np.complex64)
+    tb.tables[os.path.abspath(path)] = _Table({
+        'DATA':data,'FLAG':np.zeros(data.shape,dtype=bool),'WEIGHT':rng.uniform(1.,2.,size=(2,nrows)).astype(np.float32),
+        'UVW':rng.normal(scale=100.,size=(3,nrows)),'OBSERVATION_ID':np.full(nrows,obsid),
+        'ANTENNA1':np.zeros(nrows,dtype=int),'ANTENNA2':np.ones(nrows,dtype=int),'DATA_DESC_ID':np.zeros(nrows,dtype=int),
+    })
+    tb.tables[os.path.abspath(os.path.join(path,'SPECTRAL_WINDOW'))] = _Table({'CHAN_FREQ':[np.array(freqs)]})
+    tb.tables[os.path.abspath(os.path.join(path,'DATA_DESCRIPTION'))] = _Table({'SPECTRAL_WINDOW_ID':np.array([0])})
+
+
+@pytest.fixture
+def utils():
+    namespace = {'tb':FakeTableTool()}
+    with open(utils_path) as f:
+        exec(compile(f.read(),utils_path,'exec'),namespace)
+    return namespace
+
+
+def _read_all(utils, vis):
+    """
+    All the visibilities of an MS, sorted by u (the chunk order differs between the main table and the sub-MSs).
+    """
+    chunks = list(utils['iter_ms_visibilities'](vis))
+    columns = [np.concatenate([chunk[k] for chunk in chunks]) for k in range(5)]
+    order = np.argsort(columns[1])
+    return [column[order] for column in columns]
+
+
+def test_compressed_multi_ms_round_trip(utils, tmp_path):
+    tb  = utils['tb']
+    rng = np.random.default_rng(1)
+    mms = str(tmp_path/'concat.ms')
+    _add_ms(tb,os.path.join(mms,'SUBMSS','concat.0000.ms'),0,50,rng)
+    _add_ms(tb,os.path.join(mms,'SUBMSS','concat.0001.ms'),1,70,rng)
+    data = {name:tb.tables[os.path.abspath(os.path.join(mms,'SUBMSS',name))].columns['DATA'].copy() for name in ('concat.0000.ms','concat.0001.ms')}
+    before = _read_all(utils,mms)
+
+    utils['compress_ms_columns'](mms,columns=('DATA',))
+    assert all(os.path.isfile(os.path.join(mms,'SUBMSS',name,'COMPRESSED_COLUMNS','index.json')) for name in data)
+    after = _read_all(utils,mms)
+    for a,b in zip(before,after):
+        np.testing.assert_array_equal(a,b)
+    view = utils['ms_observation_view'](mms,1)
+    assert np.all(_read_all(utils,view)[0] == 1) and len(_read_all(utils,view)[0]) == 2*70
+
+    utils['decompress_ms_columns'](mms)
+    for name,values in data.items():
+        np.testing.assert_array_equal(tb.tables[os.path.abspath(os.path.join(mms,'SUBMSS',name))].columns['DATA'],values)
+        assert not os.path.exists(os.path.join(mms,'SUBMSS',name,'COMPRESSED_COLUMNS'))
+
+
+def test_bin_vis_uv_fluxscale(utils):
+    """
+    Visibilities divided by fluxscale=2 bin to half their value, and an EB twice as bright with fluxscale=2 bins to the
+    same value as the reference EB.
+    """
+    bin_vis_uv = utils['_bin_vis_uv']
+    u,v = np.array([100.,100.,-300.]),np.array([50.,50.,-20.])
+    vis,wgt = np.array([1.,3.,2.],dtype=complex),np.array([1.,3.,2.])
+    _,_,re,_ = bin_vis_uv([(u,v,vis,wgt)],du=10.)
+    _,_,re_scaled,_ = bin_vis_uv([(u,v,vis,wgt)],du=10.,fluxscale=[2.])
+    np.testing.assert_allclose(re_scaled,0.5*re)
+    _,_,re_joint,_ = bin_vis_uv([(u,v,vis,wgt),(u,v,2.*vis,wgt/4.)],du=10.,fluxscale=[1.,2.])
+    np.testing.assert_allclose(re_joint,re)
+
+
+def test_binned_profiles_empty_selection(utils, tmp_path):
+    ms = str(tmp_path/'EB.ms')
+    _add_ms(utils['tb'],ms,0,20,np.random.default_rng(2))
+    S,W = utils['ms_binned_profiles'](utils['ms_observation_view'](ms,3),incl=30.,PA=60.,nsectors=4)
+    assert S.shape == W.shape == (0,39,4)
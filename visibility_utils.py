@@ -0,0 +1,1260 @@
+"""
+Visibility-domain helpers working on the .vis.npz files written by export_MS (u, v in lambda, Vis, Wgt).
+Load with execfile() after reduction_utils, like imaging_utils.py.
+"""
+
+import os
+import json
+import sqlite3
+import hashlib
+import numpy as np
+
+arcsec = np.pi/180./3600. #rad
+
+#Per-EB flux scales (gencal 'amp' parameters, as for rescale_flux), applied on read instead of writing _rescaled.ms copies
+flux_scale_registry = 'flux_scales.json'
+
+def _read_flux_scales(registry=flux_scale_registry):
+    if not os.path.isfile(registry):
+        return {}
+    with open(registry) as f:
+        return json.load(f)
+
+def set_flux_scale(vis, gencalparameter, registry=flux_scale_registry):
+    """
+    Record the flux scale of an MS (same gencalparameter as rescale_flux, e.g. [1.017]) without writing any data.
+    It is applied when reading its .vis.npz export (load_vis_npz, scaled_vis_npz) and through
+    flux_scale_caltable in the next gaincal/applycal.
+    """
+    scales = _read_flux_scales(registry)
+    scales[os.path.basename(vis.rstrip('/'))] = float(np.atleast_1d(gencalparameter)[0])
+    with open(registry,'w') as f:
+        json.dump(scales,f,indent=1,sort_keys=True)
+
+def get_flux_scale(vis, registry=flux_scale_registry):
+    """
+    gencal parameter recorded for an MS (or for the MS of a .vis.npz export), 1 if none.
+    """
+    name = os.path.basename(vis.rstrip('/'))
+    if name.endswith('.vis.npz'):
+        name = name[:-len('.vis.npz')]+'.ms'
+    return _read_flux_scales(registry).get(name,1.)
+
+def load_vis_npz(filename, apply_flux_scale=True):
+    """
+    Read a .vis.npz file, dropping flagged (zero-weight) visibilities.
+    If apply_flux_scale, the flux scale g recorded with set_flux_scale is applied as gencal/applycal would
+    (Vis/g^2, Wgt*g^4).
+    Returns:
+    u, v (lambda), Vis (complex) and Wgt as flat arrays
+    """
+    data = np.load(filename)
+    u,v  = data['u'].ravel(),data['v'].ravel()
+    vis  = data['Vis'].ravel()
+    wgt  = data['Wgt'].ravel()
+    valid = (wgt > 0) & np.isfinite(vis)
+    u,v,vis,wgt = u[valid],v[valid],vis[valid],wgt[valid]
+    gain = get_flux_scale(filename) if apply_flux_scale else 1.
+    if gain != 1.:
+        vis,wgt = vis/gain**2,wgt*gain**4
+    return u,v,vis,wgt
+
+def scaled_vis_npz(filename):
+    """
+    .vis.npz file with the recorded flux scale applied, for the functions that read the files themselves
+    (estimate_flux_scale, plot_deprojected). Returns filename itself if no scale is recorded, otherwise
+    writes (once per scale) and returns <name>_fluxscaled.vis.npz.
+    """
+    gain = get_flux_scale(filename)
+    if gain == 1.:
+        return filename
+    scaled = filename.replace('.vis.npz','_fluxscaled.vis.npz')
+    if os.path.isfile(scaled) and np.load(scaled)['flux_scale'] == gain:
+        return scaled
+    data = dict(np.load(filename))
+    data['Vis'],data['Wgt'] = data['Vis']/gain**2,data['Wgt']*gain**4
+    np.savez(scaled,flux_scale=gain,**data)
+    return scaled
+
+def concat_flux_scales(vis_list):
+    """
+    Flux scales per observation id of the MS obtained by concatenating vis_list (in that order),
+    e.g. to build the flux_scale_caltable of a concat of un-rescaled EBs.
+    """
+    scales = {}
+    for vis in vis_list:
+        for i in ms_metadata(vis)['observations']:
+            scales[len(scales)] = get_flux_scale(vis)
+    return scales
+
+def flux_scale_caltable(vis, obs_scales=None, caltable=None):
+    """
+    gencal 'amp' table applying the recorded flux scales, to be pre-applied (gaintable) in the next gaincal/applycal
+    instead of splitting out _rescaled.ms copies.
+    Parameters:
+    vis:        MS the table is for
+    obs_scales: dictionary {observation id: gencal parameter} for a concatenated MS (see concat_flux_scales),
+                default is the scale recorded for vis applied to all the data
+    caltable:   name of the table, default vis+'.fluxscale'
+    Returns:
+    name of the table
+    """
+    if caltable is None:
+        caltable = vis.rstrip('/')+'.fluxscale'
+    os.system('rm -rf '+caltable)
+    if obs_scales is None:
+        gencal(vis=vis,caltable=caltable,caltype='amp',parameter=[get_flux_scale(vis)])
+        return caltable
+    #gencal selects by spw, so map the observations onto their spws
+    spw_scales = {}
+    for obsid,scale in obs_scales.items():
+        for spw in ms_spws_for_observation(vis,obsid):
+            if spw_scales.get(spw,scale) != scale:
+                raise ValueError(f'spw {spw} is shared by observations with different flux scales: concatenate without merging spws')
+            spw_scales[spw] = scale
+    spws = sorted(spw_scales)
+    gencal(
+        vis=vis,caltable=caltable,caltype='amp',
+        spw=','.join(str(spw) for spw in spws),parameter=[spw_scales[spw] for spw in spws]
+    )
+    return caltable
+
+#Persistent index of the MS metadata (spws, scans, observations, antennas, baselines), built once per MS with msmd/tb
+#and rebuilt when one of its tables is modified. ms_metadata() also keeps the records in memory for repeated lookups
+ms_metadata_index = 'ms_metadata.sqlite'
+_ms_metadata_cache = {}
+
+_ms_metadata_schema = """
+CREATE TABLE IF NOT EXISTS ms (vis TEXT PRIMARY KEY, stamp INTEGER);
+CREATE TABLE IF NOT EXISTS spws (vis TEXT, spw INTEGER, nchan INTEGER, ref_freq REAL, chan_freqs BLOB, chan_widths BLOB);
+CREATE TABLE IF NOT EXISTS observations (vis TEXT, obsid INTEGER, t0 REAL, t1 REAL);
+CREATE TABLE IF NOT EXISTS scans (vis TEXT, obsid INTEGER, scan INTEGER, spws TEXT, t0 REAL, t1 REAL);
+CREATE TABLE IF NOT EXISTS antennas (vis TEXT, antenna INTEGER, name TEXT, station TEXT, x REAL, y REAL, z REAL);
+CREATE TABLE IF NOT EXISTS baselines (vis TEXT, antenna1 TEXT, antenna2 TEXT, length REAL);
+"""
+
+def _ms_table_stamp(vis):
+    """
+    Latest modification time (ns) of the table.dat files of an MS and of its subtables, including the sub-MSs
+    (and their subtables) of a multi-MS.
+    """
+    roots = [vis]
+    submss = os.path.join(vis,'SUBMSS')
+    if os.path.isdir(submss):
+        roots += sorted(entry.path for entry in os.scandir(submss) if entry.is_dir())
+    stamps = []
+    for root in roots:
+        stamps.append(os.stat(os.path.join(root,'table.dat')).st_mtime_ns)
+        for entry in os.scandir(root):
+            if entry.is_dir() and entry.name != 'SUBMSS' and os.path.isfile(os.path.join(entry.path,'table.dat')):
+                stamps.append(os.stat(os.path.join(entry.path,'table.dat')).st_mtime_ns)
+    return max(stamps)
+
+def _build_ms_metadata(vis):
+    """
+    Read the metadata of an MS with msmd and tb (one open of each).
+    """
+    metadata = {'spws':{},'observations':{},'scans':[],'antennas':{},'baselines':[]}
+    msmd.open(vis)
+    try:
+        for spw in range(msmd.nspw()):
+            chan_freqs = np.asarray(msmd.chanfreqs(spw),dtype=float)
+            metadata['spws'][spw] = {
+                'nchan':len(chan_freqs),'ref_freq':float(msmd.reffreq(spw)['m0']['value']),
+                'chan_freqs':chan_freqs,'chan_widths':np.asarray(msmd.chanwidths(spw),dtype=float),
+            }
+        used_antennas = set()
+        for obsid in range(msmd.nobservations()):
+            t_obs = []
+            for scan in msmd.scannumbers(obsid=obsid):
+                times = msmd.timesforscan(scan,obsid=obsid)
+                metadata['scans'].append({
+                    'obsid':obsid,'scan':int(scan),'spws':[int(spw) for spw in msmd.spwsforscan(scan,obsid=obsid)],
+                    't0':float(np.min(times)),'t1':float(np.max(times)),
+                })
+                t_obs += [np.min(times),np.max(times)]
+                used_antennas.update(int(antenna) for antenna in msmd.antennasforscan(scan,obsid=obsid))
+            metadata['observations'][obsid] = {'t0':float(min(t_obs)),'t1':float(max(t_obs))}
+    finally:
+        msmd.close()
+    tb.open(os.path.join(vis,'ANTENNA'))
+    names,stations,positions = tb.getcol('NAME'),tb.getcol('STATION'),tb.getcol('POSITION').T
+    tb.close()
+    for antenna in sorted(used_antennas):
+        metadata['antennas'][antenna] = {'name':names[antenna],'station':stations[antenna],'position':positions[antenna]}
+    #Baselines between the antennas with data, sorted by length as au.getBaselineLengths
+    antennas = sorted(used_antennas)
+    for k,a1 in enumerate(antennas):
+        for a2 in antennas[k+1:]:
+            length = float(np.linalg.norm(positions[a1]-positions[a2]))
+            metadata['baselines'].append((names[a1],names[a2],length))
+    metadata['baselines'].sort(key=lambda baseline: baseline[2])
+    return metadata
+
+def _write_ms_metadata(db, vis, stamp, metadata):
+    db.executescript(_ms_metadata_schema)
+    for table in ('ms','spws','observations','scans','antennas','baselines'):
+        db.execute(f'DELETE FROM {table} WHERE vis=?',(vis,))
+    db.execute('INSERT INTO ms VALUES (?,?)',(vis,stamp))
+    db.executemany('INSERT INTO spws VALUES (?,?,?,?,?,?)',[
+        (vis,spw,s['nchan'],s['ref_freq'],s['chan_freqs'].tobytes(),s['chan_widths'].tobytes())
+        for spw,s in metadata['spws'].items()
+    ])
+    db.executemany('INSERT INTO observations VALUES (?,?,?,?)',[
+        (vis,obsid,o['t0'],o['t1']) for obsid,o in metadata['observations'].items()
+    ])
+    db.executemany('INSERT INTO scans VALUES (?,?,?,?,?,?)',[
+        (vis,s['obsid'],s['scan'],','.join(str(spw) for spw in s['spws']),s['t0'],s['t1']) for s in metadata['scans']
+    ])
+    db.executemany('INSERT INTO antennas VALUES (?,?,?,?,?,?,?)',[
+        (vis,antenna,a['name'],a['station'],*(float(x) for x in a['position'])) for antenna,a in metadata['antennas'].items()
+    ])
+    db.executemany('INSERT INTO baselines VALUES (?,?,?,?)',[(vis,)+baseline for baseline in metadata['baselines']])
+    db.commit()
+
+def _read_ms_metadata(db, vis):
+    metadata = {'spws':{},'observations':{},'scans':[],'antennas':{},'baselines':[]}
+    for spw,nchan,ref_freq,chan_freqs,chan_widths in db.execute(
+        'SELECT spw,nchan,ref_freq,chan_freqs,chan_widths FROM spws WHERE vis=? ORDER BY spw',(vis,)
+    ):
+        metadata['spws'][spw] = {
+            'nchan':nchan,'ref_freq':ref_freq,
+            'chan_freqs':np.frombuffer(chan_freqs,dtype=float),'chan_widths':np.frombuffer(chan_widths,dtype=float),
+        }
+    for obsid,t0,t1 in db.execute('SELECT obsid,t0,t1 FROM observations WHERE vis=? ORDER BY obsid',(vis,)):
+        metadata['observations'][obsid] = {'t0':t0,'t1':t1}
+    for obsid,scan,spws,t0,t1 in db.execute('SELECT obsid,scan,spws,t0,t1 FROM scans WHERE vis=? ORDER BY obsid,scan',(vis,)):
+        metadata['scans'].append({'obsid':obsid,'scan':scan,'spws':[int(spw) for spw in spws.split(',') if spw],'t0':t0,'t1':t1})
+    for antenna,name,station,x,y,z in db.execute('SELECT antenna,name,station,x,y,z FROM antennas WHERE vis=? ORDER BY antenna',(vis,)):
+        metadata['antennas'][antenna] = {'name':name,'station':station,'position':np.array([x,y,z])}
+    metadata['baselines'] = list(db.execute('SELECT antenna1,antenna2,length FROM baselines WHERE vis=? ORDER BY length',(vis,)))
+    return metadata
+
+def ms_metadata(vis, index=None):
+    """
+    Metadata of an MS from the persistent index (ms_metadata_index), built with msmd/tb the first time and rebuilt
+    when a table of the MS has been modified since. Repeated lookups are served from memory after a stat of the
+    table files.
+    Returns:
+    dictionary with 'spws' {spw: nchan, ref_freq, chan_freqs, chan_widths (Hz)}, 'observations' {obsid: t0, t1},
+    'scans' [obsid, scan, spws, t0, t1], 'antennas' {id: name, station, position (ITRF, m)} and
+    'baselines' [(antenna1, antenna2, length (m))] sorted by length; times in MJD seconds
+    """
+    index = ms_metadata_index if index is None else index
+    key   = os.path.abspath(vis.rstrip('/'))
+    stamp = _ms_table_stamp(key)
+    cached = _ms_metadata_cache.get((index,key))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with sqlite3.connect(index) as db:
+        db.executescript(_ms_metadata_schema)
+        row = db.execute('SELECT stamp FROM ms WHERE vis=?',(key,)).fetchone()
+        if row is not None and row[0] == stamp:
+            metadata = _read_ms_metadata(db,key)
+        else:
+            metadata = _build_ms_metadata(key)
+            _write_ms_metadata(db,key,stamp,metadata)
+    _ms_metadata_cache[(index,key)] = (stamp,metadata)
+    return metadata
+
+def ms_chan_freqs(vis, spw):
+    """
+    Channel frequencies (Hz) of a spw.
+    """
+    return ms_metadata(vis)['spws'][int(spw)]['chan_freqs']
+
+def ms_baseline_lengths(vis):
+    """
+    Baselines [(antenna1, antenna2, length (m))] sorted by length, in place of au.getBaselineLengths.
+    """
+    return ms_metadata(vis)['baselines']
+
+def ms_max_baseline(vis):
+    """
+    Longest baseline (m) between antennas with data.
+    """
+    return ms_baseline_lengths(vis)[-1][2]
+
+def ms_spws_for_observation(vis, obsid):
+    """
+    Sorted spws with data in an observation.
+    """
+    return sorted({spw for scan in ms_metadata(vis)['scans'] if scan['obsid'] == obsid for spw in scan['spws']})
+
+def ms_lsrk_freqs(vis, index=None):
+    """
+    LSRK channel frequencies (Hz) of all the spws of an MS (ms.cvelfreqs at the start of the first scan of each spw,
+    i.e. of its own EB in a concatenated MS), stored in the metadata index next to ms_metadata.
+    Returns:
+    dictionary {spw: frequencies}
+    """
+    index = ms_metadata_index if index is None else index
+    key   = os.path.abspath(vis.rstrip('/'))
+    stamp = _ms_table_stamp(key)
+    cached = _ms_metadata_cache.get((index,key,'lsrk'))
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with sqlite3.connect(index) as db:
+        db.execute('CREATE TABLE IF NOT EXISTS lsrk_freqs (vis TEXT, stamp INTEGER, spw INTEGER, freqs BLOB)')
+        rows = db.execute('SELECT spw,freqs FROM lsrk_freqs WHERE vis=? AND stamp=?',(key,stamp)).fetchall()
+        if rows:
+            freqs = {spw:np.frombuffer(blob,dtype=float) for spw,blob in rows}
+        else:
+            metadata = ms_metadata(key,index=index)
+            obstimes = {}
+            for scan in metadata['scans']:
+                for spw in scan['spws']:
+                    obstimes[spw] = min(obstimes.get(spw,scan['t0']),scan['t0'])
+            ms.open(key)
+            try:
+                freqs = {}
+                for spw in metadata['spws']:
+                    obstime = qa.time(qa.quantity(obstimes[spw],'s'),form='ymd',prec=9)[0] if spw in obstimes else ''
+                    freqs[spw] = np.asarray(
+                        ms.cvelfreqs(spwids=[spw],mode='channel',outframe='LSRK',obstime=obstime),dtype=float
+                    )
+            finally:
+                ms.close()
+            db.execute('DELETE FROM lsrk_freqs WHERE vis=?',(key,))
+            db.executemany('INSERT INTO lsrk_freqs VALUES (?,?,?,?)',[(key,stamp,spw,f.tobytes()) for spw,f in freqs.items()])
+    _ms_metadata_cache[(index,key,'lsrk')] = (stamp,freqs)
+    return freqs
+
+def ms_summary(vis, listfile, observation=None):
+    """
+    Write a listobs-like summary (observations, scans, spws, antennas) of an MS from the metadata index, in place of
+    listobs. The file is only rewritten when the MS has changed since it was written.
+    Parameters:
+    vis:         MS
+    listfile:    output text file
+    observation: only summarise this observation (EB) of a concatenated MS, as listobs(observation=...)
+    """
+    key = os.path.abspath(vis.rstrip('/'))
+    header = f'# {key} stamp {_ms_table_stamp(key)} observation {observation}'
+    if os.path.isfile(listfile):
+        with open(listfile) as f:
+            if f.readline().rstrip('\n') == header:
+                return
+    metadata = ms_metadata(key)
+    obsids = sorted(metadata['observations']) if observation is None else [int(observation)]
+    scans = [scan for scan in metadata['scans'] if scan['obsid'] in obsids]
+    spws = sorted({spw for scan in scans for spw in scan['spws']})
+    lines = [header,'','Observations (MJD seconds):']
+    lines += [f'  {obsid:3d}  {metadata["observations"][obsid]["t0"]:.1f} - {metadata["observations"][obsid]["t1"]:.1f}' for obsid in obsids]
+    lines += ['','Scans:  ObsId  Scan  t0 - t1  SpwIds']
+    lines += [f'  {s["obsid"]:3d}  {s["scan"]:4d}  {s["t0"]:.1f} - {s["t1"]:.1f}  {s["spws"]}' for s in scans]
+    lines += ['','Spectral windows:  SpwID  #Chans  Ch0 (MHz)  ChanWid (kHz)  RefFreq (MHz)']
+    for spw in spws:
+        s = metadata['spws'][spw]
+        lines.append(f'  {spw:3d}  {s["nchan"]:6d}  {s["chan_freqs"][0]/1e6:.3f}  {s["chan_widths"][0]/1e3:.3f}  {s["ref_freq"]/1e6:.3f}')
+    lines += ['','Antennas:  ID  Name  Station']
+    lines += [f'  {antenna:3d}  {a["name"]}  {a["station"]}' for antenna,a in metadata['antennas'].items()]
+    with open(listfile,'w') as f:
+        f.write('\n'.join(lines)+'\n')
+
+def combine_spw_map(vis):
+    """
+    spwmap for solutions made with combine='spw' on an MS (single EB or concatenated): every spw is mapped to the
+    first spw of its observation, e.g. [0]*8+[8]*8 for two EBs of 8 spws.
+    """
+    metadata = ms_metadata(vis)
+    spwmap = list(range(len(metadata['spws'])))
+    for obsid in metadata['observations']:
+        spws = ms_spws_for_observation(vis,obsid)
+        for spw in spws:
+            spwmap[spw] = spws[0]
+    return spwmap
+
+def line_channel_ranges(vis, rest_freqs, v_sys, velocity_range=(-15.,15.)):
+    """
+    Channels covering a velocity window around v_sys for several lines, in every spw of an MS (single EB or
+    concatenated, in its own spw numbering). All lines and all the channels of all spws are compared at once
+    on the LSRK frequencies of ms_lsrk_freqs (radio velocity convention).
+    Parameters:
+    vis:            MS
+    rest_freqs:     dictionary {line name: rest frequency (Hz)}
+    v_sys:          systemic velocity (km/s)
+    velocity_range: window (km/s) relative to v_sys
+    Returns:
+    dictionary {line name: [(observation id, spw, first channel, last channel), ...]} sorted by spw
+    """
+    c_kms  = 2.99792458e5
+    names  = list(rest_freqs)
+    f0     = np.array([rest_freqs[name] for name in names],dtype=float)
+    v      = v_sys+np.asarray(velocity_range,dtype=float)
+    f_high = f0*(1.-v.min()/c_kms)
+    f_low  = f0*(1.-v.max()/c_kms)
+
+    lsrk  = ms_lsrk_freqs(vis)
+    spws  = sorted(lsrk)
+    nchan = np.array([len(lsrk[spw]) for spw in spws])
+    start = np.concatenate([[0],np.cumsum(nchan)[:-1]])
+    freqs = np.concatenate([lsrk[spw] for spw in spws])
+    chan  = np.arange(len(freqs))-np.repeat(start,nchan)
+    #(lines, all channels) mask, reduced per spw
+    inside = (freqs[None,:] >= f_low[:,None]) & (freqs[None,:] <= f_high[:,None])
+    first  = np.minimum.reduceat(np.where(inside,chan,np.iinfo(np.int64).max),start,axis=1)
+    last   = np.maximum.reduceat(np.where(inside,chan,-1),start,axis=1)
+
+    spw_obs = {spw:obsid for obsid in ms_metadata(vis)['observations'] for spw in ms_spws_for_observation(vis,obsid)}
+    ranges = {name:[] for name in names}
+    for i,j in zip(*np.nonzero(last >= 0)):
+        ranges[names[i]].append((spw_obs.get(spws[j]),spws[j],int(first[i,j]),int(last[i,j])))
+    return ranges
+
+def spw_selection(ranges):
+    """
+    CASA spw selection string ('spw:first~last,...') of the channel ranges of one line from line_channel_ranges.
+    """
+    return ','.join(f'{spw}:{first}~{last}' for _,spw,first,last in ranges)
+
+def check_spw_selection(selection, expected, channel_tolerance=1):
+    """
+    Check a computed spw selection against one read by hand from listobs/get_flagchannels: same spws, and first and
+    last channels within channel_tolerance (the edge channels depend on the time the LSRK frequencies are taken at).
+    Returns:
+    the computed selection
+    """
+    def parse(string):
+        return {int(spw):tuple(int(c) for c in chans.split('~')) for spw,chans in (entry.split(':') for entry in string.split(','))}
+    computed,reference = parse(selection),parse(expected)
+    if set(computed) != set(reference) or any(
+        abs(computed[spw][0]-reference[spw][0]) > channel_tolerance or abs(computed[spw][-1]-reference[spw][-1]) > channel_tolerance
+        for spw in computed
+    ):
+        raise ValueError(f'computed spw selection {selection} does not match the expected {expected}')
+    return selection
+
+def line_spws_and_freqs(ranges, rest_freqs):
+    """
+    'line_spws' and 'line_freqs' arrays (one entry per line and spw, sorted by spw) of the ms_dict of
+    get_flagchannels/avg_cont, from line_channel_ranges.
+    """
+    entries = sorted((spw,rest_freqs[name]) for name,line_ranges in ranges.items() for _,spw,_,_ in line_ranges)
+    return np.array([spw for spw,_ in entries]),np.array([freq for _,freq in entries])
+
+def _largest_divisor(n, limit):
+    """
+    Largest divisor of n not above limit (at least 1), so that channel averaging does not drop channels.
+    """
+    for d in range(max(1,min(n,int(limit))),0,-1):
+        if n%d == 0:
+            return d
+    return 1
+
+def baseline_dependent_average(vis, outputvis, fov=None, reduction_fac=0.01, antenna_diam=12., max_timebin='300s',
+                               average_channels=True, nbaseline_groups=4, datacolumn='data', keepflags=False):
+    """
+    Baseline-dependent time and frequency averaging with mstransform, from a decorrelation tolerance instead of a
+    uniform timebin and one width_array per EB.
+    Time: rows are averaged up to max_timebin as long as the uvw of the averaged rows stay within maxuvwdistance, so
+    short baselines (whose uvw rotate slowly) are averaged much longer than long ones.
+    Frequency (average_channels, for continuum data only): the baselines are split in nbaseline_groups length groups
+    (geometric edges) and each group gets the widest channel bin (a divisor of the number of channels of each spw)
+    within the bandwidth-smearing tolerance of its longest baseline; the groups are then concatenated, so they
+    end up in separate spws.
+    The tolerance is a peak-response reduction of reduction_fac for a source at fov from the phase centre, using
+    sinc(x) ~ 1-x^2/6 for the linear phase ramp across one average. mstransform sums the weights of averaged data.
+    Parameters:
+    vis, outputvis:   input and output MS
+    fov:              radius (arcsec) of the emission to preserve, default is the primary beam FWHM at the highest
+                      frequency (as delta_freq_smearing, for the whole field)
+    reduction_fac:    response reduction factor, default is 1%
+    max_timebin:      longest time average
+    nbaseline_groups: number of baseline length groups for the channel averaging
+    Returns:
+    dictionary with the number of rows before and after, maxuvwdistance (m) and the groups (uvrange, chanbin)
+    """
+    c = 2.99792458e8
+    metadata = ms_metadata(vis)
+    f_max = max(s['chan_freqs'].max() for s in metadata['spws'].values())
+    theta = fov*arcsec if fov is not None else 1.13*c/f_max/antenna_diam
+    x = np.sqrt(6.*reduction_fac)
+    #Largest uv change (m, at the shortest wavelength) over one time average
+    max_uvw_distance = x*c/(np.pi*theta*f_max)
+
+    if average_channels:
+        lengths = np.array([length for _,_,length in metadata['baselines']])
+        edges = np.geomspace(lengths.min(),lengths.max(),nbaseline_groups+1)
+        #Move the inner edges halfway between baselines, so that no baseline falls in two (inclusive) uvranges
+        index = np.clip(np.searchsorted(lengths,edges[1:-1]),1,len(lengths)-1)
+        edges[1:-1] = 0.5*(lengths[index-1]+lengths[index])
+        edges[0],edges[-1] = 0.,lengths.max()*1.01
+    else:
+        edges = np.array([0.,np.inf])
+    spws = sorted(metadata['spws'])
+    groups,parts = [],[]
+    for k,(b0,b1) in enumerate(zip(edges[:-1],edges[1:])):
+        uvrange = f'{b0:.1f}~{b1:.1f}m' if np.isfinite(b1) else ''
+        if average_channels:
+            #Widest channel (Hz) within the tolerance on the longest baseline of the group
+            max_width = x*c/(np.pi*b1*theta)
+            chanbin = [
+                _largest_divisor(metadata['spws'][spw]['nchan'],max_width/np.abs(metadata['spws'][spw]['chan_widths']).max())
+                for spw in spws
+            ]
+        else:
+            chanbin = [1]*len(spws)
+        part = outputvis.rstrip('/')+f'.group{k}' if len(edges) > 2 else outputvis
+        os.system('rm -rf '+part)
+        mstransform(
+            vis=vis,outputvis=part,datacolumn=datacolumn,keepflags=keepflags,uvrange=uvrange,
+            timeaverage=True,timebin=max_timebin,maxuvwdistance=max_uvw_distance,
+            chanaverage=max(chanbin) > 1,chanbin=chanbin if max(chanbin) > 1 else 1,
+        )
+        groups.append({'uvrange':uvrange,'chanbin':chanbin})
+        parts.append(part)
+    if len(parts) > 1:
+        os.system('rm -rf '+outputvis)
+        concat(vis=parts,concatvis=outputvis,copypointing=False)
+        for part in parts:
+            os.system('rm -rf '+part)
+
+    nrows = []
+    for ms_name in (vis,outputvis):
+        tb.open(ms_name)
+        nrows.append(tb.nrows())
+        tb.close()
+    print(f'#{outputvis}: {nrows[1]} rows from {nrows[0]} ({100.*nrows[1]/nrows[0]:.1f}%), maxuvwdistance {max_uvw_distance:.2f} m')
+    for group in groups:
+        print(f"#  uvrange '{group['uvrange']}': chanbin {group['chanbin']}")
+    return {'nrows':tuple(nrows),'maxuvwdistance':max_uvw_distance,'groups':groups}
+
+def virtual_concat(vis, concatvis, keepcopy, materialize=False, **kwargs):
+    """
+    Concatenate EB MSs as a multi-MS (virtualconcat) instead of a physical concat: the joint dataset has the usual
+    consecutive observation and spw numbering for gaincal, applycal, split and tclean, but the data stay in the
+    per-EB sub-MSs and no subtables (e.g. SysCal) are merged.
+    virtualconcat moves the inputs into the multi-MS: with keepcopy=False no data are copied at all, but the input
+    MSs are gone afterwards, so use it only on dedicated products with no later consumer (e.g. the split/rescaled
+    outputs made for this concat). keepcopy=True copies the inputs first, as expensive as concat, when the
+    original EBs must survive. The choice is made at each call site.
+    Parameters:
+    vis:         list of MSs
+    concatvis:   name of the concatenated MS
+    keepcopy:    keep the input MSs (full copy) or move them into the multi-MS (no copy)
+    materialize: write a physical MS with concat instead (e.g. for a deliverable), see also materialize_concat
+    kwargs:      passed on to concat/virtualconcat (dirtol, freqtol, copypointing, ...)
+    """
+    if materialize:
+        concat(vis=vis,concatvis=concatvis,**kwargs)
+        return concatvis
+    virtualconcat(vis=vis,concatvis=concatvis,keepcopy=keepcopy,**kwargs)
+    return concatvis
+
+def materialize_concat(concatvis, outputvis, datacolumn='all'):
+    """
+    Write a multi-MS made by virtual_concat to a single physical MS, only when a monolithic MS is needed.
+    """
+    os.system('rm -rf '+outputvis)
+    split(vis=concatvis,outputvis=outputvis,datacolumn=datacolumn,keepmms=False)
+    return outputvis
+
+def _uv_cell_index(u, v, du, npix):
+    """
+    Index of the uv cell of each visibility in an npix x npix grid of cell du (lambda) centred on (0, 0),
+    and a boolean array of the visibilities falling inside the grid.
+    """
+    iu = np.round(u/du).astype(int)+npix//2
+    iv = np.round(v/du).astype(int)+npix//2
+    inside = (iu >= 0) & (iu < npix) & (iv >= 0) & (iv < npix)
+    return iv*npix+iu,inside
+
+def grid_visibilities(u, v, vis, wgt, du, npix, chunk_size=2000000):
+    """
+    Weighted average of the visibilities (and of their Hermitian conjugates at (-u, -v)) in the cells of an
+    npix x npix uv grid of cell du (lambda), accumulated in chunks.
+    Returns:
+    gridded visibilities and summed weights, both flattened (npix*npix)
+    """
+    sum_re = np.zeros(npix*npix)
+    sum_im = np.zeros(npix*npix)
+    sum_w  = np.zeros(npix*npix)
+    for i0 in range(0,len(u),chunk_size):
+        chunk = slice(i0,i0+chunk_size)
+        for sign in (1.,-1.):
+            index,inside = _uv_cell_index(sign*u[chunk],sign*v[chunk],du,npix)
+            index = index[inside]
+            w = wgt[chunk][inside]
+            V = vis[chunk][inside] if sign > 0 else np.conj(vis[chunk][inside])
+            sum_re += np.bincount(index,weights=w*V.real,minlength=npix*npix)
+            sum_im += np.bincount(index,weights=w*V.imag,minlength=npix*npix)
+            sum_w  += np.bincount(index,weights=w,minlength=npix*npix)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        gridded = np.where(sum_w > 0,(sum_re+1j*sum_im)/sum_w,0.)
+    return gridded,sum_w
+
+def _coarse_offset(u, v, vis, wgt, ref_grid, du, npix, chunk_size):
+    """
+    Offset (l, m in rad) at the peak of the cross-correlation image of a comparison and the gridded reference.
+    """
+    cross = np.zeros(npix*npix,dtype=complex)
+    for i0 in range(0,len(u),chunk_size):
+        chunk = slice(i0,i0+chunk_size)
+        index,inside = _uv_cell_index(u[chunk],v[chunk],du,npix)
+        index = index[inside]
+        product = wgt[chunk][inside]*vis[chunk][inside]*np.conj(ref_grid[index])
+        cross += np.bincount(index,weights=product.real,minlength=npix*npix)+1j*np.bincount(index,weights=product.imag,minlength=npix*npix)
+    correlation = np.abs(np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(cross.reshape(npix,npix)))))
+    iy,ix = np.unravel_index(np.argmax(correlation),correlation.shape)
+    dl = 1./(npix*du)
+    return (ix-npix//2)*dl,(iy-npix//2)*dl
+
+def fit_vis_offsets_fluxscale(reference, comparisons, npix=1024, cell_size=0.01, fit_decoherence=False, uvmax=None, niter=10, chunk_size=2000000):
+    """
+    Joint visibility-domain fit of each comparison EB as a shifted, scaled (and optionally decohered) copy of the
+    gridded reference: V_comp(u,v) = scale*exp(-decoherence*q^2)*exp(-2 pi i (u dRA + v dDec))*V_ref(u,v),
+    with q in Mlambda. The offset is first found at the peak of the cross-correlation image, then all parameters are
+    refined by chunked, weighted Gauss-Newton least squares on the .vis.npz data. No imaging is needed, so the
+    alignment and the flux comparison can run before any tclean.
+    Parameters:
+    reference:       .vis.npz file of the reference EB
+    comparisons:     list of .vis.npz files to fit against the reference (not including the reference itself,
+                     whose noise is correlated with the gridded reference)
+    npix, cell_size: image-plane size (pixels) and cell (arcsec) defining the uv grid of the reference,
+                     as in alignment.find_offset (uv cell = 1/(npix*cell_size))
+    fit_decoherence: also fit the uv-dependent decoherence term
+    uvmax:           only use baselines shorter than uvmax (lambda)
+    Returns:
+    dictionary {comparison: {'dRA', 'dDec' (arcsec, positive towards East and North), 'scale' (flux ratio
+    comparison/reference), 'gencal' (sqrt(scale), as printed by estimate_flux_scale), 'decoherence' (Mlambda^-2),
+    the corresponding 'e_'-prefixed errors and the reduced chi2 'chi2_red'}}
+    """
+    du = 1./(npix*cell_size*arcsec)
+    u_ref,v_ref,vis_ref,wgt_ref = load_vis_npz(reference)
+    ref_grid,ref_wgt = grid_visibilities(u_ref,v_ref,vis_ref,wgt_ref,du,npix,chunk_size=chunk_size)
+    del u_ref,v_ref,vis_ref,wgt_ref
+
+    nparams = 4 if fit_decoherence else 3
+    solutions = {}
+    for comparison in comparisons:
+        u,v,vis,wgt = load_vis_npz(comparison)
+        index,inside = _uv_cell_index(u,v,du,npix)
+        #Only keep visibilities with reference data in their uv cell
+        keep = inside.copy()
+        keep[inside] = (ref_wgt[index[inside]] > 0) & (ref_grid[index[inside]] != 0)
+        if uvmax is not None:
+            keep &= np.hypot(u,v) < uvmax
+        u,v,vis,wgt,index = u[keep],v[keep],vis[keep],wgt[keep],index[keep]
+        ref_vis = ref_grid[index]
+        #Combine the comparison weight and the weight of the reference cell
+        wgt = wgt*ref_wgt[index]/(wgt+ref_wgt[index])
+        q2  = (u**2+v**2)/1e12
+        #Noise of the gridded reference biases the scale (and the decoherence) low where the source is faint:
+        #terms quadratic in the reference use the debiased |V_ref|^2-2/W_ref (not clipped, to stay unbiased)
+        debias = 1.-2./(ref_wgt[index]*np.abs(ref_vis)**2)
+
+        dl,dm = _coarse_offset(u,v,vis,wgt,ref_grid,du,npix,chunk_size)
+        amplitude = np.sum(wgt*np.real(vis*np.conj(ref_vis*np.exp(-2j*np.pi*(u*dl+v*dm)))))/np.sum(wgt*debias*np.abs(ref_vis)**2)
+        params = np.array([amplitude,dl,dm,0.][:nparams])
+        for iteration in range(niter):
+            normal = np.zeros((nparams,nparams))
+            rhs    = np.zeros(nparams)
+            chi2   = 0.
+            for i0 in range(0,len(u),chunk_size):
+                chunk = slice(i0,i0+chunk_size)
+                decoherence = np.exp(-params[3]*q2[chunk]) if fit_decoherence else 1.
+                model = params[0]*decoherence*np.exp(-2j*np.pi*(u[chunk]*params[1]+v[chunk]*params[2]))*ref_vis[chunk]
+                residual = vis[chunk]-model
+                jacobian = [model/params[0],-2j*np.pi*u[chunk]*model,-2j*np.pi*v[chunk]*model]
+                if fit_decoherence:
+                    jacobian.append(-q2[chunk]*model)
+                jacobian = np.array(jacobian)
+                debiased = wgt[chunk]*debias[chunk]
+                normal += (jacobian.real*debiased)@jacobian.real.T+(jacobian.imag*debiased)@jacobian.imag.T
+                rhs    += np.real((np.conj(jacobian)*wgt[chunk])@vis[chunk]-(np.conj(jacobian)*debiased)@model)
+                chi2   += np.sum(wgt[chunk]*np.abs(residual)**2)
+            step = np.linalg.solve(normal,rhs)
+            params += step
+            if np.all(np.abs(step[1:3]) < 1e-4*cell_size*arcsec) and abs(step[0]) < 1e-6*abs(params[0]):
+                break
+        chi2_red   = chi2/(2*len(u)-nparams)
+        covariance = np.linalg.inv(normal)*chi2_red
+        errors = np.sqrt(np.diag(covariance))
+        solution = {
+            'dRA':params[1]/arcsec,'dDec':params[2]/arcsec,'scale':params[0],'gencal':np.sqrt(params[0]),
+            'e_dRA':errors[1]/arcsec,'e_dDec':errors[2]/arcsec,'e_scale':errors[0],'chi2_red':chi2_red,
+        }
+        if fit_decoherence:
+            solution['decoherence']   = params[3]
+            solution['e_decoherence'] = errors[3]
+        solutions[comparison] = solution
+        print(f'#{os.path.basename(comparison)} vs {os.path.basename(reference)}:')
+        print(f"#Offset [dRA, dDec] = [{solution['dRA']:.7f}, {solution['dDec']:.7f}] +- [{solution['e_dRA']:.1e}, {solution['e_dDec']:.1e}] arcsec")
+        print(f"#Flux ratio {solution['scale']:.5f} +- {solution['e_scale']:.1e}, gencal scaling factor {solution['gencal']:.3f}")
+        if fit_decoherence:
+            print(f"#Decoherence at 1 Mlambda: {1.-np.exp(-solution['decoherence']):.4f} +- {solution['e_decoherence']:.1e}")
+    return solutions
+
+def deproject_uv(u, v, incl, PA):
+    """
+    Deprojected uv distance (lambda) for a disk with inclination incl and position angle PA (deg, east of north),
+    as in deproject_vis. incl and PA can be arrays (broadcast against u, v).
+    """
+    inc   = np.radians(incl)
+    PArad = 0.5*np.pi-np.radians(PA)
+    up = u*np.cos(PArad)+v*np.sin(PArad)
+    vp = (-u*np.sin(PArad)+v*np.cos(PArad))*np.cos(inc)
+    return np.hypot(up,vp)
+
+def _bin_vis_uv(filenames, du, fluxscale=None, uvmax=None):
+    """
+    Weighted average of the real part of the visibilities of several .vis.npz files (divided by fluxscale) in cartesian
+    uv cells of size du, folded on the v >= 0 half plane since both Re(V) and the deprojected radius are symmetric.
+    Vis/scale is averaged with its inverse-variance weights Wgt*scale**2. Instead of a file name, an item of filenames
+    can be a (u, v, Vis, Wgt) tuple of arrays.
+    Returns the cell centres u, v, the averaged Re(V) and the summed weights.
+    """
+    if fluxscale is None:
+        fluxscale = [1.]*len(filenames)
+    cells_re,cells_w = [],[]
+    for filename,scale in zip(filenames,fluxscale):
+        u,v,vis,wgt = load_vis_npz(filename) if isinstance(filename,str) else filename
+        flip = v < 0
+        u,v  = np.where(flip,-u,u),np.abs(v)
+        if uvmax is not None:
+            inside = np.hypot(u,v) < uvmax
+            u,v,vis,wgt = u[inside],v[inside],vis[inside],wgt[inside]
+        iu = np.round(u/du).astype(np.int64)
+        iv = np.round(v/du).astype(np.int64)
+        keys,inverse = np.unique(iu*(1<<32)+iv,return_inverse=True)
+        cells_re.append((keys,np.bincount(inverse,weights=wgt*scale*vis.real)))
+        cells_w.append((keys,np.bincount(inverse,weights=wgt*scale**2)))
+    keys = np.unique(np.concatenate([k for k,_ in cells_re]))
+    sum_re = np.zeros(len(keys))
+    sum_w  = np.zeros(len(keys))
+    for (k,re),(_,w) in zip(cells_re,cells_w):
+        index = np.searchsorted(keys,k)
+        sum_re[index] += re
+        sum_w[index]  += w
+    iu = (keys+(1<<31))//(1<<32)
+    iv = keys-iu*(1<<32)
+    return iu*du,iv*du,sum_re/sum_w,sum_w
+
+def _profile_scatter(u, v, re, wgt, incl, PA, bin_edges):
+    """
+    Weighted scatter of Re(V) around the deprojected radial profile, for all (incl, PA) pairs at once.
+    Returns an array with the shape of incl (and PA).
+    """
+    incl,PA = np.broadcast_arrays(np.atleast_1d(incl),np.atleast_1d(PA))
+    shape   = incl.shape
+    incl,PA = incl.ravel()[:,None],PA.ravel()[:,None]
+    nbins   = len(bin_edges)-1
+    scatter = np.empty(len(incl))
+    #Process the grid in blocks to bound the memory (ngrid x ncells arrays)
+    block = max(1,int(2e7//len(u)))
+    for g0 in range(0,len(incl),block):
+        rho  = deproject_uv(u[None,:],v[None,:],incl[g0:g0+block],PA[g0:g0+block])
+        ibin = np.digitize(rho,bin_edges)-1
+        valid = (ibin >= 0) & (ibin < nbins)
+        ngrid = rho.shape[0]
+        index = (np.arange(ngrid)[:,None]*nbins+ibin)[valid]
+        w  = np.broadcast_to(wgt,rho.shape)[valid]
+        x  = np.broadcast_to(re,rho.shape)[valid]
+        sw   = np.bincount(index,weights=w,minlength=ngrid*nbins)
+        swx  = np.bincount(index,weights=w*x,minlength=ngrid*nbins)
+        swx2 = np.bincount(index,weights=w*x**2,minlength=ngrid*nbins)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            chi2 = np.where(sw > 0,swx2-swx**2/sw,0.)
+        scatter[g0:g0+block] = chi2.reshape(ngrid,nbins).sum(axis=1)
+    return scatter.reshape(shape)
+
+def fit_disk_geometry(filenames, fluxscale=None, incl_range=(0.,85.), PA_range=(0.,180.), incl_step=5., PA_step=10.,
+                      nlevels=3, refine_factor=5, nbins=60, uvmax=None):
+    """
+    Fit the disk inclination and position angle by minimising the weighted scatter of Re(V) around the deprojected
+    radial profile (an axisymmetric disk has Re(V) depending only on the deprojected uv distance).
+    The visibilities are binned once in uv cells, and every (incl, PA) grid point is evaluated in a single
+    vectorised pass; the grid is then refined around the minimum nlevels-1 times, each time with refine_factor
+    times smaller steps. PA is defined modulo 180 deg.
+    Parameters:
+    filenames:            list of .vis.npz files (e.g. all EBs), optionally divided by the flux ratios fluxscale
+    incl_range, PA_range: ranges (deg) of the coarse grid
+    incl_step, PA_step:   steps (deg) of the coarse grid
+    nbins:                number of radial bins of the deprojected profile
+    uvmax:                only use baselines shorter than uvmax (lambda), default is the 95th percentile uv distance
+    Returns:
+    dictionary with 'incl', 'PA' (deg) and, for each level, the grids and the scatter map ('levels')
+    """
+    if uvmax is None:
+        uv = np.concatenate([np.hypot(*load_vis_npz(filename)[:2]) for filename in filenames])
+        uvmax = np.percentile(uv,95.)
+    bin_edges = np.linspace(0.,uvmax,nbins+1)
+    u,v,re,wgt = _bin_vis_uv(filenames,du=(bin_edges[1]-bin_edges[0])/4.,fluxscale=fluxscale,uvmax=uvmax)
+
+    levels = []
+    incl_grid = np.arange(incl_range[0],incl_range[1]+0.5*incl_step,incl_step)
+    PA_grid   = np.arange(PA_range[0],PA_range[1],PA_step)
+    for level in range(nlevels):
+        incl_2d,PA_2d = np.meshgrid(incl_grid,PA_grid,indexing='ij')
+        scatter = _profile_scatter(u,v,re,wgt,incl_2d,PA_2d,bin_edges)
+        i,j = np.unravel_index(np.argmin(scatter),scatter.shape)
+        best_incl,best_PA = incl_grid[i],PA_grid[j]
+        levels.append({'incl':incl_grid,'PA':PA_grid,'scatter':scatter})
+        print(f'#Level {level}: incl = {best_incl:.2f} deg, PA = {best_PA%180.:.2f} deg (steps {incl_step:.3g}, {PA_step:.3g} deg)')
+        incl_step,PA_step = incl_step/refine_factor,PA_step/refine_factor
+        incl_grid = np.clip(best_incl+incl_step*np.arange(-refine_factor,refine_factor+1),0.,89.)
+        PA_grid   = best_PA+PA_step*np.arange(-refine_factor,refine_factor+1)
+    return {'incl':best_incl,'PA':best_PA%180.,'levels':levels}
+
+def _flux_units(u, v, incl, PA, uvbins, nsectors):
+    """
+    Index of the (deprojected uv bin, deprojected azimuth sector) unit of each visibility, folded on the half plane
+    since Re(V) is symmetric. uvbins are the bin edges in klambda. Returns the valid visibilities and their units.
+    """
+    inc   = np.radians(incl)
+    PArad = 0.5*np.pi-np.radians(PA)
+    up = u*np.cos(PArad)+v*np.sin(PArad)
+    vp = (-u*np.sin(PArad)+v*np.cos(PArad))*np.cos(inc)
+    rho = np.hypot(up,vp)/1e3
+    azimuth = np.mod(np.arctan2(vp,up),np.pi)
+    ibin    = np.digitize(rho,uvbins)-1
+    isector = np.minimum((azimuth/np.pi*nsectors).astype(int),nsectors-1)
+    valid   = (ibin >= 0) & (ibin < len(uvbins)-1)
+    return valid,(ibin*nsectors+isector)[valid]
+
+def _flux_unit_sums(filename, incl, PA, uvbins, nsectors):
+    """
+    Sums of w*Re(V) and w of a .vis.npz file in (deprojected uv bin, deprojected azimuth sector) units.
+    uvbins are the bin edges in klambda. Returns two arrays of shape (nbins, nsectors).
+    """
+    u,v,vis,wgt = load_vis_npz(filename)
+    nbins = len(uvbins)-1
+    valid,unit = _flux_units(u,v,incl,PA,uvbins,nsectors)
+    S = np.bincount(unit,weights=(wgt*vis.real)[valid],minlength=nbins*nsectors)
+    W = np.bincount(unit,weights=wgt[valid],minlength=nbins*nsectors)
+    return S.reshape(nbins,nsectors),W.reshape(nbins,nsectors)
+
+def _weighted_ratio(S_c, W_c, S_r, W_r):
+    """
+    Inverse-variance weighted mean over uv bins of the ratio of the binned profiles (comparison/reference).
+    The sums have the uv bins on the last axis; leading axes (bootstrap replicates) are broadcast.
+    """
+    with np.errstate(invalid='ignore',divide='ignore'):
+        P_c,P_r = S_c/W_c,S_r/W_r
+        ratio   = P_c/P_r
+        #Relative variance of the ratio in each bin from the (relative) weights of both profiles
+        weight  = 1./(ratio**2*(1./(W_c*P_c**2)+1./(W_r*P_r**2)))
+    valid  = np.isfinite(ratio) & np.isfinite(weight) & (P_r > 0)
+    weight = np.where(valid,weight,0.)
+    return np.sum(weight*np.where(valid,ratio,0.),axis=-1)/np.sum(weight,axis=-1)
+
+def bootstrap_flux_scale(pairs, incl, PA, uvbins=np.arange(10.,810.,20.), nsectors=16, nboot=2000, confidence=0.68, rescale_threshold=0.04, seed=0):
+    """
+    Bootstrap and jackknife confidence intervals of the flux ratios of many (comparison, reference) pairs of
+    .vis.npz files in one call, e.g. every EB against the reference EB at every selfcal step.
+    Each file is reduced once to sums of w*Re(V) and w in units of (deprojected uv bin, azimuthal sector); the
+    bootstrap resamples these units (Poisson weights, vectorised over nboot replicates) and the jackknife leaves out
+    one azimuthal sector at a time, so no raw visibilities are resampled. The ratio is the inverse-variance weighted
+    mean over uv bins of the ratio of the deprojected profiles, as in estimate_flux_scale, and the intervals do not
+    depend on the absolute scale of the weights.
+    Parameters:
+    pairs:             dictionary {label: (comparison, reference)}, with .vis.npz files or (S, W) sums of shape
+                       (nbins, nsectors) already reduced, e.g. from the cached profiles of step_binned_profiles
+    incl, PA:          disk geometry (deg) for the deprojection
+    uvbins:            edges of the deprojected uv bins (klambda)
+    nsectors:          number of azimuthal sectors of the resampling units
+    confidence:        confidence level of the intervals
+    rescale_threshold: EBs whose interval lies entirely beyond 1+-rescale_threshold are flagged for rescaling
+    Returns:
+    dictionary {label: {'ratio', 'ci' (low, high), 'std' (bootstrap), 'jackknife_std', 'gencal' (sqrt(ratio)), 'rescale'}}
+    """
+    rng   = np.random.default_rng(seed)
+    sums  = {}
+    for comparison,reference in pairs.values():
+        for filename in (comparison,reference):
+            if isinstance(filename,str) and filename not in sums:
+                sums[filename] = _flux_unit_sums(filename,incl,PA,uvbins,nsectors)
+    nbins = len(uvbins)-1
+    tail  = 50.*(1.-confidence)
+
+    results = {}
+    for label,(comparison,reference) in pairs.items():
+        (S_c,W_c),(S_r,W_r) = (sums[x] if isinstance(x,str) else x for x in (comparison,reference))
+        ratio = _weighted_ratio(S_c.sum(axis=1),W_c.sum(axis=1),S_r.sum(axis=1),W_r.sum(axis=1))
+        #Bootstrap: independent Poisson(1) weights for the units of both files
+        boot = []
+        for S,W in ((S_c,W_c),(S_r,W_r)):
+            counts = rng.poisson(1.,size=(nboot,nbins,nsectors))
+            boot.append((np.sum(counts*S,axis=2),np.sum(counts*W,axis=2)))
+        boot_ratio = _weighted_ratio(boot[0][0],boot[0][1],boot[1][0],boot[1][1])
+        boot_ratio = boot_ratio[np.isfinite(boot_ratio)]
+        #Jackknife: leave one azimuthal sector out of both files
+        jack_ratio = _weighted_ratio(
+            (S_c.sum(axis=1)[:,None]-S_c).T,(W_c.sum(axis=1)[:,None]-W_c).T,
+            (S_r.sum(axis=1)[:,None]-S_r).T,(W_r.sum(axis=1)[:,None]-W_r).T
+        )
+        jackknife_std = np.sqrt((nsectors-1.)/nsectors*np.sum((jack_ratio-jack_ratio.mean())**2))
+        ci = tuple(np.percentile(boot_ratio,[tail,100.-tail]))
+        rescale = ci[0] > 1.+rescale_threshold or ci[1] < 1.-rescale_threshold
+        results[label] = {
+            'ratio':ratio,'ci':ci,'std':np.std(boot_ratio),'jackknife_std':jackknife_std,
+            'gencal':np.sqrt(ratio),'rescale':rescale,
+        }
+        print(
+            f'#{label}: ratio {ratio:.4f} [{ci[0]:.4f}, {ci[1]:.4f}] ({100*confidence:.0f}%), '
+            f'jackknife std {jackknife_std:.4f}, gencal {np.sqrt(ratio):.3f}'+(' -> rescale' if rescale else '')
+        )
+    return results
+
+#Binned profiles of the selfcal steps, keyed on (MS fingerprint, step), so that a new selfcal round only bins its own MS
+flux_ratio_cache_folder = 'flux_ratio_cache'
+
+#Compressed storage of the data columns of intermediate MSs: the columns are moved into chunked, deflated (and
+#optionally quantised) .npz files inside the MS and removed from the table
+compressed_columns_folder = 'COMPRESSED_COLUMNS'
+
+def _read_compressed_index(vis):
+    index = os.path.join(vis,compressed_columns_folder,'index.json')
+    if not os.path.isfile(index):
+        return {}
+    with open(index) as f:
+        return json.load(f)
+
+def _json_default(value):
+    if isinstance(value,np.ndarray):
+        return value.tolist()
+    if isinstance(value,np.generic):
+        return value.item()
+    return str(value)
+
+def _load_compressed_chunk(vis, entry, chunk_file):
+    """
+    Rows and values of one chunk of a compressed column, dequantised if needed.
+    """
+    with np.load(os.path.join(vis,compressed_columns_folder,chunk_file)) as chunk:
+        rows = chunk['rows']
+        if entry['step'] is None:
+            return rows,chunk['values']
+        values = chunk['real'].astype(np.float32)*entry['step']
+        if 'imag' in chunk:
+            values = values+1j*chunk['imag'].astype(np.float32)*entry['step']
+        return rows,values
+
+def _quantise(values, step):
+    """
+    Round values to integer multiples of step, in the smallest integer type holding them.
+    """
+    q = np.round(values/step)
+    qmax = np.abs(q).max() if q.size else 0
+    for dtype in (np.int8,np.int16,np.int32):
+        if qmax <= np.iinfo(dtype).max:
+            return q.astype(dtype)
+    return q.astype(np.int64)
+
+def compress_ms_columns(vis, columns=('DATA','CORRECTED_DATA','MODEL_DATA','WEIGHT_SPECTRUM','SIGMA_SPECTRUM'),
+                        max_error=None, max_chunk_bytes=256*1024**2):
+    """
+    Move the data columns of an intermediate MS into compressed chunk files inside the MS (COMPRESSED_COLUMNS) and
+    remove them from the table, to cut its disk footprint. The columns are read and written one chunk of rows at a
+    time. iter_ms_visibilities (and so export_ms_view, ms_binned_profiles) reads compressed columns directly; use
+    decompress_ms_columns before running CASA tasks on the MS again. Multi-MSs are compressed sub-MS by sub-MS.
+    Parameters:
+    vis:       MS
+    columns:   columns to compress (missing ones are skipped)
+    max_error: None for lossless (deflate only), otherwise visibilities are quantised with an error of at most
+               max_error (data units, e.g. Jy) on the real and imaginary parts; weights are always lossless
+    Returns:
+    bytes of the columns before and after compression
+    """
+    submss = os.path.join(vis,'SUBMSS')
+    if os.path.isdir(submss):
+        sizes = [compress_ms_columns(os.path.join(submss,name),columns,max_error,max_chunk_bytes) for name in sorted(os.listdir(submss))]
+        return tuple(np.sum(sizes,axis=0)) if sizes else (0,0)
+    folder = os.path.join(vis,compressed_columns_folder)
+    os.makedirs(folder,exist_ok=True)
+    index = _read_compressed_index(vis)
+    raw_bytes,compressed_bytes = 0,0
+    tb.open(vis,nomodify=False)
+    try:
+        present = [column for column in columns if column in tb.colnames() and column not in index]
+        dminfo  = tb.getdminfo()
+        ddids   = np.unique(tb.getcol('DATA_DESC_ID'))
+        for column in present:
+            lossy = max_error is not None and 'DATA' in column
+            entry = {
+                'coldesc':tb.getcoldesc(column),
+                'dminfo':next(dict(dm,COLUMNS=[column]) for dm in dminfo.values() if column in dm['COLUMNS']),
+                'step':2.*max_error if lossy else None,'chunks':[],
+            }
+            for ddid in ddids:
+                sub  = tb.query(f'DATA_DESC_ID=={ddid}')
+                rows = sub.rownumbers()
+                nrows = len(rows)
+                if nrows == 0:
+                    sub.close()
+                    continue
+                row_bytes = max(1,sub.getcol(column,startrow=0,nrow=1).nbytes)
+                chunk = max(1,int(max_chunk_bytes//row_bytes))
+                for row0 in range(0,nrows,chunk):
+                    values = sub.getcol(column,startrow=row0,nrow=min(chunk,nrows-row0))
+                    chunk_file = f'{column}_{ddid}_{row0}.npz'
+                    arrays = {'rows':rows[row0:row0+chunk]}
+                    if lossy and np.iscomplexobj(values):
+                        arrays['real'],arrays['imag'] = _quantise(values.real,entry['step']),_quantise(values.imag,entry['step'])
+                    elif lossy:
+                        arrays['real'] = _quantise(values,entry['step'])
+                    else:
+                        arrays['values'] = values
+                    np.savez_compressed(os.path.join(folder,chunk_file),**arrays)
+                    raw_bytes += values.nbytes
+                    compressed_bytes += os.path.getsize(os.path.join(folder,chunk_file))
+                    entry['chunks'].append((int(ddid),chunk_file))
+                sub.close()
+            index[column] = entry
+            with open(os.path.join(folder,'index.json'),'w') as f:
+                json.dump(index,f,default=_json_default)
+        if present:
+            tb.removecols(present)
+    finally:
+        tb.close()
+    if raw_bytes:
+        print(f'#{vis}: {raw_bytes/1e9:.2f} GB of {", ".join(present)} stored in {compressed_bytes/1e9:.2f} GB')
+    return raw_bytes,compressed_bytes
+
+def decompress_ms_columns(vis):
+    """
+    Restore the columns moved out by compress_ms_columns (chunk by chunk) and remove the compressed files.
+    """
+    submss = os.path.join(vis,'SUBMSS')
+    if os.path.isdir(submss):
+        for name in sorted(os.listdir(submss)):
+            decompress_ms_columns(os.path.join(submss,name))
+        return
+    index = _read_compressed_index(vis)
+    if not index:
+        return
+    tb.open(vis,nomodify=False)
+    try:
+        for column,entry in index.items():
+            tb.addcols({column:entry['coldesc']},entry['dminfo'])
+            for _,chunk_file in entry['chunks']:
+                rows,values = _load_compressed_chunk(vis,entry,chunk_file)
+                sel = tb.selectrows(rows)
+                sel.putcol(column,values.astype(np.complex64) if np.iscomplexobj(values) else values)
+                sel.close()
+    finally:
+        tb.close()
+    os.system('rm -rf '+os.path.join(vis,compressed_columns_folder))
+
+def _ms_fingerprint(vis):
+    """
+    Cheap fingerprint of an MS from its absolute path and table stamp (_ms_table_stamp, no data read and no walk of
+    the data files), so a cached profile is recomputed if the MS is rewritten.
+    """
+    key = os.path.abspath(vis)
+    return hashlib.sha1(f'{key} {_ms_table_stamp(key)}'.encode()).hexdigest()[:16]
+
+def ms_observation_view(vis, observation):
+    """
+    Lightweight view of one observation (EB) of a concatenated MS: the rows are selected with a TaQL query when the
+    view is read, so no per-EB copy is split out. Views are accepted by iter_ms_visibilities, export_ms_view and
+    ms_binned_profiles in place of an MS name.
+    """
+    return {'vis':vis,'observation':int(observation),'taql':f'OBSERVATION_ID=={int(observation)}'}
+
+def ms_observation_views(vis):
+    """
+    Views of all the observations of an MS, in observation id order (as split_all_obs numbers its outputs).
+    """
+    return [ms_observation_view(vis,i) for i in sorted(ms_metadata(vis)['observations'])]
+
+def iter_ms_visibilities(vis, datacolumn='data', max_chunk_bytes=256*1024**2):
+    """
+    Iterate over the visibilities of an MS (or of an ms_observation_view) in chunks of rows, reduced as in export_MS:
+    polarizations averaged with their weights, flagged data and autocorrelations dropped, uv in lambda per channel.
+    Columns stored by compress_ms_columns are read directly, also from the sub-MSs of a multi-MS.
+    Yields:
+    observation ids, u, v (lambda), Vis (complex) and Wgt as flat arrays
+    """
+    view   = vis if isinstance(vis,dict) else {'vis':vis,'taql':None}
+    msname = view['vis']
+    column = {'data':'DATA','corrected':'CORRECTED_DATA'}[datacolumn.lower()]
+    submss = os.path.join(msname,'SUBMSS')
+    if os.path.isdir(submss) and any(_read_compressed_index(os.path.join(submss,name)) for name in os.listdir(submss)):
+        #Multi-MS compressed sub-MS by sub-MS (compress_ms_columns): each sub-MS holds its own index and row numbers
+        for name in sorted(os.listdir(submss)):
+            yield from iter_ms_visibilities(dict(view,vis=os.path.join(submss,name)),datacolumn,max_chunk_bytes)
+        return
+    tb.open(os.path.join(msname,'SPECTRAL_WINDOW'))
+    chan_freqs = [tb.getcell('CHAN_FREQ',i) for i in range(tb.nrows())]
+    tb.close()
+    tb.open(os.path.join(msname,'DATA_DESCRIPTION'))
+    ddid_spws = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    compressed = _read_compressed_index(msname).get(column)
+    tb.open(msname)
+    try:
+        if compressed is not None:
+            #Data column stored by compress_ms_columns: decompress chunk by chunk and read the other columns by row
+            for ddid,chunk_file in compressed['chunks']:
+                rows,data = _load_compressed_chunk(msname,compressed,chunk_file)
+                sel = tb.selectrows(rows)
+                chunk = [sel.getcol(col) for col in ('FLAG','WEIGHT','UVW','OBSERVATION_ID','ANTENNA1','ANTENNA2')]
+                sel.close()
+                if view['taql']:
+                    keep = chunk[3] == view['observation']
+                    data,chunk = data[...,keep],[col[...,keep] for col in chunk]
+                if data.shape[-1] > 0:
+                    yield _reduce_vis_chunk(data,*chunk,chan_freqs[ddid_spws[ddid]])
+            return
+        #Query by data description: the shape of the data column is only fixed within a spw
+        for ddid in np.unique(tb.getcol('DATA_DESC_ID')):
+            freqs = chan_freqs[ddid_spws[ddid]]
+            sub   = tb.query(f'DATA_DESC_ID=={ddid}'+(f' && {view["taql"]}' if view['taql'] else ''))
+            nrows = sub.nrows()
+            chunk = max(1,int(max_chunk_bytes//(16*4*len(freqs))))
+            for row0 in range(0,nrows,chunk):
+                nrow = min(chunk,nrows-row0)
+                yield _reduce_vis_chunk(
+                    *(sub.getcol(col,startrow=row0,nrow=nrow) for col in (column,'FLAG','WEIGHT','UVW','OBSERVATION_ID','ANTENNA1','ANTENNA2')),
+                    freqs
+                )
+            sub.close()
+    finally:
+        tb.close()
+
+def _reduce_vis_chunk(data, flag, weight, uvw, obsid, antenna1, antenna2, freqs):
+    """
+    Reduce a chunk of rows as export_MS: weighted average of the polarizations, flagged data and autocorrelations
+    dropped, uv in lambda per channel. Returns observation ids, u, v, Vis and Wgt as flat arrays.
+    """
+    with np.errstate(invalid='ignore',divide='ignore'):
+        vis_I = np.sum(data*weight[:,None,:],axis=0)/np.sum(weight,axis=0)
+    wgt  = np.broadcast_to(np.sum(weight,axis=0),vis_I.shape)
+    good = ~np.any(flag,axis=0) & (antenna1 != antenna2)[None,:] & (wgt > 0)
+    u = uvw[0][None,:]*freqs[:,None]/2.99792458e8
+    v = uvw[1][None,:]*freqs[:,None]/2.99792458e8
+    return np.broadcast_to(obsid[None,:],good.shape)[good],u[good],v[good],vis_I[good],wgt[good]
+
+def export_ms_view(view, outfile=None, datacolumn='data', flux_scale=1.):
+    """
+    Export an ms_observation_view to a .vis.npz file (same contents as export_MS of the split-out EB), reading only
+    the rows of that observation from the concatenated MS.
+    Parameters:
+    view:       ms_observation_view
+    outfile:    default is <MS name without .ms>_EB<observation>.vis.npz, as split_all_obs + export_MS would name it
+    flux_scale: gencal parameter applied while exporting (Vis/g^2, Wgt*g^4), e.g. for an EB whose flux scale is only
+                recorded (set_flux_scale) and not applied in the data column
+    Returns:
+    name of the .vis.npz file
+    """
+    if outfile is None:
+        outfile = view['vis'].rstrip('/').replace('.ms',f'_EB{view["observation"]}.vis.npz')
+    chunks = list(iter_ms_visibilities(view,datacolumn=datacolumn))
+    u,v,vis,wgt = (np.concatenate([chunk[k] for chunk in chunks]) for k in range(1,5))
+    np.savez(outfile,u=u,v=v,Vis=vis/flux_scale**2,Wgt=wgt*flux_scale**4)
+    print('#Measurement set exported to '+outfile)
+    return outfile
+
+def ms_binned_profiles(vis, incl, PA, uvbins=np.arange(10.,810.,20.), nsectors=1, datacolumn='data', max_chunk_bytes=256*1024**2):
+    """
+    Deprojected Re(V) profiles of every EB (observation id) of an MS in a single pass over the main table, instead of
+    split_all_obs + export_MS of each EB (see iter_ms_visibilities).
+    Parameters:
+    vis:        MS, e.g. a concatenated selfcal step
+    incl, PA:   disk geometry (deg) for the deprojection
+    uvbins:     edges of the deprojected uv bins (klambda)
+    nsectors:   number of deprojected azimuthal sectors of each bin (the resampling units of bootstrap_flux_scale)
+    datacolumn: 'data' or 'corrected'
+    Returns:
+    sums of w*Re(V) and of w, two arrays of shape (number of observations, number of uv bins, nsectors), with no
+    observation if nothing is selected
+    """
+    nbins = len(uvbins)-1
+    sums  = {}
+    for obsid,u,v,vis_I,wgt in iter_ms_visibilities(vis,datacolumn=datacolumn,max_chunk_bytes=max_chunk_bytes):
+        valid,unit = _flux_units(u,v,incl,PA,uvbins,nsectors)
+        obsid,vis_I,wgt = obsid[valid],vis_I[valid],wgt[valid]
+        for i in np.unique(obsid):
+            select = obsid == i
+            S,W = sums.setdefault(int(i),(np.zeros(nbins*nsectors),np.zeros(nbins*nsectors)))
+            S += np.bincount(unit[select],weights=(wgt*vis_I.real)[select],minlength=nbins*nsectors)
+            W += np.bincount(unit[select],weights=wgt[select],minlength=nbins*nsectors)
+    nobs = max(sums)+1 if sums else 0
+    S,W = np.zeros((nobs,nbins,nsectors)),np.zeros((nobs,nbins,nsectors))
+    for i,(S_i,W_i) in sums.items():
+        S[i],W[i] = S_i.reshape(nbins,nsectors),W_i.reshape(nbins,nsectors)
+    return S,W
+
+def _read_flux_ratio_table(table):
+    if not os.path.isfile(table):
+        return {'steps':{}}
+    with open(table) as f:
+        return json.load(f)
+
+def step_binned_profiles(step, vis, incl, PA, uvbins=np.arange(10.,810.,20.), nsectors=16, datacolumn='data',
+                         cache_folder=flux_ratio_cache_folder, fingerprint=None):
+    """
+    Binned profiles of every EB of the MS of a selfcal step (ms_binned_profiles), cached on disk keyed on
+    (MS fingerprint, step, binning), so only new or rewritten steps are binned and earlier steps are never recomputed.
+    Returns:
+    sums of w*Re(V) and of w, two arrays of shape (number of EBs, number of uv bins, nsectors); S[i],W[i] can be
+    given to bootstrap_flux_scale in place of the .vis.npz file of EB i
+    (fingerprint: _ms_fingerprint of vis, when the caller already has it)
+    """
+    if fingerprint is None:
+        fingerprint = _ms_fingerprint(vis)
+    setup = hashlib.sha1(repr((float(incl),float(PA),list(np.asarray(uvbins,float)),int(nsectors),datacolumn)).encode()).hexdigest()[:8]
+    cache = os.path.join(cache_folder,f'{os.path.basename(vis.rstrip("/"))}_{step}_{fingerprint}_{setup}.npz')
+    if os.path.isfile(cache):
+        binned = np.load(cache)
+        return binned['S'],binned['W']
+    S,W = ms_binned_profiles(vis,incl,PA,uvbins=uvbins,nsectors=nsectors,datacolumn=datacolumn)
+    os.makedirs(cache_folder,exist_ok=True)
+    np.savez(cache,S=S,W=W)
+    return S,W
+
+def track_flux_ratios(step, vis, reference_EB, incl, PA, table, uvbins=np.arange(10.,810.,20.), datacolumn='data',
+                      cache_folder=flux_ratio_cache_folder, rescale_threshold=0.04):
+    """
+    Flux ratios of every EB of the MS of a selfcal step to its reference EB, added to a ratio-vs-step table.
+    The binned profiles of each step are cached (step_binned_profiles), so only new or rewritten steps are binned
+    (one pass over the MS, see ms_binned_profiles) and earlier steps are never recomputed.
+    The ratio is the inverse-variance weighted mean over uv bins of the ratio of the deprojected profiles, as in
+    estimate_flux_scale.
+    Parameters:
+    step:              label of the selfcal step, e.g. 'p0'
+    vis:               MS of the step (all EBs, as before split_all_obs)
+    reference_EB:      observation id of the flux reference EB
+    incl, PA:          disk geometry (deg) for the deprojection
+    table:             JSON file holding the ratio-vs-step table (see flux_ratio_trend)
+    uvbins:            edges of the deprojected uv bins (klambda)
+    rescale_threshold: EBs with |ratio-1| above the threshold are marked for rescaling
+    Returns:
+    array of the ratios of all EBs
+    """
+    fingerprint = _ms_fingerprint(vis)
+    S,W = step_binned_profiles(step,vis,incl,PA,uvbins=uvbins,datacolumn=datacolumn,cache_folder=cache_folder,fingerprint=fingerprint)
+    S,W = S.sum(axis=-1),W.sum(axis=-1)
+    ratio = _weighted_ratio(S,W,S[reference_EB],W[reference_EB])
+
+    ratios = _read_flux_ratio_table(table)
+    steps = list(ratios['steps'])
+    index = steps.index(step) if step in steps else len(steps)
+    previous = ratios['steps'][steps[index-1]]['ratio'] if index > 0 else None
+    ratios['reference_EB'] = int(reference_EB)
+    ratios['steps'][step] = {
+        'vis':vis,'fingerprint':fingerprint,'ratio':[float(r) for r in ratio],
+        'gencal':[float(np.sqrt(r)) for r in ratio],
+    }
+    with open(table,'w') as f:
+        json.dump(ratios,f,indent=1)
+    for i,r in enumerate(ratio):
+        trend = f', {r-previous[i]:+.5f} since previous step' if previous is not None else ''
+        rescale = ' -> rescale' if abs(r-1.) > rescale_threshold else ''
+        print(f'#{step} EB{i}: ratio {r:.5f} (gencal {np.sqrt(r):.3f}) vs EB{reference_EB}{trend}{rescale}')
+    return ratio
+
+def flux_ratio_trend(table, EB=None):
+    """
+    Ratio-vs-step table written by track_flux_ratios.
+    Returns the list of steps (in the order they were added) and the ratios, an array of shape (steps, EBs),
+    or (steps,) for a single EB.
+    """
+    steps  = _read_flux_ratio_table(table)['steps']
+    ratios = np.array([entry['ratio'] for entry in steps.values()])
+    if EB is not None:
+        ratios = ratios[:,EB]
+    return list(steps),ratios